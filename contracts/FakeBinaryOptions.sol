@@ -0,0 +1,73 @@
+// SPDX-License-Identifier: BUSL-1.1
+
+pragma solidity 0.8.4;
+
+import "./interfaces/Interfaces.sol";
+
+/**
+ * @notice Options contract stub whose options can be set to fail while being
+ * unlocked with a panic or a revert without any data
+ */
+contract FakeBinaryOptions {
+    enum FailureMode {
+        None,
+        Panic,
+        Revert
+    }
+
+    string public assetPair;
+    mapping(uint256 => uint256) public expirationOf;
+    mapping(uint256 => FailureMode) public failureModes;
+    mapping(uint256 => IBufferBinaryOptions.State) public states;
+
+    constructor(string memory _assetPair) {
+        assetPair = _assetPair;
+    }
+
+    function createOption(
+        uint256 optionId,
+        uint256 expiration,
+        FailureMode failureMode
+    ) external {
+        states[optionId] = IBufferBinaryOptions.State.Active;
+        expirationOf[optionId] = expiration;
+        failureModes[optionId] = failureMode;
+    }
+
+    function settlementInfo(uint256 optionId)
+        external
+        view
+        returns (
+            IBufferBinaryOptions.State state,
+            uint256 strike,
+            uint256 expiration,
+            bool isAbove
+        )
+    {
+        return (states[optionId], 0, expirationOf[optionId], true);
+    }
+
+    function unlockBatch(
+        IBufferBinaryOptions.OptionExpiryData[] calldata optionData
+    ) external {
+        for (uint256 i = 0; i < optionData.length; i++) {
+            unlock(optionData[i].optionId, optionData[i].priceAtExpiration, 0);
+        }
+    }
+
+    function unlock(
+        uint256 optionId,
+        uint256,
+        uint256
+    ) public {
+        FailureMode failureMode = failureModes[optionId];
+        if (failureMode == FailureMode.Panic) {
+            // Arithmetic underflow
+            uint256 expired = uint256(states[optionId]) - 2;
+            states[optionId] = IBufferBinaryOptions.State(expired);
+        } else if (failureMode == FailureMode.Revert) {
+            revert();
+        }
+        states[optionId] = IBufferBinaryOptions.State.Expired;
+    }
+}
@@ -111,6 +111,16 @@ contract FakeTraderNFT is
         return ownerOf(tokenId);
     }
 
+    function tokenOwnerAndEpoch(uint256 tokenId)
+        external
+        view
+        override
+        returns (address user, uint32 epoch)
+    {
+        // The tiers are only set while minting so the epoch never changes
+        return (ownerOf(tokenId), 0);
+    }
+
     function setBaseURI(string memory value) external onlyOwner {
         baseURI = value;
         emit UpdateBaseURI(baseURI);
@@ -852,6 +852,30 @@ library OptionMath {
     int128 private constant CDF_CONST_1 = 0x19abac0ea1da65036; // 6400 / 3989
     int128 private constant CDF_CONST_2 = 0x0d3c84b78b749bd6b; // 3300 / 3989
 
+    // Normal CDF and PDF at d = i / 4 for i in [0, 24] as 32 bit fractions, entry i
+    // is stored at bits [32 * (i % 8), 32 * (i % 8) + 32) of the word i / 8.
+    // Generated by scripts/option_pricing.py
+    uint256 private constant CDF_TABLE_0 =
+        0xf5beaedfeee5b927e4f422edd7625e89c5fbbff5b103af129944d15980000000;
+    uint256 private constant CDF_TABLE_1 =
+        0xfffa349bfff0c122ffda2f20ffa78878ff3cb7defe690b1bfcdedb62fa2d0c1f;
+    uint256 private constant CDF_TABLE_2 =
+        0xffffffedffffffaefffffeb9fffffb31ffffeef0ffffc6ffffff4cadfffdeca5;
+    uint256 private constant CDF_TABLE_3 =
+        0x00000000000000000000000000000000000000000000000000000000fffffffc;
+    uint256 private constant PDF_TABLE_0 =
+        0x16164537212810ae2ec217283df1cb1c4d1757bf5a20f40962fcae84662114cf;
+    uint256 private constant PDF_TABLE_1 =
+        0x00171b93003931300084f9c7012272140253f4aa047cbc15082016ff0dd25a1b;
+    uint256 private constant PDF_TABLE_2 =
+        0x00000071000001cf000006ed000018f10000546200010c2a000320960008c54c;
+    uint256 private constant PDF_TABLE_3 =
+        0x000000000000000000000000000000000000000000000000000000000000001a;
+    uint256 private constant CDF_TABLE_STEPS = 24; // The CDF is 1 within 1e-9 past d = 6
+
+    // ln(spot / strike) is computed with the atanh series below this |z|, see _ln
+    int256 private constant MAX_SERIES_Z_64x64 = 0x2000000000000000; // 1 / 8
+
     /**
      * @notice calculate the exponential decay coefficient for a given interval
      * @param oldTimestamp timestamp of previous update
@@ -926,6 +950,130 @@ library OptionMath {
         return ABDKMath64x64.toUInt(premium64x64.mul(D8));
     }
 
+    /**
+     * @notice calculate the volatility dependent term of blackScholesPriceBinaryFast
+     * @param impliedVol uint256 representation of annualized impliedVol with a factor of 1e4
+     * @return 64x64 fixed point representation of impliedVol / sqrt(365 days)
+     */
+    function volatilityPerSqrtSecond(uint256 impliedVol)
+        public
+        pure
+        returns (int128)
+    {
+        return
+            ABDKMath64x64.divu(impliedVol, 10**4).div(
+                ABDKMath64x64.fromUInt(365 days).sqrt()
+            );
+    }
+
+    /**
+     * @notice calculate the price of a "yes" option like blackScholesPriceBinary
+     * with the volatility term precomputed, the log computed with a series and
+     * the CDF interpolated from a table. The price is within 1e-5 of the exact
+     * Black-Scholes price
+     * @param volatilityPerSqrtSecond64x64 output of volatilityPerSqrtSecond
+     * @param strike uint256 representation of strike price with a factor of 1e8
+     * @param spot uint256 representation of spot price with a factor of 1e8
+     * @param period uint256 representation of duration of option contract (in seconds)
+     * @param isAbove whether to the user bets the price will stay above this strike or not
+     * @return uint256 representation of Black-Scholes option price with a factor of 1e8
+     */
+    function blackScholesPriceBinaryFast(
+        int128 volatilityPerSqrtSecond64x64,
+        uint256 strike,
+        uint256 spot,
+        uint256 period,
+        bool isAbove
+    ) public pure returns (uint256) {
+        int256 stdDev64x64 = (int256(volatilityPerSqrtSecond64x64) *
+            int256(ABDKMath64x64.fromUInt(period).sqrt())) >> 64;
+        int256 d2_64x64 = (_ln(spot, strike) << 64) /
+            stdDev64x64 -
+            (stdDev64x64 >> 1);
+
+        int256 premium64x64 = _cdf(isAbove ? d2_64x64 : -d2_64x64);
+        return uint256(premium64x64 * 10**8) >> 64;
+    }
+
+    /**
+     * @notice calculate ln(spot / strike) as 2 * atanh(z) with
+     * z = (spot - strike) / (spot + strike) using the first 5 terms of the
+     * atanh series, the truncation error is below 1e-10 for |z| <= 1 / 8
+     * @return 64x64 fixed point representation of ln(spot / strike)
+     */
+    function _ln(uint256 spot, uint256 strike) internal pure returns (int256) {
+        int256 z64x64 = ((int256(spot) - int256(strike)) << 64) /
+            int256(spot + strike);
+        if (z64x64 > MAX_SERIES_Z_64x64 || z64x64 < -MAX_SERIES_Z_64x64) {
+            return ABDKMath64x64.divu(spot, strike).ln();
+        }
+
+        int256 zSquared64x64 = (z64x64 * z64x64) >> 64;
+        int256 term64x64 = z64x64;
+        int256 sum64x64 = z64x64;
+        for (int256 k = 3; k <= 9; k += 2) {
+            term64x64 = (term64x64 * zSquared64x64) >> 64;
+            sum64x64 += term64x64 / k;
+        }
+        return sum64x64 * 2;
+    }
+
+    /**
+     * @notice calculate the normal CDF by cubic Hermite interpolation between
+     * the tabulated values, using the PDF as the derivative. The error is below
+     * 6e-6 over the whole range
+     * @param input64x64 64x64 fixed point representation of random variable
+     * @return 64x64 fixed point representation of the CDF of the input
+     */
+    function _cdf(int256 input64x64) internal pure returns (int256) {
+        int256 abs64x64 = input64x64 < 0 ? -input64x64 : input64x64;
+        int256 value64x64 = ONE_64x64;
+
+        // The table has a step of 1 / 4
+        uint256 index = uint256(abs64x64 >> 62);
+        if (index < CDF_TABLE_STEPS) {
+            int256 t64x64 = (abs64x64 << 2) - (int256(index) << 64);
+            int256 tSquared64x64 = (t64x64 * t64x64) >> 64;
+            int256 tCubed64x64 = (tSquared64x64 * t64x64) >> 64;
+            (int256 cdf0_64x64, int256 pdf0_64x64) = _cdfTableEntry(index);
+            (int256 cdf1_64x64, int256 pdf1_64x64) = _cdfTableEntry(index + 1);
+
+            value64x64 =
+                cdf0_64x64 +
+                (((3 * tSquared64x64 - 2 * tCubed64x64) *
+                    (cdf1_64x64 - cdf0_64x64) +
+                    (tCubed64x64 - 2 * tSquared64x64 + t64x64) *
+                    (pdf0_64x64 >> 2) +
+                    (tCubed64x64 - tSquared64x64) *
+                    (pdf1_64x64 >> 2)) >> 64);
+        }
+
+        return input64x64 < 0 ? ONE_64x64 - value64x64 : value64x64;
+    }
+
+    /**
+     * @notice read the CDF and PDF at d = index / 4 from the tables
+     */
+    function _cdfTableEntry(uint256 index)
+        internal
+        pure
+        returns (int256 cdf64x64, int256 pdf64x64)
+    {
+        uint256 cdfWord = CDF_TABLE_3;
+        uint256 pdfWord = PDF_TABLE_3;
+        if (index < 8) {
+            (cdfWord, pdfWord) = (CDF_TABLE_0, PDF_TABLE_0);
+        } else if (index < 16) {
+            (cdfWord, pdfWord) = (CDF_TABLE_1, PDF_TABLE_1);
+        } else if (index < 24) {
+            (cdfWord, pdfWord) = (CDF_TABLE_2, PDF_TABLE_2);
+        }
+
+        uint256 shift = 32 * (index % 8);
+        cdf64x64 = int256(((cdfWord >> shift) & 0xffffffff) << 32);
+        pdf64x64 = int256(((pdfWord >> shift) & 0xffffffff) << 32);
+    }
+
     /**
      * @notice calculate the price of an option using the Black-Scholes model
      * @param varianceAnnualized64x64 64x64 fixed point representation of annualized variance
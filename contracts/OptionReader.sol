@@ -5,6 +5,26 @@ pragma solidity 0.8.4;
 import "./interfaces/Interfaces.sol";
 
 contract OptionReader {
+    struct MarketData {
+        uint256 maxFeeForIsAbove;
+        uint256 maxFeeForIsBelow;
+        uint256 payoutForIsAbove;
+        uint256 payoutForIsBelow;
+        uint256 maxUtilization;
+    }
+    struct PoolData {
+        ILiquidityPool pool;
+        uint256 totalTokenXBalance;
+        uint256 availableBalance;
+    }
+    struct UserDiscount {
+        address traderNFTContract;
+        bool isNFTOwner;
+        uint8 nftTier;
+        IReferralStorage referral;
+        uint8 referrerStep;
+    }
+
     ILiquidityPool public pool;
 
     constructor(ILiquidityPool _pool) {
@@ -90,8 +110,8 @@ contract OptionReader {
         IBufferOptionsForReader options = IBufferOptionsForReader(
             optionsContract
         );
-        address referrer = IReferralStorage(options.referral()).codeOwner(
-            referralCode
+        address referrer = IReferralStorage(options.referral()).codeHashOwner(
+            keccak256(bytes(referralCode))
         );
 
         uint256 settlementFeePercentage = isAbove
@@ -109,6 +129,222 @@ contract OptionReader {
         payout = 100e2 - (2 * settlementFeePercentage);
     }
 
+    /**
+     * @notice Returns the max fees, payouts and max utilization of the user
+     * for every market in a single call. The pool balances and the user's
+     * NFT and referrer discounts are read once and shared between the markets
+     * using the same contracts
+     */
+    function getMarketsData(
+        IBufferOptionsForReader[] calldata optionsContracts,
+        uint256 traderNFTId,
+        string calldata referralCode,
+        address user
+    ) external view returns (MarketData[] memory markets) {
+        markets = new MarketData[](optionsContracts.length);
+        PoolData[] memory pools = new PoolData[](optionsContracts.length);
+        UserDiscount memory discount;
+
+        for (uint256 i = 0; i < optionsContracts.length; i++) {
+            IBufferOptionsForReader options = optionsContracts[i];
+            IOptionsConfig.Snapshot memory config = options
+                .config()
+                .snapshot();
+            _loadUserDiscount(
+                discount,
+                config.traderNFTContract,
+                options.referral(),
+                traderNFTId,
+                referralCode,
+                user
+            );
+            markets[i] = _getMarketData(
+                options,
+                config,
+                _getPoolData(pools, options.pool()),
+                discount
+            );
+        }
+    }
+
+    function _getMarketData(
+        IBufferOptionsForReader options,
+        IOptionsConfig.Snapshot memory config,
+        PoolData memory poolData,
+        UserDiscount memory discount
+    ) internal view returns (MarketData memory market) {
+        uint256 maxStep = discount.isNFTOwner
+            ? options.nftTierStep(discount.nftTier)
+            : 0;
+        if (discount.referrerStep > maxStep) {
+            maxStep = discount.referrerStep;
+        }
+        uint256 feeDiscount = options.stepSize() * maxStep;
+        uint256 settlementFeePercentageForAbove = options
+            .baseSettlementFeePercentageForAbove() - feeDiscount;
+        uint256 settlementFeePercentageForBelow = options
+            .baseSettlementFeePercentageForBelow() - feeDiscount;
+        market.payoutForIsAbove = 100e2 - (2 * settlementFeePercentageForAbove);
+        market.payoutForIsBelow = 100e2 - (2 * settlementFeePercentageForBelow);
+
+        // Same as BufferBinaryOptions.getMaxUtilization without reverting
+        market.maxUtilization = min(
+            _getMaxUtilization(
+                poolData.totalTokenXBalance,
+                poolData.totalTokenXBalance - options.totalLockedAmount(),
+                config.assetUtilizationLimit
+            ),
+            _getMaxUtilization(
+                poolData.totalTokenXBalance,
+                poolData.availableBalance,
+                config.overallPoolUtilizationLimit
+            )
+        );
+
+        uint256 maxPerTxnFee = ((poolData.availableBalance *
+            config.optionFeePerTxnLimitPercent) / 100e2);
+        market.maxFeeForIsAbove = min(
+            _getTotalFee(
+                market.maxUtilization,
+                settlementFeePercentageForAbove
+            ),
+            maxPerTxnFee
+        );
+        market.maxFeeForIsBelow = min(
+            _getTotalFee(
+                market.maxUtilization,
+                settlementFeePercentageForBelow
+            ),
+            maxPerTxnFee
+        );
+    }
+
+    function _getPoolData(PoolData[] memory pools, ILiquidityPool _pool)
+        internal
+        view
+        returns (PoolData memory poolData)
+    {
+        uint256 i;
+        while (address(pools[i].pool) != address(0)) {
+            if (pools[i].pool == _pool) {
+                return pools[i];
+            }
+            i++;
+        }
+        pools[i] = PoolData(
+            _pool,
+            _pool.totalTokenXBalance(),
+            _pool.availableBalance()
+        );
+        return pools[i];
+    }
+
+    function _loadUserDiscount(
+        UserDiscount memory discount,
+        address traderNFTContract,
+        IReferralStorage referral,
+        uint256 traderNFTId,
+        string calldata referralCode,
+        address user
+    ) internal view {
+        if (discount.traderNFTContract != traderNFTContract) {
+            discount.traderNFTContract = traderNFTContract;
+            discount.isNFTOwner =
+                traderNFTContract != address(0) &&
+                ITraderNFT(traderNFTContract).tokenOwner(traderNFTId) == user;
+            if (discount.isNFTOwner) {
+                discount.nftTier = ITraderNFT(traderNFTContract)
+                    .tokenTierMappings(traderNFTId);
+            }
+        }
+        if (discount.referral != referral) {
+            discount.referral = referral;
+            (address referrer, , uint8 referrerStep, ) = referral.resolve(
+                keccak256(bytes(referralCode))
+            );
+            discount.referrerStep = referrer != user &&
+                referrer != address(0) &&
+                referrer.code.length == 0
+                ? referrerStep
+                : 0;
+        }
+    }
+
+    function _getMaxUtilization(
+        uint256 totalPoolBalance,
+        uint256 availableBalance,
+        uint256 utilizationLimit
+    ) internal pure returns (uint256) {
+        uint256 minBalance = ((1e4 - utilizationLimit) * totalPoolBalance) /
+            1e4;
+        return
+            availableBalance > minBalance ? availableBalance - minBalance : 0;
+    }
+
+    function _getTotalFee(uint256 amount, uint256 settlementFeePercentage)
+        internal
+        pure
+        returns (uint256)
+    {
+        return ((amount / 2) * 1e4) / (1e4 - settlementFeePercentage);
+    }
+
+    /**
+     * @notice Returns a page of the options created for the user, newest first.
+     * With activeOnly set only the unsettled options currently held by the user
+     * are paged, from the end of the user's active index. That index isn't
+     * sorted since removing an option from it moves the last one in its place
+     */
+    function getUserOptions(
+        IBufferOptionsForReader options,
+        address user,
+        uint256 offset,
+        uint256 limit,
+        bool activeOnly
+    )
+        external
+        view
+        returns (
+            uint256[] memory optionIds,
+            IBufferBinaryOptions.Option[] memory userOptions
+        )
+    {
+        uint256 total = activeOnly
+            ? options.userActiveOptionCount(user)
+            : options.userOptionCount(user);
+        uint256 count = offset < total ? total - offset : 0;
+        if (count > limit) {
+            count = limit;
+        }
+
+        optionIds = new uint256[](count);
+        userOptions = new IBufferBinaryOptions.Option[](count);
+        for (uint256 i = 0; i < count; i++) {
+            uint256 index = total - 1 - offset - i;
+            optionIds[i] = activeOnly
+                ? options.userActiveOptionIds(user, index)
+                : options.userOptionIds(user, index);
+            userOptions[i] = _getOption(options, optionIds[i]);
+        }
+    }
+
+    function _getOption(IBufferOptionsForReader options, uint256 optionId)
+        internal
+        view
+        returns (IBufferBinaryOptions.Option memory option)
+    {
+        (
+            option.state,
+            option.strike,
+            option.amount,
+            option.lockedAmount,
+            option.expiration,
+            option.isAbove,
+            option.totalFee,
+            option.createdAt
+        ) = options.options(optionId);
+    }
+
     function min(uint256 a, uint256 b) internal pure returns (uint256) {
         return a < b ? a : b;
     }
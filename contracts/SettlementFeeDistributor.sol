@@ -11,7 +11,7 @@ import "./interfaces/Interfaces.sol";
  * @notice Distributes the SettlementFee Collected by the Buffer Protocol
  */
 
-contract SettlementFeeDistributor
+contract SettlementFeeDistributor is ISettlementFeeDistributor
 {
     using SafeERC20 for ERC20;
     
@@ -29,7 +29,7 @@ contract SettlementFeeDistributor
         blpDistributor = _blpDistributor;
     }
 
-    function distribute() external {
+    function distribute() external override {
         uint256 contractBalance = tokenX.balanceOf(address(this));
 
         if(contractBalance > 10 * (10 ** tokenX.decimals())){
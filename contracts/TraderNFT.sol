@@ -10,6 +10,7 @@ import "@openzeppelin/contracts/access/Ownable.sol";
 contract TraderNFT is ITraderNFT, Ownable {
     uint256[] public updatedBatchIds;
     IERC721 public nftAddress;
+    uint32 public tierEpoch; // Bumped on every tier update to invalidate cached tiers
     mapping(uint256 => uint8) public override tokenTierMappings;
 
     constructor(IERC721 _nftAddress) {
@@ -28,11 +29,12 @@ contract TraderNFT is ITraderNFT, Ownable {
         for (uint256 index = 0; index < _batchIds.length; index++) {
             updatedBatchIds.push(_batchIds[index]);
         }
+        tierEpoch++;
         emit UpdateTiers(_tokenIds, _tiers, _batchIds);
     }
 
     function tokenOwner(uint256 id)
-        external
+        public
         view
         override
         returns (address user)
@@ -44,6 +46,15 @@ contract TraderNFT is ITraderNFT, Ownable {
         }
     }
 
+    function tokenOwnerAndEpoch(uint256 id)
+        external
+        view
+        override
+        returns (address user, uint32 epoch)
+    {
+        return (tokenOwner(id), tierEpoch);
+    }
+
     function getUpdatedBatchIds() external view returns (uint256[] memory) {
         return updatedBatchIds;
     }
@@ -6,6 +6,7 @@ import "@openzeppelin/contracts/security/ReentrancyGuard.sol";
 import "@openzeppelin/contracts/token/ERC721/ERC721.sol";
 import "@openzeppelin/contracts/access/AccessControl.sol";
 import "@openzeppelin/contracts/token/ERC20/utils/SafeERC20.sol";
+import "@openzeppelin/contracts/utils/math/SafeCast.sol";
 import "../interfaces/Interfaces.sol";
 import "../Libraries/OptionMath.sol";
 
@@ -24,6 +25,8 @@ contract BufferBinaryOptions is
     using SafeERC20 for ERC20;
     uint256 public nextTokenId = 0;
     uint256 public totalLockedAmount;
+    uint128 public pendingPremium;
+    uint128 public override accruedSettlementFees;
     bool public isPaused;
     uint16 public baseSettlementFeePercentageForAbove; // Factor of 1e2
     uint16 public baseSettlementFeePercentageForBelow; // Factor of 1e2
@@ -35,12 +38,25 @@ contract BufferBinaryOptions is
     IReferralStorage public referral;
     AssetCategory public assetCategory;
     ERC20 public override tokenX;
+    uint8 internal immutable tokenXDecimals;
+    uint256 internal immutable tokenXUnit;
+
+    IOptionsConfig.Snapshot internal configSnapshot;
+    PricingTerms internal pricingTerms;
 
     mapping(uint256 => Option) public override options;
     mapping(address => uint256[]) public userOptionIds;
+    mapping(address => uint256[]) public userActiveOptionIds;
+    mapping(uint256 => uint256) internal activeOptionPosition;
     mapping(uint8 => uint8) public nftTierStep;
+    mapping(uint256 => NFTTierCache) internal nftTierCache;
+    mapping(uint256 => uint256[]) internal expiryBucketOptionIds;
 
     bytes32 public constant ROUTER_ROLE = keccak256("ROUTER_ROLE");
+    uint256 public constant EXPIRY_BUCKET_SIZE = 1 minutes;
+    uint256 public constant MAX_EXPIRY_QUERY_LIMIT = 1000;
+    uint256 public constant MAX_EXPIRY_QUERY_RANGE = 7 days;
+    uint256 public constant MAX_EXPIRY_QUERY_SCAN = 2000;
 
     /************************************************
      *  INITIALIZATION FUNCTIONS
@@ -55,6 +71,8 @@ contract BufferBinaryOptions is
         string memory _assetPair
     ) ERC721("Buffer", "BFR") {
         tokenX = _tokenX;
+        tokenXDecimals = _tokenX.decimals();
+        tokenXUnit = 10**_tokenX.decimals();
         pool = _pool;
         config = _config;
         referral = _referral;
@@ -99,55 +117,79 @@ contract BufferBinaryOptions is
         emit Pause(isPaused);
     }
 
+    /**
+     * @notice Forwards the settlement fees accrued by the created options to
+     * the settlement fee disbursal contract in a single transfer
+     * @dev Permissionless, the destination is always read from the config
+     * @param callDistribute Also triggers the distribution of the forwarded fees
+     */
+    function sweepSettlementFees(bool callDistribute) external nonReentrant {
+        uint256 amount = accruedSettlementFees;
+        address settlementFeeDisbursalContract = config
+            .settlementFeeDisbursalContract();
+        accruedSettlementFees = 0;
+
+        if (amount > 0) {
+            tokenX.safeTransfer(settlementFeeDisbursalContract, amount);
+        }
+        if (callDistribute) {
+            ISettlementFeeDistributor(settlementFeeDisbursalContract)
+                .distribute();
+        }
+        emit SweepSettlementFees(settlementFeeDisbursalContract, amount);
+    }
+
     /************************************************
      *  ROUTER ONLY FUNCTIONS
      ***********************************************/
 
     /**
      * @notice Creates an option with the specified parameters
-     * @dev Can only be called by router
+     * @dev Can only be called by router. The router pays the returned referrer fee
+     * out of the total fee and sends the rest of it to this contract
      */
     function createFromRouter(
         OptionParams calldata optionParams,
-        bool isReferralValid,
+        DiscountMemo calldata discountMemo,
         uint256 queuedTime
-    ) external override onlyRole(ROUTER_ROLE) returns (uint256 optionID) {
+    )
+        external
+        override
+        onlyRole(ROUTER_ROLE)
+        returns (
+            uint256 optionID,
+            address referrer,
+            uint256 referrerFee
+        )
+    {
         Option memory option = Option(
             State.Active,
-            optionParams.strike,
-            optionParams.amount,
-            optionParams.amount,
-            optionParams.amount / 2,
-            queuedTime + optionParams.period,
+            SafeCast.toUint128(optionParams.strike),
+            SafeCast.toUint128(optionParams.amount),
+            SafeCast.toUint128(optionParams.amount),
+            SafeCast.toUint32(queuedTime + optionParams.period),
             optionParams.isAbove,
-            optionParams.totalFee,
-            queuedTime
+            SafeCast.toUint128(optionParams.totalFee),
+            SafeCast.toUint32(queuedTime)
         );
+        uint256 premium = optionParams.amount / 2;
         totalLockedAmount += optionParams.amount;
         optionID = _generateTokenId();
         userOptionIds[optionParams.user].push(optionID);
         options[optionID] = option;
+        _addToExpiryIndex(optionID, option.expiration);
         _mint(optionParams.user, optionID);
 
-        uint256 referrerFee = _processReferralRebate(
-            optionParams.user,
-            optionParams.totalFee,
-            optionParams.amount,
-            optionParams.referralCode,
-            optionParams.isAbove,
-            isReferralValid
-        );
+        referrer = discountMemo.referrer;
+        referrerFee = _processReferralRebate(optionParams, discountMemo);
 
-        uint256 settlementFee = optionParams.totalFee -
-            option.premium -
-            referrerFee;
+        uint256 settlementFee = optionParams.totalFee - premium - referrerFee;
 
-        tokenX.safeTransfer(
-            config.settlementFeeDisbursalContract(),
-            settlementFee
-        );
-
-        pool.lock(optionID, option.lockedAmount, option.premium);
+        // The premium is moved by settleBatch once all the trades of the router
+        // batch have been opened while the settlement fee stays here until swept
+        pool.lockDeferred(optionID, option.lockedAmount, premium);
+        pendingPremium += SafeCast.toUint128(premium);
+        accruedSettlementFees += SafeCast.toUint128(settlementFee);
         emit Create(
             optionParams.user,
             optionID,
@@ -156,6 +198,20 @@ contract BufferBinaryOptions is
         );
     }
 
+    /**
+     * @notice Pays the premiums of the options created since the last call
+     * to the pool
+     * @dev Can only be called by router at the end of every batch of opened trades
+     */
+    function settleBatch() external override onlyRole(ROUTER_ROLE) {
+        uint256 premium = pendingPremium;
+        pendingPremium = 0;
+
+        if (premium > 0) {
+            pool.collectPremium(premium);
+        }
+    }
+
     /**
      * @notice Unlocks/Exercises the active options
      * @dev Can only be called router
@@ -165,24 +221,66 @@ contract BufferBinaryOptions is
         uint256 closingPrice,
         uint256 closingTime
     ) external override onlyRole(ROUTER_ROLE) {
-        require(_exists(optionID), "O10");
-        Option storage option = options[optionID];
-        require(option.expiration <= block.timestamp, "O4");
-        require(option.state == State.Active, "O5");
-
-        if (
-            (option.isAbove && closingPrice > option.strike) ||
-            (!option.isAbove && closingPrice < option.strike) ||
-            option.expiration > closingTime
-        ) {
-            _exercise(optionID, closingPrice, closingTime);
-        } else {
-            option.state = State.Expired;
+        (address user, uint256 profit) = _settle(
+            optionID,
+            closingPrice,
+            closingTime
+        );
+        if (user == address(0)) {
             pool.unlock(optionID);
-            _burn(optionID);
-            emit Expire(optionID, option.premium, closingPrice);
+        } else {
+            pool.send(optionID, user, profit);
+        }
+    }
+
+    /**
+     * @notice Unlocks/Exercises a batch of expired options with a single
+     * pool call for the expired ones and a single pool call for the exercised ones
+     * @dev Can only be called router
+     */
+    function unlockBatch(OptionExpiryData[] calldata optionData)
+        external
+        override
+        onlyRole(ROUTER_ROLE)
+    {
+        uint256[] memory unlockIds = new uint256[](optionData.length);
+        uint256[] memory sendIds = new uint256[](optionData.length);
+        address[] memory users = new address[](optionData.length);
+        uint256[] memory profits = new uint256[](optionData.length);
+        uint256 unlockCount;
+        uint256 sendCount;
+
+        for (uint256 i = 0; i < optionData.length; i++) {
+            uint256 optionID = optionData[i].optionId;
+            (address user, uint256 profit) = _settle(
+                optionID,
+                optionData[i].priceAtExpiration,
+                options[optionID].expiration
+            );
+            if (user == address(0)) {
+                unlockIds[unlockCount] = optionID;
+                unlockCount++;
+            } else {
+                sendIds[sendCount] = optionID;
+                users[sendCount] = user;
+                profits[sendCount] = profit;
+                sendCount++;
+            }
+        }
+
+        // Trim the arrays to the number of options in each of them
+        assembly {
+            mstore(unlockIds, unlockCount)
+            mstore(sendIds, sendCount)
+            mstore(users, sendCount)
+            mstore(profits, sendCount)
+        }
+        if (unlockCount > 0) {
+            pool.unlockBatch(unlockIds);
+        }
+        if (sendCount > 0) {
+            pool.sendBatch(sendIds, users, profits);
         }
-        totalLockedAmount -= option.lockedAmount;
     }
 
     /************************************************
@@ -193,7 +291,7 @@ contract BufferBinaryOptions is
      * @notice Returns decimals of the pool token
      */
     function decimals() public view returns (uint256) {
-        return tokenX.decimals();
+        return tokenXDecimals;
     }
 
     /**
@@ -215,11 +313,15 @@ contract BufferBinaryOptions is
             uint256 premium
         )
     {
+        (address referrer, , uint8 referrerStep, ) = referral.resolve(
+            keccak256(bytes(referralCode))
+        );
         (uint256 settlementFeePercentage, ) = _getSettlementFeePercentage(
-            referral.codeOwner(referralCode),
+            referrer,
+            referrerStep,
             user,
             _getbaseSettlementFeePercentage(isAbove),
-            traderNFTId
+            _getNFTStep(config.traderNFTContract(), user, traderNFTId)
         );
         (total, settlementFee, premium) = _fees(
             amount,
@@ -227,6 +329,143 @@ contract BufferBinaryOptions is
         );
     }
 
+    /**
+     * @notice Returns the number of options created for the user
+     */
+    function userOptionCount(address user) external view returns (uint256) {
+        return userOptionIds[user].length;
+    }
+
+    /**
+     * @notice Returns the number of unsettled options held by the user, which
+     * userActiveOptionIds lists in no particular order
+     */
+    function userActiveOptionCount(address user)
+        external
+        view
+        returns (uint256)
+    {
+        return userActiveOptionIds[user].length;
+    }
+
+    /**
+     * @notice Returns the expiration of an option
+     */
+    function expirationOf(uint256 optionID)
+        external
+        view
+        override
+        returns (uint256)
+    {
+        return options[optionID].expiration;
+    }
+
+    /**
+     * @notice Returns the fields needed to settle an option
+     */
+    function settlementInfo(uint256 optionID)
+        external
+        view
+        override
+        returns (
+            State state,
+            uint256 strike,
+            uint256 expiration,
+            bool isAbove
+        )
+    {
+        Option storage option = options[optionID];
+        return (option.state, option.strike, option.expiration, option.isAbove);
+    }
+
+    /**
+     * @notice Returns at most `limit` active options expiring between
+     * startTime and endTime (both inclusive). The scan starts at `cursor`,
+     * 0 for the first page, and the cursor of the next page is returned,
+     * 0 once the whole range has been scanned. A page can hold fewer than
+     * `limit` options while the cursor isn't 0 as each call reads at most
+     * MAX_EXPIRY_QUERY_SCAN buckets and bucket slots
+     * @dev A cursor packs the expiry bucket in its high 128 bits and the index
+     * of the option in the bucket in its low 128 bits. Settled options keep
+     * their slot in the bucket, so a cursor stays valid across settlements
+     */
+    function getOptionsExpiringBetween(
+        uint256 startTime,
+        uint256 endTime,
+        uint256 cursor,
+        uint256 limit
+    )
+        external
+        view
+        returns (
+            uint256[] memory ids,
+            uint256[] memory strikes,
+            uint256[] memory expirations,
+            uint256 nextCursor
+        )
+    {
+        require(limit > 0 && limit <= MAX_EXPIRY_QUERY_LIMIT, "O37");
+        require(
+            startTime <= endTime &&
+                endTime - startTime <= MAX_EXPIRY_QUERY_RANGE,
+            "O38"
+        );
+        ids = new uint256[](limit);
+        strikes = new uint256[](limit);
+        expirations = new uint256[](limit);
+        uint256 count;
+        uint256 bucket = cursor >> 128;
+        uint256 index = uint128(cursor);
+        if (bucket < startTime / EXPIRY_BUCKET_SIZE) {
+            bucket = startTime / EXPIRY_BUCKET_SIZE;
+            index = 0;
+        }
+
+        uint256 scanned;
+        while (
+            bucket <= endTime / EXPIRY_BUCKET_SIZE &&
+            count < limit &&
+            scanned < MAX_EXPIRY_QUERY_SCAN
+        ) {
+            uint256[] storage bucketOptionIds = expiryBucketOptionIds[bucket];
+            scanned++;
+            for (
+                ;
+                index < bucketOptionIds.length &&
+                    count < limit &&
+                    scanned < MAX_EXPIRY_QUERY_SCAN;
+                index++
+            ) {
+                scanned++;
+                Option storage option = options[bucketOptionIds[index]];
+                if (
+                    option.state == State.Active &&
+                    option.expiration >= startTime &&
+                    option.expiration <= endTime
+                ) {
+                    ids[count] = bucketOptionIds[index];
+                    strikes[count] = option.strike;
+                    expirations[count] = option.expiration;
+                    count++;
+                }
+            }
+            if (index >= bucketOptionIds.length) {
+                bucket++;
+                index = 0;
+            }
+        }
+        if (bucket <= endTime / EXPIRY_BUCKET_SIZE) {
+            nextCursor = (bucket << 128) | index;
+        }
+
+        // Trim the arrays to the number of options found
+        assembly {
+            mstore(ids, count)
+            mstore(strikes, count)
+            mstore(expirations, count)
+        }
+    }
+
     /**
      * @notice Checks if the strike price at which the trade is opened lies within the slippage bounds
      */
@@ -248,35 +487,8 @@ contract BufferBinaryOptions is
      * Used only for forex options
      */
     function isInCreationWindow(uint256 period) public view returns (bool) {
-        uint256 currentTime = block.timestamp;
-        uint256 currentDay = ((currentTime / 86400) + 4) % 7;
-        uint256 expirationDay = (((currentTime + period) / 86400) + 4) % 7;
-
-        if (currentDay == expirationDay) {
-            uint256 currentHour = (currentTime / 3600) % 24;
-            uint256 currentMinute = (currentTime % 3600) / 60;
-            uint256 expirationHour = ((currentTime + period) / 3600) % 24;
-            uint256 expirationMinute = ((currentTime + period) % 3600) / 60;
-            (
-                uint256 startHour,
-                uint256 startMinute,
-                uint256 endHour,
-                uint256 endMinute
-            ) = config.marketTimes(uint8(currentDay));
-
-            if (
-                (currentHour > startHour ||
-                    (currentHour == startHour &&
-                        currentMinute >= startMinute)) &&
-                (currentHour < endHour ||
-                    (currentHour == endHour && currentMinute < endMinute)) &&
-                (expirationHour < endHour ||
-                    (expirationHour == endHour && expirationMinute < endMinute))
-            ) {
-                return true;
-            }
-        }
-        return false;
+        return
+            config.isInMarketHours(block.timestamp, block.timestamp + period);
     }
 
     /**
@@ -287,14 +499,15 @@ contract BufferBinaryOptions is
         uint256 period,
         uint256 totalFee,
         address account
-    ) external view override {
+    ) external override {
+        IOptionsConfig.Snapshot memory snapshot = _loadConfigSnapshot();
         require(!isPaused, "O33");
         require(slippage <= 5e2, "O34"); // 5% is the max slippage a user can use
-        require(period >= config.minPeriod(), "O21");
-        require(period <= config.maxPeriod(), "O25");
-        require(totalFee >= config.minFee(), "O35");
+        require(period >= snapshot.minPeriod, "O21");
+        require(period <= snapshot.maxPeriod, "O25");
+        require(totalFee >= snapshot.minFee, "O35");
         require(
-            IWhitelist(config.whitelistStorage()).isWhitelist(account),
+            IWhitelist(snapshot.whitelistStorage).isWhitelist(account),
             "O36"
         );
     }
@@ -308,27 +521,7 @@ contract BufferBinaryOptions is
         override
         returns (uint256 maxAmount)
     {
-        // Calculate the max option size due to asset wise pool utilization limit
-        uint256 totalPoolBalance = pool.totalTokenXBalance();
-        uint256 availableBalance = totalPoolBalance - totalLockedAmount;
-        uint256 utilizationLimit = config.assetUtilizationLimit();
-        uint256 maxAssetWiseUtilizationAmount = _getMaxUtilization(
-            totalPoolBalance,
-            availableBalance,
-            utilizationLimit
-        );
-
-        // Calculate the max option size due to overall pool utilization limit
-        utilizationLimit = config.overallPoolUtilizationLimit();
-        availableBalance = pool.availableBalance();
-        uint256 maxUtilizationAmount = _getMaxUtilization(
-            totalPoolBalance,
-            availableBalance,
-            utilizationLimit
-        );
-
-        // Take the min of the above 2 values
-        maxAmount = min(maxUtilizationAmount, maxAssetWiseUtilizationAmount);
+        maxAmount = _getMaxUtilization(_readConfigSnapshot());
     }
 
     /**
@@ -337,12 +530,11 @@ contract BufferBinaryOptions is
      */
     function checkParams(OptionParams calldata optionParams)
         external
-        view
         override
         returns (
             uint256 amount,
             uint256 revisedFee,
-            bool isReferralValid
+            DiscountMemo memory discountMemo
         )
     {
         require(!isPaused, "O33");
@@ -352,26 +544,48 @@ contract BufferBinaryOptions is
             "O30"
         );
 
-        uint256 maxAmount = getMaxUtilization();
+        IOptionsConfig.Snapshot memory snapshot = _loadConfigSnapshot();
+        uint256 maxAmount = _getMaxUtilization(snapshot);
 
         // Calculate the max fee due to the max txn limit
-        uint256 maxPerTxnFee = ((pool.availableBalance() *
-            config.optionFeePerTxnLimitPercent()) / 100e2);
-        uint256 newFee = min(optionParams.totalFee, maxPerTxnFee);
+        uint256 newFee = min(
+            optionParams.totalFee,
+            (pool.availableBalance() * snapshot.optionFeePerTxnLimitPercent) /
+                100e2
+        );
 
-        // Calculate the amount here from the new fees
+        // Calculate the amount here from the new fees and memoize the discount
+        // so that createFromRouter doesn't resolve the referral again
         uint256 settlementFeePercentage;
-        (
-            settlementFeePercentage,
-            isReferralValid
-        ) = _getSettlementFeePercentage(
-            referral.codeOwner(optionParams.referralCode),
-            optionParams.user,
-            _getbaseSettlementFeePercentage(optionParams.isAbove),
-            optionParams.traderNFTId
-        );
-        (uint256 unitFee, , ) = _fees(10**decimals(), settlementFeePercentage);
-        amount = (newFee * 10**decimals()) / unitFee;
+        {
+            (
+                address referrer,
+                ,
+                uint8 referrerStep,
+                uint32 referrerDiscount
+            ) = referral.resolve(optionParams.referralCode);
+            discountMemo.referrer = referrer;
+            (
+                settlementFeePercentage,
+                discountMemo.isReferralValid
+            ) = _getSettlementFeePercentage(
+                referrer,
+                referrerStep,
+                optionParams.user,
+                _getbaseSettlementFeePercentage(optionParams.isAbove),
+                _cacheNFTStep(
+                    snapshot.traderNFTContract,
+                    optionParams.user,
+                    optionParams.traderNFTId
+                )
+            );
+            if (_isReferrerPayable(referrer, optionParams.user)) {
+                discountMemo.referrerDiscount = referrerDiscount;
+            }
+        }
+        discountMemo.settlementFeePercentage = settlementFeePercentage;
+        (uint256 unitFee, , ) = _fees(tokenXUnit, settlementFeePercentage);
+        amount = (newFee * tokenXUnit) / unitFee;
 
         // Recalculate the amount and the fees if values are greater than the max and partial fill is allowed
         if (amount > maxAmount || newFee < optionParams.totalFee) {
@@ -414,6 +628,32 @@ contract BufferBinaryOptions is
         return super.ownerOf(tokenId);
     }
 
+    /**
+     * @notice Keeps the active options of every holder up to date as the
+     * options are minted, transferred and burnt on settlement
+     */
+    function _beforeTokenTransfer(
+        address from,
+        address to,
+        uint256 tokenId
+    ) internal override {
+        super._beforeTokenTransfer(from, to, tokenId);
+        if (from != address(0)) {
+            uint256[] storage activeIds = userActiveOptionIds[from];
+            uint256 position = activeOptionPosition[tokenId];
+            uint256 lastOptionID = activeIds[activeIds.length - 1];
+
+            activeIds[position] = lastOptionID;
+            activeOptionPosition[lastOptionID] = position;
+            activeIds.pop();
+            delete activeOptionPosition[tokenId];
+        }
+        if (to != address(0)) {
+            activeOptionPosition[tokenId] = userActiveOptionIds[to].length;
+            userActiveOptionIds[to].push(tokenId);
+        }
+    }
+
     /************************************************
      *  INTERNAL OPTION UTILITY FUNCTIONS
      ***********************************************/
@@ -431,6 +671,79 @@ contract BufferBinaryOptions is
             : baseSettlementFeePercentageForBelow;
     }
 
+    /**
+     * @notice Returns the config parameters, only reading them from the config
+     * contract again if its version has changed since they were cached
+     */
+    function _readConfigSnapshot()
+        internal
+        view
+        returns (IOptionsConfig.Snapshot memory snapshot)
+    {
+        snapshot = configSnapshot;
+        if (snapshot.version != config.version()) {
+            snapshot = config.snapshot();
+        }
+    }
+
+    /**
+     * @notice Same as _readConfigSnapshot but also refreshes the cache
+     */
+    function _loadConfigSnapshot()
+        internal
+        returns (IOptionsConfig.Snapshot memory snapshot)
+    {
+        snapshot = configSnapshot;
+        if (snapshot.version != config.version()) {
+            snapshot = config.snapshot();
+            configSnapshot = snapshot;
+        }
+    }
+
+    /**
+     * @notice Returns the volatility term used to price the early closes,
+     * recomputing it only when the config version changes
+     */
+    function _loadPricingTerms() internal returns (int128) {
+        PricingTerms memory terms = pricingTerms;
+        uint32 version = config.version();
+        if (terms.version != version) {
+            terms = PricingTerms(
+                version,
+                OptionMath.volatilityPerSqrtSecond(config.impliedProbability())
+            );
+            pricingTerms = terms;
+        }
+        return terms.volatilityPerSqrtSecond64x64;
+    }
+
+    /**
+     * @notice Calculates max option amount based on the pool's capacity
+     */
+    function _getMaxUtilization(IOptionsConfig.Snapshot memory snapshot)
+        internal
+        view
+        returns (uint256 maxAmount)
+    {
+        // Calculate the max option size due to asset wise pool utilization limit
+        uint256 totalPoolBalance = pool.totalTokenXBalance();
+        uint256 maxAssetWiseUtilizationAmount = _getMaxUtilization(
+            totalPoolBalance,
+            totalPoolBalance - totalLockedAmount,
+            snapshot.assetUtilizationLimit
+        );
+
+        // Calculate the max option size due to overall pool utilization limit
+        uint256 maxUtilizationAmount = _getMaxUtilization(
+            totalPoolBalance,
+            pool.availableBalance(),
+            snapshot.overallPoolUtilizationLimit
+        );
+
+        // Take the min of the above 2 values
+        maxAmount = min(maxUtilizationAmount, maxAssetWiseUtilizationAmount);
+    }
+
     /**
      * @notice Calculates the max utilization
      */
@@ -467,6 +780,43 @@ contract BufferBinaryOptions is
         settlementFee = total - premium;
     }
 
+    /**
+     * @notice Adds an active option to the bucket of its expiration. Buckets are
+     * append only, the settled options are skipped by getOptionsExpiringBetween
+     */
+    function _addToExpiryIndex(uint256 optionID, uint256 expiration) internal {
+        expiryBucketOptionIds[expiration / EXPIRY_BUCKET_SIZE].push(optionID);
+    }
+
+    /**
+     * @notice Marks the option as exercised or expired and burns it.
+     * Returns the user to pay and the profit if the option was exercised,
+     * moving the funds is left to the caller
+     */
+    function _settle(
+        uint256 optionID,
+        uint256 closingPrice,
+        uint256 closingTime
+    ) internal returns (address user, uint256 profit) {
+        require(_exists(optionID), "O10");
+        Option storage option = options[optionID];
+        require(option.expiration <= block.timestamp, "O4");
+        require(option.state == State.Active, "O5");
+
+        if (
+            (option.isAbove && closingPrice > option.strike) ||
+            (!option.isAbove && closingPrice < option.strike) ||
+            option.expiration > closingTime
+        ) {
+            (user, profit) = _exercise(optionID, closingPrice, closingTime);
+        } else {
+            option.state = State.Expired;
+            _burn(optionID);
+            emit Expire(optionID, option.amount / 2, closingPrice);
+        }
+        totalLockedAmount -= option.lockedAmount;
+    }
+
     /**
      * @notice Exercises the ITM options
      */
@@ -474,26 +824,24 @@ contract BufferBinaryOptions is
         uint256 optionID,
         uint256 closingPrice,
         uint256 closingTime
-    ) internal returns (uint256 profit) {
+    ) internal returns (address user, uint256 profit) {
         Option storage option = options[optionID];
-        address user = ownerOf(optionID);
+        user = ownerOf(optionID);
 
         if (option.expiration > closingTime) {
             profit =
                 (option.lockedAmount *
-                    OptionMath.blackScholesPriceBinary(
-                        config.impliedProbability(),
+                    OptionMath.blackScholesPriceBinaryFast(
+                        _loadPricingTerms(),
                         option.strike,
                         closingPrice,
                         option.expiration - closingTime,
-                        true,
                         option.isAbove
                     )) /
                 1e10; // TODO: Check the factor
         } else {
             profit = option.lockedAmount;
         }
-        pool.send(optionID, user, profit);
 
         // Burn the option
         _burn(optionID);
@@ -502,45 +850,45 @@ contract BufferBinaryOptions is
     }
 
     /**
-     * @notice Sends the referral rebate to the referrer and
-     * updates the stats in the referral storage contract
+     * @notice Computes the referral rebate that the router sends to the referrer
      */
     function _processReferralRebate(
-        address user,
-        uint256 totalFee,
-        uint256 amount,
-        string calldata referralCode,
-        bool isAbove,
-        bool isReferralValid
+        OptionParams calldata optionParams,
+        DiscountMemo calldata discountMemo
     ) internal returns (uint256 referrerFee) {
-        address referrer = referral.codeOwner(referralCode);
-        if (
+        referrerFee =
+            (optionParams.totalFee * discountMemo.referrerDiscount) /
+            (1e4 * 1e3);
+        if (referrerFee > 0) {
+            (uint256 formerUnitFee, , ) = _fees(
+                tokenXUnit,
+                _getbaseSettlementFeePercentage(optionParams.isAbove)
+            );
+            emit UpdateReferral(
+                optionParams.user,
+                discountMemo.referrer,
+                discountMemo.isReferralValid,
+                optionParams.totalFee,
+                referrerFee,
+                (((formerUnitFee * optionParams.amount) / tokenXUnit) -
+                    optionParams.totalFee),
+                optionParams.referralCode
+            );
+        }
+    }
+
+    /**
+     * @notice Checks if the referrer can get a discount and a rebate
+     */
+    function _isReferrerPayable(address referrer, address user)
+        internal
+        view
+        returns (bool)
+    {
+        return
             referrer != user &&
             referrer != address(0) &&
-            referrer.code.length == 0
-        ) {
-            referrerFee = ((totalFee *
-                referral.referrerTierDiscount(
-                    referral.referrerTier(referrer)
-                )) / (1e4 * 1e3));
-            if (referrerFee > 0) {
-                tokenX.safeTransfer(referrer, referrerFee);
-
-                (uint256 formerUnitFee, , ) = _fees(
-                    10**decimals(),
-                    _getbaseSettlementFeePercentage(isAbove)
-                );
-                emit UpdateReferral(
-                    user,
-                    referrer,
-                    isReferralValid,
-                    totalFee,
-                    referrerFee,
-                    (((formerUnitFee * amount) / 10**decimals()) - totalFee),
-                    referralCode
-                );
-            }
-        }
+            referrer.code.length == 0;
     }
 
     /**
@@ -552,23 +900,26 @@ contract BufferBinaryOptions is
         address user,
         uint256 traderNFTId
     ) public view returns (bool isReferralValid, uint8 maxStep) {
-        if (config.traderNFTContract() != address(0)) {
-            ITraderNFT nftContract = ITraderNFT(config.traderNFTContract());
-            if (nftContract.tokenOwner(traderNFTId) == user)
-                maxStep = nftTierStep[
-                    nftContract.tokenTierMappings(traderNFTId)
-                ];
-        }
-        if (
-            referrer != user &&
-            referrer != address(0) &&
-            referrer.code.length == 0
-        ) {
-            uint8 step = referral.referrerTierStep(
-                referral.referrerTier(referrer)
+        (, uint8 referrerStep, ) = referral.resolveReferrer(referrer);
+        return
+            _getSettlementFeeDiscount(
+                referrer,
+                referrerStep,
+                user,
+                _getNFTStep(config.traderNFTContract(), user, traderNFTId)
             );
-            if (step > maxStep) {
-                maxStep = step;
+    }
+
+    function _getSettlementFeeDiscount(
+        address referrer,
+        uint8 referrerStep,
+        address user,
+        uint8 nftStep
+    ) internal view returns (bool isReferralValid, uint8 maxStep) {
+        maxStep = nftStep;
+        if (_isReferrerPayable(referrer, user)) {
+            if (referrerStep > maxStep) {
+                maxStep = referrerStep;
                 isReferralValid = true;
             }
         }
@@ -579,9 +930,10 @@ contract BufferBinaryOptions is
      */
     function _getSettlementFeePercentage(
         address referrer,
+        uint8 referrerStep,
         address user,
         uint16 baseSettlementFeePercentage,
-        uint256 traderNFTId
+        uint8 nftStep
     )
         internal
         view
@@ -591,11 +943,96 @@ contract BufferBinaryOptions is
         uint256 maxStep;
         (isReferralValid, maxStep) = _getSettlementFeeDiscount(
             referrer,
+            referrerStep,
             user,
-            traderNFTId
+            nftStep
         );
         settlementFeePercentage =
             settlementFeePercentage -
             (stepSize * maxStep);
     }
+
+    /**
+     * @notice Returns the tier of the NFT if it is owned by the user. The tier
+     * is read from the cache if it was cached in the current tier epoch of the
+     * NFT contract
+     */
+    function _getNFTTier(
+        address traderNFTContract,
+        address user,
+        uint256 traderNFTId
+    )
+        internal
+        view
+        returns (
+            bool isOwner,
+            uint8 tier,
+            uint32 epoch,
+            bool isCached
+        )
+    {
+        if (traderNFTContract == address(0)) {
+            return (false, 0, 0, false);
+        }
+        address owner;
+        (owner, epoch) = ITraderNFT(traderNFTContract).tokenOwnerAndEpoch(
+            traderNFTId
+        );
+        if (owner != user) {
+            return (false, 0, epoch, false);
+        }
+
+        isOwner = true;
+        NFTTierCache memory cache = nftTierCache[traderNFTId];
+        isCached =
+            cache.traderNFTContract == traderNFTContract &&
+            cache.epoch == epoch;
+        tier = isCached
+            ? cache.tier
+            : ITraderNFT(traderNFTContract).tokenTierMappings(traderNFTId);
+    }
+
+    /**
+     * @notice Returns the step reduction of the user's NFT
+     */
+    function _getNFTStep(
+        address traderNFTContract,
+        address user,
+        uint256 traderNFTId
+    ) internal view returns (uint8 step) {
+        (bool isOwner, uint8 tier, , ) = _getNFTTier(
+            traderNFTContract,
+            user,
+            traderNFTId
+        );
+        if (isOwner) {
+            step = nftTierStep[tier];
+        }
+    }
+
+    /**
+     * @notice Same as _getNFTStep but caches the tier of the NFT until the
+     * tiers of the NFT contract are updated
+     */
+    function _cacheNFTStep(
+        address traderNFTContract,
+        address user,
+        uint256 traderNFTId
+    ) internal returns (uint8 step) {
+        (bool isOwner, uint8 tier, uint32 epoch, bool isCached) = _getNFTTier(
+            traderNFTContract,
+            user,
+            traderNFTId
+        );
+        if (isOwner) {
+            if (!isCached) {
+                nftTierCache[traderNFTId] = NFTTierCache(
+                    traderNFTContract,
+                    epoch,
+                    tier
+                );
+            }
+            step = nftTierStep[tier];
+        }
+    }
 }
@@ -6,6 +6,7 @@ import "../interfaces/Interfaces.sol";
 import "@openzeppelin/contracts/access/AccessControl.sol";
 import "@openzeppelin/contracts/token/ERC20/utils/SafeERC20.sol";
 import "@openzeppelin/contracts/utils/math/SafeMath.sol";
+import "@openzeppelin/contracts/utils/math/SafeCast.sol";
 
 /**
  * @author Heisenberg
@@ -22,9 +23,13 @@ contract BufferBinaryPool is
     uint16 public constant ACCURACY = 1e3;
     uint32 public constant INITIAL_RATE = 1;
     uint32 public lockupPeriod;
+    uint32 public depositBucketSize;
     uint256 public lockedAmount;
     uint256 public lockedPremium;
     uint256 public maxLiquidity;
+    uint256 public totalPendingWithdrawal;
+    uint256 public firstPendingWithdrawalRequestId;
+    uint256 public nextWithdrawalRequestId;
     address public owner;
     bytes32 public constant OPTION_ISSUER_ROLE =
         keccak256("OPTION_ISSUER_ROLE");
@@ -32,6 +37,7 @@ contract BufferBinaryPool is
     mapping(address => LockedLiquidity[]) public lockedLiquidity;
     mapping(address => bool) public isHandler;
     mapping(address => ProvidedLiquidity) public liquidityPerUser;
+    mapping(uint256 => WithdrawalRequest) public withdrawalRequests;
 
     constructor(ERC20 _tokenX, uint32 _lockupPeriod) {
         tokenX = _tokenX;
@@ -70,6 +76,22 @@ contract BufferBinaryPool is
         emit UpdateMaxLiquidity(_maxLiquidity);
     }
 
+    /**
+     * @notice Used for merging the deposits of an account made within the same
+     * bucket of time into a single lockup, 0 disables the merging
+     */
+    function setDepositBucketSize(uint32 _depositBucketSize)
+        external
+        onlyRole(DEFAULT_ADMIN_ROLE)
+    {
+        require(
+            _depositBucketSize <= lockupPeriod,
+            "Pool: Bucket size is greater than the lockup period"
+        );
+        depositBucketSize = _depositBucketSize;
+        emit UpdateDepositBucketSize(_depositBucketSize);
+    }
+
     /************************************************
      *  EXTERNAL/PUBLIC FUNCTIONS
      ***********************************************/
@@ -142,6 +164,75 @@ contract BufferBinaryPool is
         burn = _withdraw(tokenXAmount, account);
     }
 
+    /**
+     * @notice Queues a withdrawal that can't be filled with the available
+     * balance. The BLP is moved to the pool until the request is filled by
+     * processWithdrawals or cancelled
+     * @param blpAmount Amount of unlocked BLP to burn
+     */
+    function requestWithdrawal(uint256 blpAmount)
+        external
+        returns (uint256 id)
+    {
+        require(blpAmount > 0, "Pool: Amount is too small");
+        require(
+            toTokenX(blpAmount + totalPendingWithdrawal) > availableBalance(),
+            "Pool: Amount can be withdrawn directly"
+        );
+
+        // The BLP is moved to the pool with a burn and a mint since direct
+        // transfers to the pool are rejected
+        _burn(msg.sender, blpAmount);
+        _mint(address(this), blpAmount);
+
+        id = nextWithdrawalRequestId++;
+        withdrawalRequests[id] = WithdrawalRequest(msg.sender, blpAmount);
+        totalPendingWithdrawal += blpAmount;
+        emit RequestWithdrawal(msg.sender, id, blpAmount);
+    }
+
+    /**
+     * @notice Cancels the unfilled part of a withdrawal request and returns
+     * the BLP held for it
+     */
+    function cancelWithdrawalRequest(uint256 id) external {
+        WithdrawalRequest storage request = withdrawalRequests[id];
+        require(request.account == msg.sender, "Pool: forbidden");
+        uint256 amount = request.amount;
+        require(amount > 0, "Pool: Request isn't pending");
+
+        request.amount = 0;
+        totalPendingWithdrawal -= amount;
+        _transfer(address(this), msg.sender, amount);
+        emit CancelWithdrawal(msg.sender, id, amount);
+    }
+
+    /**
+     * @notice Fills the withdrawal requests in the order they were made with
+     * the available balance, stopping at the first one that can't be filled
+     * completely after filling it partially
+     * @param maxCount Maximum number of requests to go through
+     */
+    function processWithdrawals(uint256 maxCount)
+        external
+        returns (uint256 processed)
+    {
+        uint256 id = firstPendingWithdrawalRequestId;
+        uint256 end = nextWithdrawalRequestId;
+        while (id < end && processed < maxCount) {
+            WithdrawalRequest storage request = withdrawalRequests[id];
+            if (request.amount > 0) {
+                _fillWithdrawalRequest(request);
+                if (request.amount > 0) {
+                    break;
+                }
+            }
+            processed++;
+            id++;
+        }
+        firstPendingWithdrawalRequestId = id;
+    }
+
     /************************************************
      *  OPTION ONLY FUNCTIONS
      ***********************************************/
@@ -172,6 +263,47 @@ contract BufferBinaryPool is
         lockedAmount = lockedAmount + tokenXAmount;
     }
 
+    /**
+     * @notice Called by BufferBinaryOptions to lock the funds of an option whose
+     * premium is collected later along with the other options of the batch
+     * @param id optionId
+     * @param tokenXAmount Amount of funds that should be locked in an option
+     * @param premium Premium that will be paid to liquidity pool by collectPremium
+     */
+    function lockDeferred(
+        uint256 id,
+        uint256 tokenXAmount,
+        uint256 premium
+    ) external override onlyRole(OPTION_ISSUER_ROLE) {
+        require(id == lockedLiquidity[msg.sender].length, "Pool: Wrong id");
+
+        require(
+            (lockedAmount + tokenXAmount) <= totalTokenXBalance(),
+            "Pool: Amount is too large."
+        );
+
+        // The premium is added to lockedPremium only when it is collected
+        // so that totalTokenXBalance doesn't change in between
+        lockedLiquidity[msg.sender].push(
+            LockedLiquidity(tokenXAmount, premium, true)
+        );
+        lockedAmount = lockedAmount + tokenXAmount;
+    }
+
+    /**
+     * @notice Called by BufferBinaryOptions to pull the premiums of the options
+     * locked with lockDeferred in a single transfer
+     * @param premium Sum of the premiums of those options
+     */
+    function collectPremium(uint256 premium)
+        external
+        override
+        onlyRole(OPTION_ISSUER_ROLE)
+    {
+        tokenX.safeTransferFrom(msg.sender, address(this), premium);
+        lockedPremium = lockedPremium + premium;
+    }
+
     /**
      * @notice Called by BufferOptions to unlock the funds
      * @param id Id of LockedLiquidity that should be unlocked
@@ -182,6 +314,31 @@ contract BufferBinaryPool is
         emit Profit(id, premium);
     }
 
+    /**
+     * @notice Called by BufferOptions to unlock the funds of a batch of options.
+     * The locked amount and premium are updated once for the whole batch
+     * @param ids Ids of LockedLiquidity that should be unlocked
+     */
+    function unlockBatch(uint256[] calldata ids)
+        external
+        override
+        onlyRole(OPTION_ISSUER_ROLE)
+    {
+        uint256 totalPremium;
+        uint256 totalAmount;
+        for (uint256 i = 0; i < ids.length; i++) {
+            LockedLiquidity storage ll = lockedLiquidity[msg.sender][ids[i]];
+            require(ll.locked, "Pool: lockedAmount is already unlocked");
+            ll.locked = false;
+
+            totalPremium += ll.premium;
+            totalAmount += ll.amount;
+            emit Profit(ids[i], ll.premium);
+        }
+        lockedPremium = lockedPremium - totalPremium;
+        lockedAmount = lockedAmount - totalAmount;
+    }
+
     /**
      * @notice Called by BufferBinaryOptions to send funds to liquidity providers after an option's expiration
      * @param id Id of LockedLiquidity
@@ -195,7 +352,7 @@ contract BufferBinaryPool is
     ) external override onlyRole(OPTION_ISSUER_ROLE) {
         LockedLiquidity storage ll = lockedLiquidity[msg.sender][id];
         require(ll.locked, "Pool: lockedAmount is already unlocked");
-        require(to != address(0));
+        require(to != address(0), "P1");
 
         uint256 transferTokenXAmount = tokenXAmount > ll.amount
             ? ll.amount
@@ -211,6 +368,46 @@ contract BufferBinaryPool is
         else emit Loss(id, transferTokenXAmount - ll.premium);
     }
 
+    /**
+     * @notice Called by BufferBinaryOptions to send the funds of a batch of options.
+     * The locked amount and premium are updated once for the whole batch and
+     * all the payouts to the same account are merged into a single transfer
+     * @param ids Ids of LockedLiquidity
+     * @param accounts Providers
+     * @param tokenXAmounts Funds that should be sent
+     */
+    function sendBatch(
+        uint256[] calldata ids,
+        address[] calldata accounts,
+        uint256[] calldata tokenXAmounts
+    ) external override onlyRole(OPTION_ISSUER_ROLE) {
+        require(
+            ids.length == accounts.length &&
+                ids.length == tokenXAmounts.length,
+            "Pool: Wrong lengths"
+        );
+        uint256 totalPremium;
+        uint256 totalAmount;
+        Payouts memory payouts = _newPayouts(ids.length);
+
+        for (uint256 i = 0; i < ids.length; i++) {
+            require(accounts[i] != address(0), "P1");
+            (uint256 premium, uint256 transferTokenXAmount) = _release(
+                ids[i],
+                tokenXAmounts[i]
+            );
+            totalPremium += premium;
+            totalAmount += transferTokenXAmount;
+            _addPayout(payouts, accounts[i], transferTokenXAmount);
+        }
+        lockedPremium = lockedPremium - totalPremium;
+        lockedAmount = lockedAmount - totalAmount;
+
+        for (uint256 i = 0; i < payouts.count; i++) {
+            tokenX.safeTransfer(payouts.accounts[i], payouts.amounts[i]);
+        }
+    }
+
     /************************************************
      *  INTERNAL FUNCTIONS
      ***********************************************/
@@ -239,13 +436,58 @@ contract BufferBinaryPool is
 
         _mint(account, mint);
 
-        LockedAmount memory amountLocked = LockedAmount(block.timestamp, mint);
-        liquidityPerUser[account].lockedAmounts.push(amountLocked);
+        _addLockedAmount(account, mint);
         _updateLiquidity(account);
 
         emit Provide(account, tokenXAmount, mint);
     }
 
+    /**
+     * @notice Records a deposit in the lockups of the account. Deposits made in
+     * the same bucket as the last one are merged into it and unlock along with
+     * the latest of them
+     */
+    function _addLockedAmount(address account, uint256 amount) internal {
+        LockedAmount[] storage lockedAmounts = liquidityPerUser[account]
+            .lockedAmounts;
+        uint256 length = lockedAmounts.length;
+        if (length == 0) {
+            lockedAmounts.push(
+                LockedAmount(
+                    SafeCast.toUint32(block.timestamp),
+                    SafeCast.toUint224(amount)
+                )
+            );
+            return;
+        }
+
+        LockedAmount storage lastLockedAmount = lockedAmounts[length - 1];
+        uint256 cumulativeAmount = lastLockedAmount.cumulativeAmount + amount;
+        // The last deposit is still locked as the bucket is clamped to the
+        // lockup period, so it can't have been counted as unlocked
+        uint256 bucketSize = depositBucketSize < lockupPeriod
+            ? depositBucketSize
+            : lockupPeriod;
+        if (
+            bucketSize > 0 &&
+            lastLockedAmount.timestamp / bucketSize ==
+            block.timestamp / bucketSize &&
+            length > liquidityPerUser[account].nextIndexForUnlock
+        ) {
+            lastLockedAmount.timestamp = SafeCast.toUint32(block.timestamp);
+            lastLockedAmount.cumulativeAmount = SafeCast.toUint224(
+                cumulativeAmount
+            );
+        } else {
+            lockedAmounts.push(
+                LockedAmount(
+                    SafeCast.toUint32(block.timestamp),
+                    SafeCast.toUint224(cumulativeAmount)
+                )
+            );
+        }
+    }
+
     function _updateLiquidity(address account) internal {
         (
             uint256 unlockedAmount,
@@ -256,30 +498,42 @@ contract BufferBinaryPool is
         liquidityPerUser[account].nextIndexForUnlock = nextIndexForUnlock;
     }
 
+    /**
+     * @notice Returns the unlocked amount of the account including the deposits
+     * whose lockup period is over. The deposits being sorted by timestamp, the
+     * first one still locked is found with a binary search and the unlocked
+     * deposits are summed from the cumulative amounts
+     */
     function _getUnlockedLiquidity(address account)
         internal
         view
         returns (uint256 unlockedAmount, uint256 nextIndexForUnlock)
     {
-        uint256 len = liquidityPerUser[account].lockedAmounts.length;
-        unlockedAmount = liquidityPerUser[account].unlockedAmount;
-        uint256 index = liquidityPerUser[account].nextIndexForUnlock;
-        nextIndexForUnlock = index;
-        uint256 maxIndex = index + 1000 < len ? index + 1000 : len;
-        for (uint256 n = index; n < maxIndex; n++) {
+        ProvidedLiquidity storage liquidity = liquidityPerUser[account];
+        LockedAmount[] storage lockedAmounts = liquidity.lockedAmounts;
+        unlockedAmount = liquidity.unlockedAmount;
+        uint256 index = liquidity.nextIndexForUnlock;
+
+        uint256 low = index;
+        uint256 high = lockedAmounts.length;
+        while (low < high) {
+            uint256 mid = (low + high) / 2;
             if (
-                liquidityPerUser[account].lockedAmounts[n].timestamp +
-                    lockupPeriod <=
+                uint256(lockedAmounts[mid].timestamp) + lockupPeriod <=
                 block.timestamp
             ) {
-                unlockedAmount += liquidityPerUser[account]
-                    .lockedAmounts[n]
-                    .amount;
-                nextIndexForUnlock = n + 1;
+                low = mid + 1;
             } else {
-                break;
+                high = mid;
             }
         }
+        nextIndexForUnlock = low;
+
+        if (nextIndexForUnlock > index) {
+            unlockedAmount +=
+                lockedAmounts[nextIndexForUnlock - 1].cumulativeAmount -
+                (index > 0 ? lockedAmounts[index - 1].cumulativeAmount : 0);
+        }
     }
 
     function _validateHandler() private view {
@@ -290,8 +544,10 @@ contract BufferBinaryPool is
         internal
         returns (uint256 burn)
     {
+        // The liquidity needed by the queued withdrawals can't be withdrawn
         require(
-            tokenXAmount <= availableBalance(),
+            tokenXAmount + toTokenX(totalPendingWithdrawal) <=
+                availableBalance(),
             "Pool: Not enough funds on the pool contract. Please lower the amount."
         );
         uint256 totalSupply = totalSupply();
@@ -322,6 +578,76 @@ contract BufferBinaryPool is
         emit Withdraw(account, tokenXAmountToWithdraw, burn);
     }
 
+    function _fillWithdrawalRequest(WithdrawalRequest storage request)
+        internal
+    {
+        uint256 supply = totalSupply();
+        uint256 balance = totalTokenXBalance();
+        if (balance == 0) {
+            return;
+        }
+        uint256 maxBurn = (availableBalance() * supply) / balance;
+        uint256 burn = request.amount < maxBurn ? request.amount : maxBurn;
+        if (burn == 0) {
+            return;
+        }
+        uint256 tokenXAmount = (burn * balance) / supply;
+
+        request.amount -= burn;
+        totalPendingWithdrawal -= burn;
+        _burn(address(this), burn);
+        tokenX.safeTransfer(request.account, tokenXAmount);
+
+        emit Withdraw(request.account, tokenXAmount, burn);
+    }
+
+    function _newPayouts(uint256 length)
+        internal
+        pure
+        returns (Payouts memory payouts)
+    {
+        // The hash table is kept at most half full so that the probe
+        // sequences stay short
+        payouts.accounts = new address[](length);
+        payouts.amounts = new uint256[](length);
+        uint256 size = 1;
+        while (size < 2 * length) {
+            size <<= 1;
+        }
+        payouts.slots = new uint256[](size);
+    }
+
+    /**
+     * @notice Adds the amount to the payout of the account. The payouts are
+     * found through an open addressing hash table kept in memory
+     */
+    function _addPayout(
+        Payouts memory payouts,
+        address account,
+        uint256 amount
+    ) internal pure {
+        if (amount == 0) {
+            return;
+        }
+        uint256 mask = payouts.slots.length - 1;
+        uint256 slot = uint256(keccak256(abi.encodePacked(account))) & mask;
+        while (true) {
+            uint256 entry = payouts.slots[slot];
+            if (entry == 0) {
+                payouts.accounts[payouts.count] = account;
+                payouts.amounts[payouts.count] = amount;
+                payouts.count++;
+                payouts.slots[slot] = payouts.count;
+                return;
+            }
+            if (payouts.accounts[entry - 1] == account) {
+                payouts.amounts[entry - 1] += amount;
+                return;
+            }
+            slot = (slot + 1) & mask;
+        }
+    }
+
     function _unlock(uint256 id) internal returns (uint256 premium) {
         LockedLiquidity storage ll = lockedLiquidity[msg.sender][id];
         require(ll.locked, "Pool: lockedAmount is already unlocked");
@@ -332,12 +658,38 @@ contract BufferBinaryPool is
         premium = ll.premium;
     }
 
+    function _release(uint256 id, uint256 tokenXAmount)
+        internal
+        returns (uint256 premium, uint256 transferTokenXAmount)
+    {
+        LockedLiquidity storage ll = lockedLiquidity[msg.sender][id];
+        require(ll.locked, "Pool: lockedAmount is already unlocked");
+        ll.locked = false;
+
+        premium = ll.premium;
+        transferTokenXAmount = tokenXAmount > ll.amount
+            ? ll.amount
+            : tokenXAmount;
+
+        if (transferTokenXAmount <= premium)
+            emit Profit(id, premium - transferTokenXAmount);
+        else emit Loss(id, transferTokenXAmount - premium);
+    }
+
     function _beforeTokenTransfer(
         address from,
         address to,
         uint256 value
     ) internal override {
-        if (!isHandler[from] && !isHandler[to] && from != address(0)) {
+        if (from == address(this)) {
+            // BLP held for the withdrawal requests is already unlocked
+            if (to != address(0) && !isHandler[to]) {
+                liquidityPerUser[to].unlockedAmount += value;
+            }
+        } else if (to == address(this)) {
+            // BLP sent to the pool outside of a request would be stuck
+            require(from == address(0), "Pool: Use requestWithdrawal");
+        } else if (!isHandler[from] && !isHandler[to] && from != address(0)) {
             _updateLiquidity(from);
             require(
                 liquidityPerUser[from].unlockedAmount >= value,
@@ -384,6 +736,26 @@ contract BufferBinaryPool is
         (unlockedAmount, ) = _getUnlockedLiquidity(account);
     }
 
+    /**
+     * @notice Returns the number of pending requests ahead of a pending
+     * withdrawal request
+     */
+    function withdrawalQueuePosition(uint256 id)
+        external
+        view
+        returns (uint256 position)
+    {
+        require(
+            withdrawalRequests[id].amount > 0,
+            "Pool: Request isn't pending"
+        );
+        for (uint256 i = firstPendingWithdrawalRequestId; i < id; i++) {
+            if (withdrawalRequests[i].amount > 0) {
+                position++;
+            }
+        }
+    }
+
     /**
      * @notice Returns provider's share in X
      */
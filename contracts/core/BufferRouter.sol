@@ -5,6 +5,8 @@ pragma solidity 0.8.4;
 import "@openzeppelin/contracts/security/ReentrancyGuard.sol";
 import "@openzeppelin/contracts/access/AccessControl.sol";
 import "@openzeppelin/contracts/utils/cryptography/ECDSA.sol";
+import "@openzeppelin/contracts/utils/cryptography/MerkleProof.sol";
+import "@openzeppelin/contracts/utils/math/SafeCast.sol";
 import "@openzeppelin/contracts/token/ERC20/utils/SafeERC20.sol";
 import "../interfaces/Interfaces.sol";
 
@@ -15,6 +17,9 @@ import "../interfaces/Interfaces.sol";
 contract BufferRouter is AccessControl, IBufferRouter {
     using SafeERC20 for ERC20;
     uint16 MAX_WAIT_TIME = 1 minutes;
+    uint256 public constant OPEN_TRADE_PACKED_SIZE = 92;
+    uint256 public constant CLOSE_TRADE_PACKED_SIZE = 112;
+    uint256 public constant MIN_OPEN_TRADE_GAS = 500000;
     uint256 public nextQueueId = 0;
     uint256 public nextCloseId = 0;
     address public publisher;
@@ -22,10 +27,14 @@ contract BufferRouter is AccessControl, IBufferRouter {
 
     mapping(address => uint256[]) public userQueuedIds;
     mapping(address => uint256[]) public userCancelledQueuedIds;
+    mapping(address => uint256[]) internal userPendingQueuedIds;
+    mapping(uint256 => uint256) internal pendingQueuedIdPosition;
     mapping(uint256 => QueuedTrade) public queuedTrades;
     mapping(uint256 => TradeToClose) public tradesToClose;
     mapping(address => bool) public contractRegistry;
+    mapping(address => MarketInfo) public marketInfo;
     mapping(address => bool) public isKeeper;
+    mapping(ERC20 => mapping(address => uint256)) public claimableBalance;
 
     constructor(address _publisher) {
         publisher = _publisher;
@@ -41,6 +50,20 @@ contract BufferRouter is AccessControl, IBufferRouter {
         onlyRole(DEFAULT_ADMIN_ROLE)
     {
         contractRegistry[targetContract] = register;
+
+        // Cache the immutable market metadata so that the keeper functions
+        // don't have to fetch it from the options contract for every trade
+        if (register) {
+            IBufferBinaryOptions optionsContract = IBufferBinaryOptions(
+                targetContract
+            );
+            marketInfo[targetContract] = MarketInfo(
+                optionsContract.assetPair(),
+                optionsContract.tokenX()
+            );
+        } else {
+            delete marketInfo[targetContract];
+        }
     }
 
     function setKeeper(address _keeper, bool _isActive)
@@ -77,11 +100,7 @@ contract BufferRouter is AccessControl, IBufferRouter {
             contractRegistry[targetContract],
             "Router: Unauthorized contract"
         );
-        IBufferBinaryOptions optionsContract = IBufferBinaryOptions(
-            targetContract
-        );
-
-        optionsContract.runInitialChecks(
+        IBufferBinaryOptions(targetContract).runInitialChecks(
             slippage,
             period,
             totalFee,
@@ -90,7 +109,7 @@ contract BufferRouter is AccessControl, IBufferRouter {
 
         // Transfer the fee specified from the user to this contract.
         // User has to approve first inorder to execute this function
-        ERC20(optionsContract.tokenX()).safeTransferFrom(
+        _getTokenX(targetContract).safeTransferFrom(
             msg.sender,
             address(this),
             totalFee
@@ -99,26 +118,34 @@ contract BufferRouter is AccessControl, IBufferRouter {
         queueId = nextQueueId;
         nextQueueId++;
 
-        QueuedTrade memory queuedTrade = QueuedTrade(
-            queueId,
-            userQueueCount(msg.sender),
-            msg.sender,
-            totalFee,
-            period,
-            isAbove,
-            targetContract,
-            expectedStrike,
-            slippage,
-            allowPartialFill,
-            block.timestamp,
-            true,
-            referralCode,
-            traderNFTId
+        // Fields are written one by one as the packed layout fills only 3 slots
+        // (4 with a referral code) and building the struct in memory runs out of stack
+        QueuedTrade storage queuedTrade = queuedTrades[queueId];
+        queuedTrade.queueId = SafeCast.toUint40(queueId);
+        queuedTrade.userQueueIndex = SafeCast.toUint40(
+            userQueueCount(msg.sender)
         );
+        queuedTrade.user = msg.sender;
+        queuedTrade.isAbove = isAbove;
+        queuedTrade.allowPartialFill = allowPartialFill;
+        queuedTrade.targetContract = targetContract;
+        queuedTrade.period = SafeCast.toUint32(period);
+        queuedTrade.slippage = SafeCast.toUint16(slippage);
+        queuedTrade.queuedTime = SafeCast.toUint32(block.timestamp);
+        queuedTrade.isQueued = true;
+        queuedTrade.totalFee = SafeCast.toUint128(totalFee);
+        queuedTrade.expectedStrike = SafeCast.toUint96(expectedStrike);
+        queuedTrade.traderNFTId = SafeCast.toUint32(traderNFTId);
 
-        queuedTrades[queueId] = queuedTrade;
+        // Only the hash of the referral code is stored, the referral storage resolves it
+        if (bytes(referralCode).length != 0) {
+            queuedTrade.referralCode = keccak256(bytes(referralCode));
+        }
 
         userQueuedIds[msg.sender].push(queueId);
+        pendingQueuedIdPosition[queueId] = userPendingQueuedIds[msg.sender]
+            .length;
+        userPendingQueuedIds[msg.sender].push(queueId);
 
         emit InitiateTrade(msg.sender, queueId, block.timestamp);
     }
@@ -163,9 +190,25 @@ contract BufferRouter is AccessControl, IBufferRouter {
         require(msg.sender == queuedTrade.user, "Router: Forbidden");
         require(queuedTrade.isQueued, "Router: Trade has already been opened");
         _cancelQueuedTrade(queueId);
+        _getTokenX(queuedTrade.targetContract).safeTransfer(
+            queuedTrade.user,
+            queuedTrade.totalFee
+        );
         emit CancelTrade(queuedTrade.user, queueId, "User Cancelled");
     }
 
+    /**
+     * @notice Sends the sender's amount of the token that couldn't be transferred
+     * while settling a batch to the recipient
+     */
+    function claim(ERC20 token, address recipient) external {
+        uint256 amount = claimableBalance[token][msg.sender];
+        require(amount > 0, "Router: Nothing to claim");
+        claimableBalance[token][msg.sender] = 0;
+        token.safeTransfer(recipient, amount);
+        emit Claim(msg.sender, token, amount);
+    }
+
     /************************************************
      *  KEEPER ONLY FUNCTIONS
      ***********************************************/
@@ -175,148 +218,322 @@ contract BufferRouter is AccessControl, IBufferRouter {
      */
     function resolveQueuedTrades(OpenTradeParams[] calldata params) external {
         _validateKeeper();
+        OpenBatch memory batch = _newOpenBatch(params.length);
         for (uint32 index = 0; index < params.length; index++) {
             OpenTradeParams memory currentParams = params[index];
-            QueuedTrade memory queuedTrade = queuedTrades[
-                currentParams.queueId
-            ];
-            IBufferBinaryOptions optionsContract = IBufferBinaryOptions(
-                queuedTrade.targetContract
-            );
             bool isSignerVerifed = _validateSigner(
                 currentParams.timestamp,
-                optionsContract.assetPair(),
+                _getAssetPair(
+                    queuedTrades[currentParams.queueId].targetContract
+                ),
                 currentParams.price,
                 currentParams.signature
             );
-            // Silently fail if the signature doesn't match
-            if (!isSignerVerifed) {
-                emit FailResolve(
-                    currentParams.queueId,
-                    "Router: Signature didn't match"
-                );
-                continue;
-            }
-            if (
-                !queuedTrade.isQueued ||
-                currentParams.timestamp != queuedTrade.queuedTime
-            ) {
-                // Trade has already been opened or cancelled or the timestamp is wrong.
-                // So ignore this trade.
-                continue;
-            }
+            _resolveQueuedTrade(
+                batch,
+                currentParams.queueId,
+                currentParams.timestamp,
+                currentParams.price,
+                isSignerVerifed
+            );
+        }
+        _settleOpenBatch(batch);
+    }
 
-            // If the opening time is much greater than the queue time then cancel the trade
-            if (block.timestamp - queuedTrade.queuedTime <= MAX_WAIT_TIME) {
-                _openQueuedTrade(currentParams.queueId, currentParams.price);
-            } else {
-                _cancelQueuedTrade(currentParams.queueId);
-                emit CancelTrade(
-                    queuedTrade.user,
-                    currentParams.queueId,
-                    "Wait time too high"
-                );
-            }
+    /**
+     * @notice Resolves the queued trades using prices attested by a single
+     * publisher signature over the merkle root of all the (assetPair, timestamp, price) leaves
+     */
+    function resolveQueuedTradesWithProof(
+        bytes32 priceRoot,
+        bytes calldata rootSignature,
+        OpenTradeParamsWithProof[] calldata params
+    ) external {
+        _validateKeeper();
+        _validateRootSigner(priceRoot, rootSignature);
+        OpenBatch memory batch = _newOpenBatch(params.length);
+        for (uint32 index = 0; index < params.length; index++) {
+            OpenTradeParamsWithProof calldata currentParams = params[index];
+            bool isSignerVerifed = _validateProof(
+                priceRoot,
+                currentParams.timestamp,
+                _getAssetPair(
+                    queuedTrades[currentParams.queueId].targetContract
+                ),
+                currentParams.price,
+                currentParams.proof
+            );
+            _resolveQueuedTrade(
+                batch,
+                currentParams.queueId,
+                currentParams.timestamp,
+                currentParams.price,
+                isSignerVerifed
+            );
         }
+        _settleOpenBatch(batch);
+    }
+
+    /**
+     * @notice Same as resolveQueuedTrades but reads the params from a tightly packed layout.
+     * Each trade takes OPEN_TRADE_PACKED_SIZE bytes: queueId (uint64), timestamp (uint32),
+     * price (uint128) followed by the EIP-2098 compact signature (r, vs)
+     */
+    function resolveQueuedTradesPacked(bytes calldata data) external {
+        _validateKeeper();
+        require(
+            data.length % OPEN_TRADE_PACKED_SIZE == 0,
+            "Router: Wrong data length"
+        );
+        OpenBatch memory batch = _newOpenBatch(
+            data.length / OPEN_TRADE_PACKED_SIZE
+        );
+        for (
+            uint256 offset = 0;
+            offset < data.length;
+            offset += OPEN_TRADE_PACKED_SIZE
+        ) {
+            uint256 queueId = _readPacked(data, offset, 8);
+            uint256 timestamp = _readPacked(data, offset + 8, 4);
+            uint256 price = _readPacked(data, offset + 12, 16);
+            bool isSignerVerifed = _validateCompactSigner(
+                timestamp,
+                _getAssetPair(queuedTrades[queueId].targetContract),
+                price,
+                bytes32(_readPacked(data, offset + 28, 32)),
+                bytes32(_readPacked(data, offset + 60, 32))
+            );
+            _resolveQueuedTrade(
+                batch,
+                queueId,
+                timestamp,
+                price,
+                isSignerVerifed
+            );
+        }
+        _settleOpenBatch(batch);
     }
 
     /**
      * @notice Verifies the option parameter via the signature and unlocks an array of options
+     * @return settled Bitmap with the bit i set if the option at index i was unlocked
      */
-    function unlockOptions(CloseTradeParams[] calldata optionData) external {
+    function unlockOptions(CloseTradeParams[] calldata optionData)
+        external
+        returns (uint256[] memory settled)
+    {
         _validateKeeper();
 
         uint32 arrayLength = uint32(optionData.length);
+        UnlockBatch memory batch = _newUnlockBatch(arrayLength);
         for (uint32 i = 0; i < arrayLength; i++) {
             CloseTradeParams memory params = optionData[i];
-            IBufferBinaryOptions optionsContract = IBufferBinaryOptions(
-                params.targetContract
-            );
-            (, , , , , uint256 expiration, , , ) = optionsContract.options(
-                params.optionId
-            );
-
             bool isSignerVerifed = _validateSigner(
                 params.expiryTimestamp,
-                optionsContract.assetPair(),
+                _getAssetPair(params.targetContract),
                 params.priceAtExpiry,
                 params.signature
             );
+            _addToUnlockBatch(
+                batch,
+                params.optionId,
+                params.targetContract,
+                params.expiryTimestamp,
+                params.priceAtExpiry,
+                isSignerVerifed
+            );
+        }
+        settled = _unlockBatch(batch);
+    }
 
-            // Silently fail if the timestamp of the signature is wrong
-            if (expiration != params.expiryTimestamp) {
-                emit FailUnlock(params.optionId, "Router: Wrong price");
-                continue;
-            }
+    /**
+     * @notice Unlocks an array of options using prices attested by a single
+     * publisher signature over the merkle root of all the price leaves
+     * @return settled Bitmap with the bit i set if the option at index i was unlocked
+     */
+    function unlockOptionsWithProof(
+        bytes32 priceRoot,
+        bytes calldata rootSignature,
+        CloseTradeParamsWithProof[] calldata optionData
+    ) external returns (uint256[] memory settled) {
+        _validateKeeper();
+        _validateRootSigner(priceRoot, rootSignature);
 
-            // Silently fail if the signature doesn't match
-            if (!isSignerVerifed) {
-                emit FailUnlock(
-                    params.optionId,
-                    "Router: Signature didn't match"
-                );
-                continue;
-            }
+        uint32 arrayLength = uint32(optionData.length);
+        UnlockBatch memory batch = _newUnlockBatch(arrayLength);
+        for (uint32 i = 0; i < arrayLength; i++) {
+            CloseTradeParamsWithProof calldata params = optionData[i];
+            bool isSignerVerifed = _validateProof(
+                priceRoot,
+                params.expiryTimestamp,
+                _getAssetPair(params.targetContract),
+                params.priceAtExpiry,
+                params.proof
+            );
+            _addToUnlockBatch(
+                batch,
+                params.optionId,
+                params.targetContract,
+                params.expiryTimestamp,
+                params.priceAtExpiry,
+                isSignerVerifed
+            );
+        }
+        settled = _unlockBatch(batch);
+    }
 
-            try
-                optionsContract.unlock(
-                    params.optionId,
-                    params.priceAtExpiry,
-                    expiration
-                )
-            {} catch Error(string memory reason) {
-                emit FailUnlock(params.optionId, reason);
-                continue;
-            }
+    /**
+     * @notice Same as unlockOptions but reads the params from a tightly packed layout.
+     * Each option takes CLOSE_TRADE_PACKED_SIZE bytes: optionId (uint64), targetContract (address),
+     * expiryTimestamp (uint32), priceAtExpiry (uint128) followed by the EIP-2098 compact signature (r, vs)
+     * @return settled Bitmap with the bit i set if the option at index i was unlocked
+     */
+    function unlockOptionsPacked(bytes calldata data)
+        external
+        returns (uint256[] memory settled)
+    {
+        _validateKeeper();
+        require(
+            data.length % CLOSE_TRADE_PACKED_SIZE == 0,
+            "Router: Wrong data length"
+        );
+        UnlockBatch memory batch = _newUnlockBatch(
+            data.length / CLOSE_TRADE_PACKED_SIZE
+        );
+        for (
+            uint256 offset = 0;
+            offset < data.length;
+            offset += CLOSE_TRADE_PACKED_SIZE
+        ) {
+            address targetContract = address(
+                uint160(_readPacked(data, offset + 8, 20))
+            );
+            uint256 expiryTimestamp = _readPacked(data, offset + 28, 4);
+            uint256 priceAtExpiry = _readPacked(data, offset + 32, 16);
+            bool isSignerVerifed = _validateCompactSigner(
+                expiryTimestamp,
+                _getAssetPair(targetContract),
+                priceAtExpiry,
+                bytes32(_readPacked(data, offset + 48, 32)),
+                bytes32(_readPacked(data, offset + 80, 32))
+            );
+            _addToUnlockBatch(
+                batch,
+                _readPacked(data, offset, 8),
+                targetContract,
+                expiryTimestamp,
+                priceAtExpiry,
+                isSignerVerifed
+            );
         }
+        settled = _unlockBatch(batch);
     }
 
     /**
      * @notice Verifies the option parameter via the signature and unlocks an array of options
+     * @return settled Bitmap with the bit i set if the option at index i was closed
      */
     function closeAnytime(QueuedCloseTradeParams[] calldata optionData)
         external
+        returns (uint256[] memory settled)
     {
         _validateKeeper();
         uint32 arrayLength = uint32(optionData.length);
+        settled = _newStatusBitmap(arrayLength);
         for (uint32 i = 0; i < arrayLength; i++) {
             QueuedCloseTradeParams memory params = optionData[i];
             TradeToClose storage tradeToClose = tradesToClose[params.closeId];
 
-            IBufferBinaryOptions optionsContract = IBufferBinaryOptions(
-                tradeToClose.targetContract
-            );
-
             bool isSignerVerifed = _validateSigner(
                 tradeToClose.closingTime,
-                optionsContract.assetPair(),
+                _getAssetPair(tradeToClose.targetContract),
                 params.closingPrice,
                 params.signature
             );
-
-            // Silently fail if the signature doesn't match
-            if (!isSignerVerifed) {
-                emit FailUnlock(
-                    tradeToClose.optionId,
-                    "Router: Signature didn't match"
-                );
-                continue;
+            if (
+                _closeOption(
+                    tradeToClose,
+                    params.closingPrice,
+                    isSignerVerifed
+                )
+            ) {
+                _setStatus(settled, i);
             }
+        }
+    }
 
-            try
-                optionsContract.unlock(
-                    tradeToClose.optionId,
+    /**
+     * @notice Closes an array of options using prices attested by a single
+     * publisher signature over the merkle root of all the price leaves
+     * @return settled Bitmap with the bit i set if the option at index i was closed
+     */
+    function closeAnytimeWithProof(
+        bytes32 priceRoot,
+        bytes calldata rootSignature,
+        QueuedCloseTradeParamsWithProof[] calldata optionData
+    ) external returns (uint256[] memory settled) {
+        _validateKeeper();
+        _validateRootSigner(priceRoot, rootSignature);
+        uint32 arrayLength = uint32(optionData.length);
+        settled = _newStatusBitmap(arrayLength);
+        for (uint32 i = 0; i < arrayLength; i++) {
+            QueuedCloseTradeParamsWithProof calldata params = optionData[i];
+            TradeToClose storage tradeToClose = tradesToClose[params.closeId];
+
+            bool isSignerVerifed = _validateProof(
+                priceRoot,
+                tradeToClose.closingTime,
+                _getAssetPair(tradeToClose.targetContract),
+                params.closingPrice,
+                params.proof
+            );
+            if (
+                _closeOption(
+                    tradeToClose,
                     params.closingPrice,
-                    tradeToClose.closingTime
+                    isSignerVerifed
                 )
-            {} catch Error(string memory reason) {
-                emit FailUnlock(tradeToClose.optionId, reason);
-                continue;
+            ) {
+                _setStatus(settled, i);
             }
-            tradeToClose.hasClosed = true;
         }
     }
 
+    /**
+     * @notice Opens a queued trade in its own call frame so that an unexpected
+     * revert only affects that trade and not the rest of the batch
+     * @dev Can only be called by the router itself. The tokens aren't moved here,
+     * the returned amounts are settled by the caller along with the rest of the batch
+     * @return revisedFee Fee to pay for the option, the rest of the total fee is refunded
+     * @return referrer Referrer to pay out of the revised fee
+     * @return referrerFee Amount to pay to the referrer
+     */
+    function openQueuedTrade(uint256 queueId, uint256 price)
+        external
+        returns (
+            uint256 revisedFee,
+            address referrer,
+            uint256 referrerFee
+        )
+    {
+        require(msg.sender == address(this), "Router: Forbidden");
+        return _openQueuedTrade(queueId, price);
+    }
+
+    /**
+     * @notice Transfers an amount of the batch ledger in its own call frame so
+     * that a recipient that can't receive it doesn't revert the batch
+     * @dev Can only be called by the router itself
+     */
+    function transferFromRouter(
+        ERC20 token,
+        address recipient,
+        uint256 amount
+    ) external {
+        require(msg.sender == address(this), "Router: Forbidden");
+        token.safeTransfer(recipient, amount);
+    }
+
     /************************************************
      *  READ ONLY FUNCTIONS
      ***********************************************/
@@ -333,6 +550,89 @@ contract BufferRouter is AccessControl, IBufferRouter {
         return userCancelledQueuedIds[user].length;
     }
 
+    function userPendingQueueCount(address user)
+        external
+        view
+        returns (uint256)
+    {
+        return userPendingQueuedIds[user].length;
+    }
+
+    /**
+     * @notice Returns a page of the trades queued by the user, newest first.
+     * With activeOnly set only the trades still waiting to be opened are paged,
+     * from the end of the user's pending index. That index isn't sorted since
+     * removing a trade from it moves the user's last pending trade in its place
+     */
+    function getUserQueuedTrades(
+        address user,
+        uint256 offset,
+        uint256 limit,
+        bool activeOnly
+    )
+        external
+        view
+        returns (uint256[] memory queueIds, QueuedTrade[] memory trades)
+    {
+        uint256[] storage userIds = activeOnly
+            ? userPendingQueuedIds[user]
+            : userQueuedIds[user];
+        uint256 total = userIds.length;
+        uint256 count = offset < total ? total - offset : 0;
+        if (count > limit) {
+            count = limit;
+        }
+
+        queueIds = new uint256[](count);
+        trades = new QueuedTrade[](count);
+        for (uint256 i = 0; i < count; i++) {
+            queueIds[i] = userIds[total - 1 - offset - i];
+            trades[i] = queuedTrades[queueIds[i]];
+        }
+    }
+
+    /**
+     * @notice Returns the still queued trades with queue ids in [startId, endId)
+     * along with the lowest still queued id in that range. If nothing is queued
+     * in the range then lowestPendingId is the end of the scanned range
+     */
+    function getPendingTrades(uint256 startId, uint256 endId)
+        external
+        view
+        returns (PendingTrade[] memory trades, uint256 lowestPendingId)
+    {
+        if (endId > nextQueueId) {
+            endId = nextQueueId;
+        }
+        lowestPendingId = endId;
+        if (startId >= endId) {
+            return (new PendingTrade[](0), lowestPendingId);
+        }
+
+        trades = new PendingTrade[](endId - startId);
+        uint256 count;
+        for (uint256 queueId = startId; queueId < endId; queueId++) {
+            QueuedTrade storage queuedTrade = queuedTrades[queueId];
+            if (!queuedTrade.isQueued) {
+                continue;
+            }
+            if (count == 0) {
+                lowestPendingId = queueId;
+            }
+            trades[count] = PendingTrade(
+                queueId,
+                queuedTrade.targetContract,
+                queuedTrade.queuedTime
+            );
+            count++;
+        }
+
+        // Trim the array to the number of queued trades found
+        assembly {
+            mstore(trades, count)
+        }
+    }
+
     /************************************************
      *  INTERNAL FUNCTIONS
      ***********************************************/
@@ -343,6 +643,30 @@ contract BufferRouter is AccessControl, IBufferRouter {
         );
     }
 
+    function _getAssetPair(address targetContract)
+        internal
+        view
+        returns (string memory assetPair)
+    {
+        assetPair = marketInfo[targetContract].assetPair;
+        // Fallback for the markets that aren't registered anymore
+        if (bytes(assetPair).length == 0) {
+            assetPair = IBufferBinaryOptions(targetContract).assetPair();
+        }
+    }
+
+    function _getTokenX(address targetContract)
+        internal
+        view
+        returns (ERC20 tokenX)
+    {
+        tokenX = marketInfo[targetContract].tokenX;
+        // Fallback for the markets that aren't registered anymore
+        if (address(tokenX) == address(0)) {
+            tokenX = IBufferBinaryOptions(targetContract).tokenX();
+        }
+    }
+
     function _validateSigner(
         uint256 timestamp,
         string memory assetPair,
@@ -364,7 +688,387 @@ contract BufferRouter is AccessControl, IBufferRouter {
         }
     }
 
-    function _openQueuedTrade(uint256 queueId, uint256 price) internal {
+    function _validateCompactSigner(
+        uint256 timestamp,
+        string memory assetPair,
+        uint256 price,
+        bytes32 r,
+        bytes32 vs
+    ) internal view returns (bool) {
+        bytes32 digest = ECDSA.toEthSignedMessageHash(
+            keccak256(abi.encodePacked(assetPair, timestamp, price))
+        );
+        (address recoveredSigner, ECDSA.RecoverError error) = ECDSA.tryRecover(
+            digest,
+            r,
+            vs
+        );
+
+        return
+            error == ECDSA.RecoverError.NoError &&
+            recoveredSigner == publisher;
+    }
+
+    /**
+     * @notice Reads a big endian unsigned integer of `size` bytes from `data` at `offset`
+     */
+    function _readPacked(
+        bytes calldata data,
+        uint256 offset,
+        uint256 size
+    ) internal pure returns (uint256 value) {
+        assembly {
+            value := shr(
+                sub(256, mul(size, 8)),
+                calldataload(add(data.offset, offset))
+            )
+        }
+    }
+
+    function _validateRootSigner(bytes32 priceRoot, bytes calldata signature)
+        internal
+        view
+    {
+        (address recoveredSigner, ECDSA.RecoverError error) = ECDSA.tryRecover(
+            ECDSA.toEthSignedMessageHash(priceRoot),
+            signature
+        );
+        require(
+            error == ECDSA.RecoverError.NoError &&
+                recoveredSigner == publisher,
+            "Router: Signature didn't match"
+        );
+    }
+
+    function _validateProof(
+        bytes32 priceRoot,
+        uint256 timestamp,
+        string memory assetPair,
+        uint256 price,
+        bytes32[] calldata proof
+    ) internal pure returns (bool) {
+        return
+            MerkleProof.verifyCalldata(
+                proof,
+                priceRoot,
+                keccak256(abi.encodePacked(assetPair, timestamp, price))
+            );
+    }
+
+    function _resolveQueuedTrade(
+        OpenBatch memory batch,
+        uint256 queueId,
+        uint256 timestamp,
+        uint256 price,
+        bool isSignerVerifed
+    ) internal {
+        // Silently fail if the signature doesn't match
+        if (!isSignerVerifed) {
+            emit FailResolve(queueId, "Router: Signature didn't match");
+            return;
+        }
+
+        QueuedTrade storage queuedTrade = queuedTrades[queueId];
+        if (!queuedTrade.isQueued || timestamp != queuedTrade.queuedTime) {
+            // Trade has already been opened or cancelled or the timestamp is wrong.
+            // So ignore this trade.
+            return;
+        }
+
+        // If the opening time is much greater than the queue time then cancel the trade
+        if (block.timestamp - queuedTrade.queuedTime <= MAX_WAIT_TIME) {
+            require(gasleft() >= MIN_OPEN_TRADE_GAS, "Router: Not enough gas");
+
+            // Cancel and refund the trade if opening it fails for any reason.
+            // The self call gets a fixed amount of gas so that a trade can't be
+            // cancelled by running the batch out of gas on purpose
+            try
+                this.openQueuedTrade{gas: MIN_OPEN_TRADE_GAS}(queueId, price)
+            returns (
+                uint256 revisedFee,
+                address referrer,
+                uint256 referrerFee
+            ) {
+                _creditOpenedTrade(
+                    batch,
+                    queuedTrade,
+                    revisedFee,
+                    referrer,
+                    referrerFee
+                );
+            } catch Error(string memory reason) {
+                _requireOpenTradeGas();
+                _cancelQueuedTradeInBatch(batch, queueId, reason);
+            } catch Panic(uint256) {
+                _requireOpenTradeGas();
+                _cancelQueuedTradeInBatch(batch, queueId, "R1");
+            } catch (bytes memory) {
+                _requireOpenTradeGas();
+                _cancelQueuedTradeInBatch(batch, queueId, "R2");
+            }
+        } else {
+            _cancelQueuedTradeInBatch(batch, queueId, "Wait time too high");
+        }
+    }
+
+    /**
+     * @notice Reverts the batch if the failed self call to openQueuedTrade may have
+     * been given less than MIN_OPEN_TRADE_GAS. The call only gets 63/64 of the gas
+     * left when that's less, leaving under 1/64 of MIN_OPEN_TRADE_GAS behind
+     */
+    function _requireOpenTradeGas() internal view {
+        require(
+            gasleft() >= MIN_OPEN_TRADE_GAS / 64,
+            "Router: Not enough gas"
+        );
+    }
+
+    function _newUnlockBatch(uint256 length)
+        internal
+        pure
+        returns (UnlockBatch memory batch)
+    {
+        batch.options = new IBufferBinaryOptions.OptionExpiryData[](length);
+        batch.targetContracts = new address[](length);
+        batch.indices = new uint256[](length);
+        batch.settled = _newStatusBitmap(length);
+    }
+
+    /**
+     * @notice Adds the option to the batch if it can be unlocked. The checks of
+     * the options contract are run here so that a single invalid option doesn't
+     * make the batch unlock fail
+     */
+    function _addToUnlockBatch(
+        UnlockBatch memory batch,
+        uint256 optionId,
+        address targetContract,
+        uint256 expiryTimestamp,
+        uint256 priceAtExpiry,
+        bool isSignerVerifed
+    ) internal {
+        uint256 index = batch.nextIndex;
+        batch.nextIndex++;
+        (
+            IBufferBinaryOptions.State state,
+            ,
+            uint256 expiration,
+
+        ) = IBufferBinaryOptions(targetContract).settlementInfo(optionId);
+
+        // Silently fail if the timestamp of the signature is wrong
+        if (expiration != expiryTimestamp) {
+            emit FailUnlock(optionId, "Router: Wrong price");
+            return;
+        }
+
+        // Silently fail if the signature doesn't match
+        if (!isSignerVerifed) {
+            emit FailUnlock(optionId, "Router: Signature didn't match");
+            return;
+        }
+
+        if (state != IBufferBinaryOptions.State.Active) {
+            emit FailUnlock(optionId, "O10");
+            return;
+        }
+        if (expiration > block.timestamp) {
+            emit FailUnlock(optionId, "O4");
+            return;
+        }
+
+        batch.options[batch.count] = IBufferBinaryOptions.OptionExpiryData(
+            optionId,
+            priceAtExpiry
+        );
+        batch.targetContracts[batch.count] = targetContract;
+        batch.indices[batch.count] = index;
+        batch.count++;
+    }
+
+    /**
+     * @notice Unlocks the consecutive options of the same options contract with a
+     * single unlockBatch call. If that call reverts the options are unlocked
+     * one by one so that only the failing ones are skipped
+     */
+    function _unlockBatch(UnlockBatch memory batch)
+        internal
+        returns (uint256[] memory)
+    {
+        uint256 start;
+        while (start < batch.count) {
+            address targetContract = batch.targetContracts[start];
+            uint256 end = start + 1;
+            while (
+                end < batch.count &&
+                batch.targetContracts[end] == targetContract
+            ) {
+                end++;
+            }
+
+            bool isBatchUnlocked;
+            if (end - start > 1) {
+                IBufferBinaryOptions.OptionExpiryData[]
+                    memory group = new IBufferBinaryOptions.OptionExpiryData[](
+                        end - start
+                    );
+                for (uint256 i = start; i < end; i++) {
+                    group[i - start] = batch.options[i];
+                }
+                try
+                    IBufferBinaryOptions(targetContract).unlockBatch(group)
+                {
+                    isBatchUnlocked = true;
+                } catch {}
+            }
+
+            for (uint256 i = start; i < end; i++) {
+                if (
+                    isBatchUnlocked ||
+                    _unlockOption(targetContract, batch.options[i])
+                ) {
+                    _setStatus(batch.settled, batch.indices[i]);
+                }
+            }
+            start = end;
+        }
+        return batch.settled;
+    }
+
+    function _unlockOption(
+        address targetContract,
+        IBufferBinaryOptions.OptionExpiryData memory optionData
+    ) internal returns (bool) {
+        IBufferBinaryOptions.OptionExpiryData[]
+            memory single = new IBufferBinaryOptions.OptionExpiryData[](1);
+        single[0] = optionData;
+
+        // Any revert only fails this option and not the rest of the batch
+        try IBufferBinaryOptions(targetContract).unlockBatch(single) {
+            return true;
+        } catch Error(string memory reason) {
+            emit FailUnlock(optionData.optionId, reason);
+        } catch Panic(uint256) {
+            emit FailUnlock(optionData.optionId, "R1");
+        } catch (bytes memory) {
+            emit FailUnlock(optionData.optionId, "R2");
+        }
+        return false;
+    }
+
+    function _closeOption(
+        TradeToClose storage tradeToClose,
+        uint256 closingPrice,
+        bool isSignerVerifed
+    ) internal returns (bool) {
+        // Silently fail if the signature doesn't match
+        if (!isSignerVerifed) {
+            emit FailUnlock(
+                tradeToClose.optionId,
+                "Router: Signature didn't match"
+            );
+            return false;
+        }
+
+        try
+            IBufferBinaryOptions(tradeToClose.targetContract).unlock(
+                tradeToClose.optionId,
+                closingPrice,
+                tradeToClose.closingTime
+            )
+        {
+            tradeToClose.hasClosed = true;
+            return true;
+        } catch Error(string memory reason) {
+            emit FailUnlock(tradeToClose.optionId, reason);
+        } catch Panic(uint256) {
+            emit FailUnlock(tradeToClose.optionId, "R1");
+        } catch (bytes memory) {
+            emit FailUnlock(tradeToClose.optionId, "R2");
+        }
+        return false;
+    }
+
+    function _newStatusBitmap(uint256 length)
+        internal
+        pure
+        returns (uint256[] memory)
+    {
+        return new uint256[]((length + 255) / 256);
+    }
+
+    function _setStatus(uint256[] memory status, uint256 index) internal pure {
+        status[index / 256] |= 1 << (index % 256);
+    }
+
+    function _newOpenBatch(uint256 length)
+        internal
+        pure
+        returns (OpenBatch memory batch)
+    {
+        batch.optionsContracts = new address[](length);
+
+        // Every trade credits at most 3 recipients. The hash table is kept
+        // at most half full so that the probe sequences stay short
+        batch.tokens = new ERC20[](3 * length);
+        batch.recipients = new address[](3 * length);
+        batch.amounts = new uint256[](3 * length);
+        uint256 ledgerSize = 1;
+        while (ledgerSize < 6 * length) {
+            ledgerSize <<= 1;
+        }
+        batch.ledgerSlots = new uint256[](ledgerSize);
+    }
+
+    function _addToOpenBatch(OpenBatch memory batch, address optionsContract)
+        internal
+        pure
+    {
+        for (uint256 i = 0; i < batch.count; i++) {
+            if (batch.optionsContracts[i] == optionsContract) {
+                return;
+            }
+        }
+        batch.optionsContracts[batch.count] = optionsContract;
+        batch.count++;
+    }
+
+    /**
+     * @notice Settles every (token, recipient) pair of the batch ledger with a single
+     * transfer. Then moves the premiums and settlement fees accumulated by the
+     * options contracts while opening the trades, once per options contract
+     * @dev The options contracts have already accounted for the fees and locked
+     * liquidity against the premiums, so the batch reverts if they can't be paid.
+     * Only the refunds and referrer fees are kept claimable when they fail
+     */
+    function _settleOpenBatch(OpenBatch memory batch) internal {
+        for (uint256 i = 0; i < batch.ledgerCount; i++) {
+            ERC20 token = batch.tokens[i];
+            address recipient = batch.recipients[i];
+            uint256 amount = batch.amounts[i];
+
+            if (contractRegistry[recipient]) {
+                token.safeTransfer(recipient, amount);
+            } else {
+                try this.transferFromRouter(token, recipient, amount) {} catch {
+                    claimableBalance[token][recipient] += amount;
+                    emit FailTransfer(recipient, token, amount);
+                }
+            }
+        }
+        for (uint256 i = 0; i < batch.count; i++) {
+            IBufferBinaryOptions(batch.optionsContracts[i]).settleBatch();
+        }
+    }
+
+    function _openQueuedTrade(uint256 queueId, uint256 price)
+        internal
+        returns (
+            uint256 revisedFee,
+            address referrer,
+            uint256 referrerFee
+        )
+    {
         QueuedTrade storage queuedTrade = queuedTrades[queueId];
         IBufferBinaryOptions optionsContract = IBufferBinaryOptions(
             queuedTrade.targetContract
@@ -385,13 +1089,12 @@ contract BufferRouter is AccessControl, IBufferRouter {
                 "Slippage limit exceeds"
             );
 
-            return;
+            return (0, address(0), 0);
         }
 
         // Check all the parameters and compute the amount and revised fee
         uint256 amount;
-        uint256 revisedFee;
-        bool isReferralValid;
+        IBufferBinaryOptions.DiscountMemo memory discountMemo;
         IBufferBinaryOptions.OptionParams
             memory optionParams = IBufferBinaryOptions.OptionParams(
                 queuedTrade.expectedStrike,
@@ -407,57 +1110,148 @@ contract BufferRouter is AccessControl, IBufferRouter {
         try optionsContract.checkParams(optionParams) returns (
             uint256 _amount,
             uint256 _revisedFee,
-            bool _isReferralValid
+            IBufferBinaryOptions.DiscountMemo memory _discountMemo
         ) {
-            (amount, revisedFee, isReferralValid) = (
+            (amount, revisedFee, discountMemo) = (
                 _amount,
                 _revisedFee,
-                _isReferralValid
+                _discountMemo
             );
         } catch Error(string memory reason) {
             _cancelQueuedTrade(queueId);
             emit CancelTrade(queuedTrade.user, queueId, reason);
-            return;
+            return (0, address(0), 0);
         }
 
         queuedTrade.isQueued = false;
-
-        // Transfer the fee to the target options contract
-        ERC20 tokenX = ERC20(optionsContract.tokenX());
-        tokenX.safeTransfer(queuedTrade.targetContract, revisedFee);
-
-        // Refund the user in case the trade amount was lesser
-        if (revisedFee < queuedTrade.totalFee) {
-            tokenX.safeTransfer(
-                queuedTrade.user,
-                queuedTrade.totalFee - revisedFee
-            );
-        }
+        _removePendingQueuedId(queuedTrade.user, queueId);
 
         optionParams.totalFee = revisedFee;
         optionParams.strike = price;
         optionParams.amount = amount;
 
-        uint256 optionId = optionsContract.createFromRouter(
+        uint256 optionId;
+        (optionId, referrer, referrerFee) = optionsContract.createFromRouter(
             optionParams,
-            isReferralValid,
+            discountMemo,
             queuedTrade.queuedTime
         );
 
         emit OpenTrade(queuedTrade.user, queueId, optionId);
     }
 
+    /**
+     * @notice Marks the trade as cancelled, the caller refunds the total fee
+     */
     function _cancelQueuedTrade(uint256 queueId) internal {
         QueuedTrade storage queuedTrade = queuedTrades[queueId];
-        IBufferBinaryOptions optionsContract = IBufferBinaryOptions(
-            queuedTrade.targetContract
-        );
         queuedTrade.isQueued = false;
-        ERC20(optionsContract.tokenX()).safeTransfer(
+        _removePendingQueuedId(queuedTrade.user, queueId);
+
+        userCancelledQueuedIds[queuedTrade.user].push(queueId);
+    }
+
+    /**
+     * @notice Removes a trade that isn't queued anymore from the pending trades
+     * of the user by moving the user's last pending trade in its place
+     */
+    function _removePendingQueuedId(address user, uint256 queueId) internal {
+        uint256[] storage pendingIds = userPendingQueuedIds[user];
+        uint256 position = pendingQueuedIdPosition[queueId];
+        uint256 lastQueueId = pendingIds[pendingIds.length - 1];
+
+        pendingIds[position] = lastQueueId;
+        pendingQueuedIdPosition[lastQueueId] = position;
+        pendingIds.pop();
+        delete pendingQueuedIdPosition[queueId];
+    }
+
+    function _cancelQueuedTradeInBatch(
+        OpenBatch memory batch,
+        uint256 queueId,
+        string memory reason
+    ) internal {
+        QueuedTrade storage queuedTrade = queuedTrades[queueId];
+        if (!queuedTrade.isQueued) {
+            // Already cancelled and refunded
+            return;
+        }
+        _cancelQueuedTrade(queueId);
+        _credit(
+            batch,
+            _getTokenX(queuedTrade.targetContract),
             queuedTrade.user,
             queuedTrade.totalFee
         );
+        emit CancelTrade(queuedTrade.user, queueId, reason);
+    }
 
-        userCancelledQueuedIds[queuedTrade.user].push(queueId);
+    /**
+     * @notice Records the token flows of an opened trade. The options contract is paid
+     * the revised fee minus the referrer fee and the user is refunded the rest of the
+     * total fee, which is all of it if the trade got cancelled while opening
+     */
+    function _creditOpenedTrade(
+        OpenBatch memory batch,
+        QueuedTrade storage queuedTrade,
+        uint256 revisedFee,
+        address referrer,
+        uint256 referrerFee
+    ) internal {
+        ERC20 tokenX = _getTokenX(queuedTrade.targetContract);
+        _credit(
+            batch,
+            tokenX,
+            queuedTrade.targetContract,
+            revisedFee - referrerFee
+        );
+        _credit(batch, tokenX, referrer, referrerFee);
+        _credit(
+            batch,
+            tokenX,
+            queuedTrade.user,
+            queuedTrade.totalFee - revisedFee
+        );
+        if (revisedFee > 0) {
+            _addToOpenBatch(batch, queuedTrade.targetContract);
+        }
+    }
+
+    /**
+     * @notice Adds the amount to the (token, recipient) entry of the batch ledger.
+     * The entries are found through an open addressing hash table kept in memory
+     */
+    function _credit(
+        OpenBatch memory batch,
+        ERC20 token,
+        address recipient,
+        uint256 amount
+    ) internal pure {
+        if (amount == 0) {
+            return;
+        }
+        uint256 mask = batch.ledgerSlots.length - 1;
+        uint256 slot = uint256(
+            keccak256(abi.encodePacked(address(token), recipient))
+        ) & mask;
+        while (true) {
+            uint256 entry = batch.ledgerSlots[slot];
+            if (entry == 0) {
+                batch.tokens[batch.ledgerCount] = token;
+                batch.recipients[batch.ledgerCount] = recipient;
+                batch.amounts[batch.ledgerCount] = amount;
+                batch.ledgerCount++;
+                batch.ledgerSlots[slot] = batch.ledgerCount;
+                return;
+            }
+            if (
+                batch.tokens[entry - 1] == token &&
+                batch.recipients[entry - 1] == recipient
+            ) {
+                batch.amounts[entry - 1] += amount;
+                return;
+            }
+            slot = (slot + 1) & mask;
+        }
     }
 }
@@ -23,31 +23,61 @@ contract OptionsConfig is Ownable, IOptionsConfig {
     uint256 public override impliedProbability;
 
     uint16 public override optionFeePerTxnLimitPercent = 5e2;
+    uint32 public override version = 1;
     uint256 public override minFee = 1e6;
 
     mapping(uint8 => Window) public override marketTimes;
+    // Bit i of word j is set if the market is open during the minute
+    // j * 256 + i of the week, the week starting on Sunday 00:00 UTC
+    uint256[40] public marketMinutes;
+
+    uint256 internal constant MINUTES_PER_DAY = 1 days / 1 minutes;
+    uint256 internal constant MINUTES_PER_WEEK = 7 days / 1 minutes;
 
     constructor(BufferBinaryPool _pool) {
         pool = _pool;
     }
 
+    /**
+     * @notice Returns all the parameters read by the options contracts while
+     * creating an option along with the version they belong to
+     */
+    function snapshot() external view override returns (Snapshot memory) {
+        return
+            Snapshot(
+                whitelistStorage,
+                assetUtilizationLimit,
+                overallPoolUtilizationLimit,
+                optionFeePerTxnLimitPercent,
+                version,
+                traderNFTContract,
+                minPeriod,
+                maxPeriod,
+                minFee
+            );
+    }
+
     function settraderNFTContract(address value) external onlyOwner {
         traderNFTContract = value;
+        version++;
         emit UpdatetraderNFTContract(value);
     }
 
     function setMinFee(uint256 value) external onlyOwner {
         minFee = value;
+        version++;
         emit UpdateMinFee(value);
     }
 
     function setImpliedProbability(uint256 value) external onlyOwner {
         impliedProbability = value;
+        version++;
         emit UpdateImpliedProbability(value);
     }
 
     function setWhitelistStorage(address value) external onlyOwner {
         whitelistStorage = value;
+        version++;
         emit UpdateWhitelistStorage(value);
     }
 
@@ -61,18 +91,21 @@ contract OptionsConfig is Ownable, IOptionsConfig {
 
     function setOptionFeePerTxnLimitPercent(uint16 value) external onlyOwner {
         optionFeePerTxnLimitPercent = value;
+        version++;
         emit UpdateOptionFeePerTxnLimitPercent(value);
     }
 
     function setOverallPoolUtilizationLimit(uint16 value) external onlyOwner {
         require(value <= 100e2 && value > 0, "Wrong utilization value");
         overallPoolUtilizationLimit = value;
+        version++;
         emit UpdateOverallPoolUtilizationLimit(value);
     }
 
     function setAssetUtilizationLimit(uint16 value) external onlyOwner {
         require(value <= 100e2 && value > 0, "Wrong utilization value");
         assetUtilizationLimit = value;
+        version++;
         emit UpdateAssetUtilizationLimit(value);
     }
 
@@ -86,6 +119,7 @@ contract OptionsConfig is Ownable, IOptionsConfig {
             "MaxPeriod needs to be greater than or equal the min period"
         );
         maxPeriod = value;
+        version++;
         emit UpdateMaxPeriod(value);
     }
 
@@ -95,13 +129,141 @@ contract OptionsConfig is Ownable, IOptionsConfig {
             "MinPeriod needs to be greater than 1 minute"
         );
         minPeriod = value;
+        version++;
         emit UpdateMinPeriod(value);
     }
 
+    /**
+     * @notice Sets a single window per day, the index of the window being the
+     * day of the week starting from Sunday
+     */
     function setMarketTime(Window[] memory windows) external onlyOwner {
         for (uint8 index = 0; index < windows.length; index++) {
             marketTimes[index] = windows[index];
         }
+
+        uint256[40] memory bitmap;
+        for (uint8 day = 0; day < 7; day++) {
+            Window memory window = marketTimes[day];
+            uint256 start = _minuteOfDay(window.startHour, window.startMinute);
+            uint256 end = _minuteOfDay(window.endHour, window.endMinute);
+            if (end > start) {
+                _addMarketMinutes(
+                    bitmap,
+                    day * MINUTES_PER_DAY + start,
+                    end - start
+                );
+            }
+        }
+        marketMinutes = bitmap;
+        emit UpdateMarketTime();
+    }
+
+    /**
+     * @notice Replaces the schedule with any number of sessions per day.
+     * A session whose end is not after its start closes on the next day
+     * @dev marketTimes only describes schedules set through setMarketTime so
+     * it is cleared here
+     */
+    function setMarketSessions(Session[] memory sessions) external onlyOwner {
+        uint256[40] memory bitmap;
+        for (uint256 index = 0; index < sessions.length; index++) {
+            Session memory session = sessions[index];
+            require(session.day < 7, "Wrong market time");
+            uint256 start = _minuteOfDay(
+                session.window.startHour,
+                session.window.startMinute
+            );
+            uint256 end = _minuteOfDay(
+                session.window.endHour,
+                session.window.endMinute
+            );
+            _addMarketMinutes(
+                bitmap,
+                session.day * MINUTES_PER_DAY + start,
+                end > start ? end - start : end + MINUTES_PER_DAY - start
+            );
+        }
+        for (uint8 day = 0; day < 7; day++) {
+            delete marketTimes[day];
+        }
+        marketMinutes = bitmap;
         emit UpdateMarketTime();
     }
+
+    /**
+     * @notice Checks if the market stays open from the minute of startTime
+     * up to and including the minute of endTime
+     */
+    function isInMarketHours(uint256 startTime, uint256 endTime)
+        external
+        view
+        override
+        returns (bool)
+    {
+        if (endTime < startTime) {
+            return false;
+        }
+        uint256 minute = ((startTime / 1 minutes) + 4 * MINUTES_PER_DAY) %
+            MINUTES_PER_WEEK;
+        uint256 count = (endTime / 1 minutes) - (startTime / 1 minutes) + 1;
+        if (count > MINUTES_PER_WEEK) {
+            count = MINUTES_PER_WEEK;
+        }
+
+        while (count > 0) {
+            (uint256 mask, uint256 length) = _marketMinutesMask(minute, count);
+            if (marketMinutes[minute / 256] & mask != mask) {
+                return false;
+            }
+            count -= length;
+            minute = (minute + length) % MINUTES_PER_WEEK;
+        }
+        return true;
+    }
+
+    function _minuteOfDay(uint8 hour, uint8 minute)
+        internal
+        pure
+        returns (uint256 minuteOfDay)
+    {
+        minuteOfDay = uint256(hour) * 60 + minute;
+        require(minuteOfDay <= MINUTES_PER_DAY, "Wrong market time");
+    }
+
+    /**
+     * @notice Marks count minutes of the week as open starting from minute,
+     * wrapping around the end of the week
+     */
+    function _addMarketMinutes(
+        uint256[40] memory bitmap,
+        uint256 minute,
+        uint256 count
+    ) internal pure {
+        minute = minute % MINUTES_PER_WEEK;
+        while (count > 0) {
+            (uint256 mask, uint256 length) = _marketMinutesMask(minute, count);
+            bitmap[minute / 256] |= mask;
+            count -= length;
+            minute = (minute + length) % MINUTES_PER_WEEK;
+        }
+    }
+
+    /**
+     * @notice Returns the mask of the bits covering up to count minutes
+     * starting from minute that fall in the word of minute
+     */
+    function _marketMinutesMask(uint256 minute, uint256 count)
+        internal
+        pure
+        returns (uint256 mask, uint256 length)
+    {
+        uint256 wordStart = (minute / 256) * 256;
+        uint256 wordLength = MINUTES_PER_WEEK - wordStart < 256
+            ? MINUTES_PER_WEEK - wordStart
+            : 256;
+        uint256 bit = minute - wordStart;
+        length = wordLength - bit < count ? wordLength - bit : count;
+        mask = length == 256 ? ~uint256(0) : ((1 << length) - 1) << bit;
+    }
 }
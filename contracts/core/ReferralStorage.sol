@@ -13,9 +13,9 @@ import "../interfaces/Interfaces.sol";
 contract ReferralStorage is IReferralStorage, Ownable {
     mapping(address => uint8) public override referrerTier; // link between user <> tier
     mapping(uint8 => Tier) public tiers;
-    mapping(uint8 => uint8) public override referrerTierStep;
-    mapping(uint8 => uint32) public override referrerTierDiscount;
+    mapping(uint8 => TierConfig) public tierConfigs; // Step and discount of a tier packed in one slot
     mapping(string => address) public override codeOwner;
+    mapping(bytes32 => address) public override codeHashOwner; // keccak256 of the code <> owner
     mapping(address => string) public userCode;
     mapping(address => string) public override traderReferralCodes;
     mapping(address => ReferralData) public UserReferralData;
@@ -28,11 +28,10 @@ contract ReferralStorage is IReferralStorage, Ownable {
         uint32[3] calldata _referrerTierDiscount // Factor of 1e5
     ) external onlyOwner {
         for (uint8 i = 0; i < 3; i++) {
-            referrerTierStep[i] = _referrerTierStep[i];
-        }
-
-        for (uint8 i = 0; i < 3; i++) {
-            referrerTierDiscount[i] = _referrerTierDiscount[i];
+            tierConfigs[i] = TierConfig(
+                _referrerTierStep[i],
+                _referrerTierDiscount[i]
+            );
         }
     }
 
@@ -86,6 +85,7 @@ contract ReferralStorage is IReferralStorage, Ownable {
         );
 
         codeOwner[_code] = msg.sender;
+        codeHashOwner[keccak256(bytes(_code))] = msg.sender;
         userCode[msg.sender] = _code;
         emit RegisterCode(msg.sender, _code);
     }
@@ -105,6 +105,72 @@ contract ReferralStorage is IReferralStorage, Ownable {
         }
     }
 
+    /**
+     * @notice Returns the step reduction for a tier
+     */
+    function referrerTierStep(uint8 tier)
+        external
+        view
+        override
+        returns (uint8)
+    {
+        return tierConfigs[tier].step;
+    }
+
+    /**
+     * @notice Returns the discount for a tier
+     */
+    function referrerTierDiscount(uint8 tier)
+        external
+        view
+        override
+        returns (uint32)
+    {
+        return tierConfigs[tier].discount;
+    }
+
+    /**
+     * @notice Returns the owner of a code along with the owner's tier, step
+     * reduction and discount so that a trade needs a single external call to
+     * price its referral. That call still reads three slots, the code owner,
+     * the owner's tier and the tier config. Everything is 0 for an
+     * unregistered code
+     */
+    function resolve(bytes32 codeHash)
+        external
+        view
+        override
+        returns (
+            address referrer,
+            uint8 tier,
+            uint8 step,
+            uint32 discount
+        )
+    {
+        referrer = codeHashOwner[codeHash];
+        if (referrer != address(0)) {
+            (tier, step, discount) = resolveReferrer(referrer);
+        }
+    }
+
+    /**
+     * @notice Returns the tier, step reduction and discount of a referrer
+     */
+    function resolveReferrer(address referrer)
+        public
+        view
+        override
+        returns (
+            uint8 tier,
+            uint8 step,
+            uint32 discount
+        )
+    {
+        tier = referrerTier[referrer];
+        TierConfig memory tierConfig = tierConfigs[tier];
+        (step, discount) = (tierConfig.step, tierConfig.discount);
+    }
+
     /************************************************
      *  PRIVATE FUNCTIONS
      ***********************************************/
@@ -27,21 +27,27 @@ interface IKeeperPayment {
 }
 
 interface IBufferRouter {
+    // Packed into 4 slots, the last one is only written for trades with a referral code
     struct QueuedTrade {
-        uint256 queueId;
-        uint256 userQueueIndex;
+        uint40 queueId;
+        uint40 userQueueIndex;
         address user;
-        uint256 totalFee;
-        uint256 period;
         bool isAbove;
-        address targetContract;
-        uint256 expectedStrike;
-        uint256 slippage;
         bool allowPartialFill;
-        uint256 queuedTime;
+        address targetContract;
+        uint32 period;
+        uint16 slippage;
+        uint32 queuedTime;
         bool isQueued;
-        string referralCode;
-        uint256 traderNFTId;
+        uint128 totalFee;
+        uint96 expectedStrike;
+        uint32 traderNFTId;
+        bytes32 referralCode; // keccak256 of the code, 0 if there is no code
+    }
+    struct PendingTrade {
+        uint256 queueId;
+        address targetContract;
+        uint256 queuedTime;
     }
     struct Trade {
         uint256 queueId;
@@ -72,6 +78,45 @@ interface IBufferRouter {
         uint256 priceAtExpiry;
         bytes signature;
     }
+    struct OpenTradeParamsWithProof {
+        uint256 queueId;
+        uint256 timestamp;
+        uint256 price;
+        bytes32[] proof;
+    }
+    struct QueuedCloseTradeParamsWithProof {
+        uint256 closeId;
+        uint256 closingPrice;
+        bytes32[] proof;
+    }
+    struct CloseTradeParamsWithProof {
+        uint256 optionId;
+        address targetContract;
+        uint256 expiryTimestamp;
+        uint256 priceAtExpiry;
+        bytes32[] proof;
+    }
+    struct OpenBatch {
+        address[] optionsContracts;
+        uint256 count;
+        ERC20[] tokens;
+        address[] recipients;
+        uint256[] amounts;
+        uint256[] ledgerSlots;
+        uint256 ledgerCount;
+    }
+    struct UnlockBatch {
+        IBufferBinaryOptions.OptionExpiryData[] options;
+        address[] targetContracts;
+        uint256[] indices;
+        uint256 count;
+        uint256 nextIndex;
+        uint256[] settled;
+    }
+    struct MarketInfo {
+        string assetPair;
+        ERC20 tokenX;
+    }
     event OpenTrade(address indexed account, uint256 queueId, uint256 optionId);
     event InitiateClose(
         address indexed account,
@@ -81,6 +126,8 @@ interface IBufferRouter {
     event CancelTrade(address indexed account, uint256 queueId, string reason);
     event FailUnlock(uint256 optionId, string reason);
     event FailResolve(uint256 queueId, string reason);
+    event FailTransfer(address indexed account, ERC20 token, uint256 amount);
+    event Claim(address indexed account, ERC20 token, uint256 amount);
     event InitiateTrade(
         address indexed account,
         uint256 queueId,
@@ -108,6 +155,7 @@ interface IBufferBinaryOptions {
         uint256 priceAtExpiration
     );
     event Pause(bool isPaused);
+    event SweepSettlementFees(address indexed recipient, uint256 amount);
     event UpdateReferral(
         address user,
         address referrer,
@@ -115,21 +163,27 @@ interface IBufferBinaryOptions {
         uint256 totalFee,
         uint256 referrerFee,
         uint256 rebate,
-        string referralCode
+        bytes32 referralCode
     );
 
     function createFromRouter(
         OptionParams calldata optionParams,
-        bool isReferralValid,
+        DiscountMemo calldata discountMemo,
         uint256 queuedTime
-    ) external returns (uint256 optionID);
+    )
+        external
+        returns (
+            uint256 optionID,
+            address referrer,
+            uint256 referrerFee
+        );
 
     function checkParams(OptionParams calldata optionParams)
         external
         returns (
             uint256 amount,
             uint256 revisedFee,
-            bool isReferralValid
+            DiscountMemo memory discountMemo
         );
 
     function runInitialChecks(
@@ -137,7 +191,7 @@ interface IBufferBinaryOptions {
         uint256 period,
         uint256 totalFee,
         address account
-    ) external view;
+    ) external;
 
     function isStrikeValid(
         uint256 slippage,
@@ -187,16 +241,16 @@ interface IBufferBinaryOptions {
         uint256 priceAtExpiration;
     }
 
+    // Packed into 3 slots, the premium is always amount / 2 so it isn't stored
     struct Option {
         State state;
-        uint256 strike;
-        uint256 amount;
-        uint256 lockedAmount;
-        uint256 premium;
-        uint256 expiration;
+        uint128 strike;
+        uint128 amount;
+        uint128 lockedAmount;
+        uint32 expiration;
         bool isAbove;
-        uint256 totalFee;
-        uint256 createdAt;
+        uint128 totalFee;
+        uint32 createdAt;
     }
     struct OptionParams {
         uint256 strike;
@@ -206,23 +260,49 @@ interface IBufferBinaryOptions {
         bool allowPartialFill;
         uint256 totalFee;
         address user;
-        string referralCode;
+        bytes32 referralCode;
         uint256 traderNFTId;
     }
+    struct PricingTerms {
+        uint32 version;
+        int128 volatilityPerSqrtSecond64x64;
+    }
+    struct NFTTierCache {
+        address traderNFTContract;
+        uint32 epoch;
+        uint8 tier;
+    }
+    struct DiscountMemo {
+        address referrer;
+        bool isReferralValid;
+        uint256 settlementFeePercentage; // Factor of 1e2
+        uint256 referrerDiscount; // Factor of 1e5, 0 if the referrer isn't paid
+    }
 
     function options(uint256 optionId)
+        external
+        view
+        returns (
+            State state,
+            uint128 strike,
+            uint128 amount,
+            uint128 lockedAmount,
+            uint32 expiration,
+            bool isAbove,
+            uint128 totalFee,
+            uint32 createdAt
+        );
+
+    function expirationOf(uint256 optionId) external view returns (uint256);
+
+    function settlementInfo(uint256 optionId)
         external
         view
         returns (
             State state,
             uint256 strike,
-            uint256 amount,
-            uint256 lockedAmount,
-            uint256 premium,
             uint256 expiration,
-            bool isAbove,
-            uint256 totalFee,
-            uint256 createdAt
+            bool isAbove
         );
 
     function ownerOf(uint256 id) external view returns (address);
@@ -232,12 +312,20 @@ interface IBufferBinaryOptions {
         uint256 priceAtExpiration,
         uint256 closingTime
     ) external;
+
+    function unlockBatch(OptionExpiryData[] calldata optionData) external;
+
+    function settleBatch() external;
+
+    function accruedSettlementFees() external view returns (uint128);
 }
 
 interface ILiquidityPool {
+    // Packed into 1 slot, the amount of a deposit being the difference
+    // between its cumulative amount and the one of the previous deposit
     struct LockedAmount {
-        uint256 timestamp;
-        uint256 amount;
+        uint32 timestamp;
+        uint224 cumulativeAmount;
     }
     struct ProvidedLiquidity {
         uint256 unlockedAmount;
@@ -249,18 +337,33 @@ interface ILiquidityPool {
         uint256 premium;
         bool locked;
     }
+    struct WithdrawalRequest {
+        address account;
+        uint256 amount; // BLP held by the pool until the request is filled
+    }
+    struct Payouts {
+        address[] accounts;
+        uint256[] amounts;
+        uint256[] slots;
+        uint256 count;
+    }
     event Profit(uint256 indexed id, uint256 amount);
     event Loss(uint256 indexed id, uint256 amount);
     event Provide(address indexed account, uint256 amount, uint256 writeAmount);
     event UpdateMaxLiquidity(uint256 indexed maxLiquidity);
+    event UpdateDepositBucketSize(uint32 depositBucketSize);
     event Withdraw(
         address indexed account,
         uint256 amount,
         uint256 writeAmount
     );
+    event RequestWithdrawal(address indexed account, uint256 id, uint256 amount);
+    event CancelWithdrawal(address indexed account, uint256 id, uint256 amount);
 
     function unlock(uint256 id) external;
 
+    function unlockBatch(uint256[] calldata ids) external;
+
     function totalTokenXBalance() external view returns (uint256 amount);
 
     function availableBalance() external view returns (uint256 balance);
@@ -271,11 +374,25 @@ interface ILiquidityPool {
         uint256 amount
     ) external;
 
+    function sendBatch(
+        uint256[] calldata ids,
+        address[] calldata accounts,
+        uint256[] calldata amounts
+    ) external;
+
     function lock(
         uint256 id,
         uint256 tokenXAmount,
         uint256 premium
     ) external;
+
+    function lockDeferred(
+        uint256 id,
+        uint256 tokenXAmount,
+        uint256 premium
+    ) external;
+
+    function collectPremium(uint256 premium) external;
 }
 
 interface IOptionsConfig {
@@ -285,6 +402,22 @@ interface IOptionsConfig {
         uint8 endHour;
         uint8 endMinute;
     }
+    struct Session {
+        uint8 day;
+        Window window;
+    }
+    // Packed into 3 slots
+    struct Snapshot {
+        address whitelistStorage;
+        uint16 assetUtilizationLimit;
+        uint16 overallPoolUtilizationLimit;
+        uint16 optionFeePerTxnLimitPercent;
+        uint32 version;
+        address traderNFTContract;
+        uint32 minPeriod;
+        uint32 maxPeriod;
+        uint256 minFee;
+    }
 
     event UpdateMarketTime();
     event UpdateMaxPeriod(uint32 value);
@@ -328,6 +461,15 @@ interface IOptionsConfig {
     function minFee() external view returns (uint256);
 
     function optionFeePerTxnLimitPercent() external view returns (uint16);
+
+    function version() external view returns (uint32);
+
+    function snapshot() external view returns (Snapshot memory);
+
+    function isInMarketHours(uint256 startTime, uint256 endTime)
+        external
+        view
+        returns (bool);
 }
 
 interface ITraderNFT {
@@ -335,6 +477,11 @@ interface ITraderNFT {
 
     function tokenTierMappings(uint256 id) external view returns (uint8 tier);
 
+    function tokenOwnerAndEpoch(uint256 id)
+        external
+        view
+        returns (address user, uint32 epoch);
+
     event UpdateTiers(uint256[] tokenIds, uint8[] tiers, uint256[] batchIds);
 }
 
@@ -343,6 +490,11 @@ interface IFakeTraderNFT {
 
     function tokenTierMappings(uint256 id) external view returns (uint8 tier);
 
+    function tokenOwnerAndEpoch(uint256 id)
+        external
+        view
+        returns (address user, uint32 epoch);
+
     event UpdateNftBasePrice(uint256 nftBasePrice);
     event UpdateMaxNFTMintLimits(uint256 maxNFTMintLimit);
     event UpdateBaseURI(string baseURI);
@@ -353,6 +505,8 @@ interface IFakeTraderNFT {
 interface IReferralStorage {
     function codeOwner(string memory _code) external view returns (address);
 
+    function codeHashOwner(bytes32 codeHash) external view returns (address);
+
     function traderReferralCodes(address) external view returns (string memory);
 
     function getTraderReferralInfo(address user)
@@ -376,6 +530,25 @@ interface IReferralStorage {
 
     function referrerTier(address referrer) external view returns (uint8 tier);
 
+    function resolve(bytes32 codeHash)
+        external
+        view
+        returns (
+            address referrer,
+            uint8 tier,
+            uint8 step,
+            uint32 discount
+        );
+
+    function resolveReferrer(address referrer)
+        external
+        view
+        returns (
+            uint8 tier,
+            uint8 step,
+            uint32 discount
+        );
+
     struct ReferrerData {
         uint256 tradeVolume;
         uint256 rebate;
@@ -397,6 +570,11 @@ interface IReferralStorage {
         uint256 discountShare; // 5000 for 50%/50%, 7000 for 30% rebates/70% discount
     }
 
+    struct TierConfig {
+        uint8 step;
+        uint32 discount; // Factor of 1e5
+    }
+
     event UpdateTraderReferralCode(address indexed account, string code);
     event UpdateReferrerTier(address referrer, uint8 tierId);
     event RegisterCode(address indexed account, string code);
@@ -422,6 +600,27 @@ interface IBufferOptionsForReader is IBufferBinaryOptions {
 
     function stepSize() external view returns (uint16);
 
+    function nftTierStep(uint8 tier) external view returns (uint8);
+
+    function totalLockedAmount() external view returns (uint256);
+
+    function userOptionIds(address user, uint256 index)
+        external
+        view
+        returns (uint256);
+
+    function userOptionCount(address user) external view returns (uint256);
+
+    function userActiveOptionIds(address user, uint256 index)
+        external
+        view
+        returns (uint256);
+
+    function userActiveOptionCount(address user)
+        external
+        view
+        returns (uint256);
+
     function _getSettlementFeeDiscount(
         address referrer,
         address user,
@@ -432,3 +631,7 @@ interface IBufferOptionsForReader is IBufferBinaryOptions {
 interface IWhitelist {
     function isWhitelist(address user) external view returns (bool);
 }
+
+interface ISettlementFeeDistributor {
+    function distribute() external;
+}
@@ -0,0 +1,42 @@
+// SPDX-License-Identifier: BUSL-1.1
+
+pragma solidity 0.8.4;
+
+import "@openzeppelin/contracts/token/ERC20/ERC20.sol";
+import "@openzeppelin/contracts/access/AccessControl.sol";
+
+/**
+ * @notice USDC with a blacklist like the real one, transfers from or to
+ * a blacklisted address revert
+ */
+contract BlacklistUSDC is ERC20("USDC", "USDC"), AccessControl {
+    mapping(address => bool) public isBlacklisted;
+
+    constructor() {
+        uint256 INITIAL_SUPPLY = 1000 * 10**6 * 10**decimals();
+        _mint(msg.sender, INITIAL_SUPPLY);
+        _setupRole(DEFAULT_ADMIN_ROLE, msg.sender);
+    }
+
+    function decimals() public view virtual override returns (uint8) {
+        return 6;
+    }
+
+    function setBlacklisted(address account, bool blacklisted)
+        external
+        onlyRole(DEFAULT_ADMIN_ROLE)
+    {
+        isBlacklisted[account] = blacklisted;
+    }
+
+    function _beforeTokenTransfer(
+        address from,
+        address to,
+        uint256 amount
+    ) internal virtual override {
+        require(
+            !isBlacklisted[from] && !isBlacklisted[to],
+            "Blacklistable: account is blacklisted"
+        );
+    }
+}
@@ -0,0 +1,126 @@
+"""
+NumPy reference implementations of the binary option pricing in OptionMath.
+
+black_scholes_price_binary mirrors blackScholesPriceBinary, which uses Choudhury's
+approximation of the normal CDF. black_scholes_price_binary_fast mirrors
+blackScholesPriceBinaryFast, which interpolates the CDF between the values tabulated
+every CDF_TABLE_STEP with cubic Hermite polynomials. exact_price_binary is the
+closed form Black-Scholes price that both are checked against.
+
+All the prices are fractions in [0, 1], OptionMath returns them with a factor of 1e8.
+Running this file prints the packed table constants of OptionMath.
+"""
+
+import math
+
+import numpy as np
+
+SECONDS_PER_YEAR = 365 * 86400
+CDF_TABLE_STEP = 0.25
+CDF_TABLE_SIZE = 25  # d = 0, 0.25, ..., 6
+TABLE_ENTRY_BITS = 32
+
+_erf = np.vectorize(math.erf, otypes=[float])
+
+
+def normal_cdf(x):
+    return 0.5 * (1 + _erf(np.asarray(x, dtype=float) / math.sqrt(2)))
+
+
+def normal_pdf(x):
+    x = np.asarray(x, dtype=float)
+    return np.exp(-(x**2) / 2) / math.sqrt(2 * math.pi)
+
+
+def choudhury_cdf(x):
+    """
+    Choudhury's approximation of the normal CDF used by OptionMath._N
+    """
+    x = np.asarray(x, dtype=float)
+    value = np.exp(-(x**2) / 2) / (
+        2260 / 3989 + 6400 / 3989 * np.abs(x) + 3300 / 3989 * np.sqrt(x**2 + 3)
+    )
+    return np.where(x > 0, 1 - value, value)
+
+
+def cdf_table():
+    """
+    Returns the tabulated CDF and PDF rounded to TABLE_ENTRY_BITS bits like OptionMath
+    """
+    nodes = np.arange(CDF_TABLE_SIZE) * CDF_TABLE_STEP
+    scale = 2**TABLE_ENTRY_BITS
+    cdf = np.round(normal_cdf(nodes) * scale) / scale
+    pdf = np.round(normal_pdf(nodes) * scale) / scale
+    return cdf, pdf
+
+
+def pack_table(values):
+    """
+    Packs the fractions into the uint256 words of OptionMath, entry i is stored at
+    bits [32 * (i % 8), 32 * (i % 8) + 32) of the word i / 8
+    """
+    entries_per_word = 256 // TABLE_ENTRY_BITS
+    words = [0] * math.ceil(len(values) / entries_per_word)
+    for index, value in enumerate(values):
+        entry = int(round(value * 2**TABLE_ENTRY_BITS))
+        assert 0 <= entry < 2**TABLE_ENTRY_BITS
+        words[index // entries_per_word] |= entry << (
+            TABLE_ENTRY_BITS * (index % entries_per_word)
+        )
+    return words
+
+
+def table_cdf(x):
+    """
+    Cubic Hermite interpolation of the tabulated CDF used by OptionMath._cdf
+    """
+    x = np.asarray(x, dtype=float)
+    cdf, pdf = cdf_table()
+    scaled = np.abs(x) / CDF_TABLE_STEP
+    index = np.minimum(np.floor(scaled).astype(int), CDF_TABLE_SIZE - 2)
+    t = scaled - index
+    value = (
+        cdf[index]
+        + (3 * t**2 - 2 * t**3) * (cdf[index + 1] - cdf[index])
+        + (t**3 - 2 * t**2 + t) * pdf[index] * CDF_TABLE_STEP
+        + (t**3 - t**2) * pdf[index + 1] * CDF_TABLE_STEP
+    )
+    value = np.where(scaled >= CDF_TABLE_SIZE - 1, 1.0, value)
+    return np.where(x < 0, 1 - value, value)
+
+
+def _d2(implied_vol, strike, spot, period):
+    """
+    implied_vol has a factor of 1e4 and period is in seconds like in OptionMath
+    """
+    std_dev = (
+        np.asarray(implied_vol, dtype=float)
+        / 1e4
+        * np.sqrt(np.asarray(period, dtype=float) / SECONDS_PER_YEAR)
+    )
+    log_moneyness = np.log(np.asarray(spot, dtype=float) / np.asarray(strike))
+    return log_moneyness / std_dev - std_dev / 2
+
+
+def _price(cdf, implied_vol, strike, spot, period, is_above):
+    d2 = _d2(implied_vol, strike, spot, period)
+    return cdf(np.where(is_above, d2, -d2))
+
+
+def exact_price_binary(implied_vol, strike, spot, period, is_above):
+    return _price(normal_cdf, implied_vol, strike, spot, period, is_above)
+
+
+def black_scholes_price_binary(implied_vol, strike, spot, period, is_above):
+    return _price(choudhury_cdf, implied_vol, strike, spot, period, is_above)
+
+
+def black_scholes_price_binary_fast(implied_vol, strike, spot, period, is_above):
+    return _price(table_cdf, implied_vol, strike, spot, period, is_above)
+
+
+if __name__ == "__main__":
+    cdf, pdf = cdf_table()
+    for name, values in (("CDF", cdf), ("PDF", pdf)):
+        for index, word in enumerate(pack_table(values)):
+            print(f"{name}_TABLE_{index} = 0x{word:064x}")
@@ -0,0 +1,69 @@
+"""
+Encoders for the packed keeper entry points of BufferRouter.
+
+resolveQueuedTradesPacked expects OPEN_TRADE_PACKED_SIZE (92) bytes per trade:
+    queueId (uint64) | timestamp (uint32) | price (uint128) | r (bytes32) | vs (bytes32)
+
+unlockOptionsPacked expects CLOSE_TRADE_PACKED_SIZE (112) bytes per option:
+    optionId (uint64) | targetContract (address) | expiryTimestamp (uint32)
+    | priceAtExpiry (uint128) | r (bytes32) | vs (bytes32)
+
+All the integers are big endian and the signatures are EIP-2098 compact signatures.
+"""
+
+OPEN_TRADE_PACKED_SIZE = 92
+CLOSE_TRADE_PACKED_SIZE = 112
+
+
+def _to_bytes(value):
+    if isinstance(value, str):
+        return bytes.fromhex(value[2:] if value.startswith("0x") else value)
+    return bytes(value)
+
+
+def _pack_uint(value, size):
+    return int(value).to_bytes(size, "big")
+
+
+def compact_signature(signature):
+    """
+    Converts a 65 bytes (r, s, v) signature to its 64 bytes EIP-2098 (r, vs) form
+    """
+    signature = _to_bytes(signature)
+    if len(signature) != 65:
+        raise ValueError("Expected a 65 bytes signature")
+    r, s, v = signature[:32], signature[32:64], signature[64]
+    if v < 27:
+        v += 27
+    vs = int.from_bytes(s, "big") | ((v - 27) << 255)
+    return r + vs.to_bytes(32, "big")
+
+
+def encode_open_trades(trades):
+    """
+    Encodes (queue_id, timestamp, price, signature) tuples for resolveQueuedTradesPacked
+    """
+    data = b"".join(
+        _pack_uint(queue_id, 8)
+        + _pack_uint(timestamp, 4)
+        + _pack_uint(price, 16)
+        + compact_signature(signature)
+        for queue_id, timestamp, price, signature in trades
+    )
+    return "0x" + data.hex()
+
+
+def encode_close_trades(options):
+    """
+    Encodes (option_id, target_contract, expiry_timestamp, price, signature) tuples
+    for unlockOptionsPacked
+    """
+    data = b"".join(
+        _pack_uint(option_id, 8)
+        + _to_bytes(str(target_contract))
+        + _pack_uint(expiry_timestamp, 4)
+        + _pack_uint(price, 16)
+        + compact_signature(signature)
+        for option_id, target_contract, expiry_timestamp, price, signature in options
+    )
+    return "0x" + data.hex()
@@ -15,6 +15,25 @@ class OptionType(IntEnum):
     NONE = 3
 
 
+def pytest_addoption(parser):
+    parser.addoption("--benchmark", action="store_true", help="run the gas benchmarks")
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "benchmark: gas benchmark, only run with --benchmark"
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--benchmark"):
+        return
+    skip_benchmark = pytest.mark.skip(reason="gas benchmark, run with --benchmark")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip_benchmark)
+
+
 @pytest.fixture(scope="function", autouse=True)
 def isolate(fn_isolation):
     # perform a chain rewind after completing each test, to ensure proper isolation
@@ -2,7 +2,13 @@ import time
 from enum import IntEnum
 
 import brownie
-from brownie import BufferBinaryOptions
+from brownie import (
+    BufferBinaryOptions,
+    OptionReader,
+    SettlementFeeDistributor,
+    TraderNFT,
+    web3,
+)
 from eth_account import Account
 from eth_account.messages import encode_defunct
 
@@ -105,12 +111,12 @@ class BinaryOptionTesting(object):
     def verify_referrals(self):
         self.chain.snapshot()
 
-        (code, referrer) = self.referral_contract.getTraderReferralInfo(self.user_1)
+        code, referrer = self.referral_contract.getTraderReferralInfo(self.user_1)
         assert code == "" and referrer == ADDRESS_0, "Wrong ref data"
 
         self.referral_contract.setTraderReferralCodeByUser("123", {"from": self.user_1})
 
-        (code, referrer) = self.referral_contract.getTraderReferralInfo(self.user_1)
+        code, referrer = self.referral_contract.getTraderReferralInfo(self.user_1)
         assert code == "123" and referrer == ADDRESS_0, "Wrong ref data"
 
         self.referral_contract.registerCode("123", {"from": self.user_1})
@@ -120,6 +126,9 @@ class BinaryOptionTesting(object):
     def verify_option_config(self):
         self.chain.snapshot()
 
+        # The token unit is cached at construction
+        assert self.tokenX_options.decimals() == self.tokenX.decimals()
+
         # assetUtilizationLimit
         with brownie.reverts("Wrong utilization value"):
             self.options_config.setAssetUtilizationLimit(112e2)
@@ -168,6 +177,27 @@ class BinaryOptionTesting(object):
         self.options_config.setMinPeriod(300)
         assert self.options_config.minPeriod() == 300
 
+        # snapshot
+        version = self.options_config.version()
+        self.options_config.setMinFee(2e6)
+        self.options_config.setOptionFeePerTxnLimitPercent(4e2)
+        assert self.options_config.version() == version + 2, "Version not bumped"
+        assert self.options_config.snapshot() == (
+            self.options_config.whitelistStorage(),
+            52e2,
+            52e2,
+            4e2,
+            version + 2,
+            self.options_config.traderNFTContract(),
+            300,
+            86400,
+            2e6,
+        ), "Wrong snapshot"
+        # The implied volatility has no snapshot field but invalidates the
+        # cached pricing terms
+        self.options_config.setImpliedProbability(1e4)
+        assert self.options_config.version() == version + 3, "Version not bumped"
+
         with brownie.reverts():  # Wrong role
             self.options_config.transferOwnership(self.user_2, {"from": self.user_1})
         with brownie.reverts():  # Wrong address
@@ -193,7 +223,7 @@ class BinaryOptionTesting(object):
         expected_total_fee,
         expected_settlement_fee,
         pool_balance_diff,
-        sfd_diff,
+        accrued_fee_diff,
         txn,
     ):
         (
@@ -201,8 +231,7 @@ class BinaryOptionTesting(object):
             strike,
             amount,
             locked_amount,
-            premium,
-            _,
+            expiration,
             _is_above,
             fee,
             _,
@@ -212,14 +241,21 @@ class BinaryOptionTesting(object):
         assert (
             amount == locked_amount == expected_amount
         ), "Wrong amount or locked amount"
-        assert premium == expected_premium, "Wrong premium"
+        assert amount // 2 == expected_premium, "Wrong premium"
+        assert self.tokenX_options.expirationOf(option_id) == expiration
+        assert self.tokenX_options.settlementInfo(option_id) == (
+            1,
+            strike,
+            expiration,
+            _is_above,
+        ), "Wrong settlement info"
         assert _is_above == expected_option_type, "Wrong option_type"
         assert fee == expected_total_fee, "Wrong fee"
         assert (
             self.tokenX.balanceOf(self.tokenX_options.address)
-            == self.tokenX.balanceOf(self.router.address)
-            == 0
+            == self.tokenX_options.accruedSettlementFees()
         ), "Wrong option balance"
+        assert self.tokenX.balanceOf(self.router.address) == 0, "Wrong router balance"
         assert pool_balance_diff == expected_premium, "Wrong premium transferred"
         assert (
             self.generic_pool.lockedLiquidity(self.tokenX_options.address, option_id)[0]
@@ -229,7 +265,7 @@ class BinaryOptionTesting(object):
 
         assert (
             txn.events["Create"]["settlementFee"] == expected_settlement_fee
-            and sfd_diff == expected_settlement_fee
+            and accrued_fee_diff == expected_settlement_fee
         ), "Wrong settlementFee"
 
     def get_signature(self, token, timestamp, price, publisher=None):
@@ -291,7 +327,7 @@ class BinaryOptionTesting(object):
         )
         queued_trade = self.router.queuedTrades(next_id)
         open_params_1 = [
-            queued_trade[10],
+            queued_trade[8],
             self.expected_strike,
         ]
         txn = self.router.resolveQueuedTrades(
@@ -334,7 +370,7 @@ class BinaryOptionTesting(object):
         )
         queued_trade = self.router.queuedTrades(next_id)
         open_params_1 = [
-            queued_trade[10],
+            queued_trade[8],
             self.expected_strike,
         ]
         txn = self.router.resolveQueuedTrades(
@@ -376,7 +412,7 @@ class BinaryOptionTesting(object):
         )
         queued_trade = self.router.queuedTrades(next_id)
         open_params_1 = [
-            queued_trade[10],
+            queued_trade[8],
             self.expected_strike,
         ]
         txn = self.router.resolveQueuedTrades(
@@ -413,7 +449,7 @@ class BinaryOptionTesting(object):
         )
         queued_trade = self.router.queuedTrades(next_id)
         open_params_1 = [
-            queued_trade[10],
+            queued_trade[8],
             self.expected_strike,
         ]
         txn = self.router.resolveQueuedTrades(
@@ -445,7 +481,7 @@ class BinaryOptionTesting(object):
         )
         queued_trade = self.router.queuedTrades(next_id)
         open_params_1 = [
-            queued_trade[10],
+            queued_trade[8],
             self.expected_strike,
         ]
         txn = self.router.resolveQueuedTrades(
@@ -496,7 +532,7 @@ class BinaryOptionTesting(object):
         )
         queued_trade = self.router.queuedTrades(next_id)
         open_params_1 = [
-            queued_trade[10],
+            queued_trade[8],
             self.expected_strike,
         ]
         txn = self.router.resolveQueuedTrades(
@@ -531,7 +567,7 @@ class BinaryOptionTesting(object):
         )
         queued_trade = self.router.queuedTrades(next_id)
         open_params_1 = [
-            queued_trade[10],
+            queued_trade[8],
             self.expected_strike,
         ]
         txn = self.router.resolveQueuedTrades(
@@ -563,7 +599,7 @@ class BinaryOptionTesting(object):
         )
         queued_trade = self.router.queuedTrades(next_id)
         open_params_1 = [
-            queued_trade[10],
+            queued_trade[8],
             self.expected_strike,
         ]
         txn = self.router.resolveQueuedTrades(
@@ -584,6 +620,110 @@ class BinaryOptionTesting(object):
         )
         self.chain.revert()
 
+    def open_forex_trade(self, period):
+        queue_id = self.router.nextQueueId()
+        self.router.initiateTrade(
+            self.total_fee,
+            period,
+            self.is_above,
+            self.forex_option.address,
+            self.expected_strike,
+            self.slippage,
+            self.allow_partial_fill,
+            self.referral_code,
+            0,
+            {"from": self.user_1},
+        )
+        open_params = [self.router.queuedTrades(queue_id)[8], self.expected_strike]
+        return self.router.resolveQueuedTrades(
+            [
+                (
+                    queue_id,
+                    *open_params,
+                    self.get_signature(self.forex_option.address, *open_params),
+                ),
+            ],
+            {"from": self.bot},
+        )
+
+    def verify_forex_market_sessions(self):
+        self.chain.snapshot()
+        self.tokenX.transfer(self.user_1, self.total_fee * 10, {"from": self.owner})
+        self.tokenX.approve(
+            self.router.address, self.total_fee * 10, {"from": self.user_1}
+        )
+
+        # Set the current time at 22,0 of the day
+        currentTime = self.chain.time()
+        self.chain.sleep(86400 - (currentTime % 86400) + (22 * 3600))
+        currentTime = self.chain.time()
+        currentDay = ((currentTime // 86400) + 4) % 7
+        nextDay = (currentDay + 1) % 7
+
+        # Overnight session followed by a second session on the next day
+        sessions = [
+            (currentDay, (22, 0, 2, 0)),
+            (nextDay, (3, 0, 4, 0)),
+        ]
+        with brownie.reverts("Ownable: caller is not the owner"):
+            self.forex_option_config.setMarketSessions(sessions, {"from": self.user_1})
+        with brownie.reverts("Wrong market time"):
+            self.forex_option_config.setMarketSessions(
+                [(7, (22, 0, 2, 0))], {"from": self.owner}
+            )
+        self.forex_option_config.setMarketSessions(sessions, {"from": self.owner})
+        assert self.forex_option_config.marketTimes(currentDay) == (0, 0, 0, 0)
+
+        ########### TRADES CAN CROSS MIDNIGHT ###########
+        txn = self.open_forex_trade(3 * 3600)
+        assert txn.events["OpenTrade"], "Trade didn't open"
+
+        # Should cancel trades expiring after the end of the session
+        txn = self.open_forex_trade(4 * 3600 + 60)
+        assert (
+            txn.events["CancelTrade"] and txn.events["CancelTrade"]["reason"] == "O30"
+        )
+
+        # Should cancel trades spanning the break between the sessions
+        txn = self.open_forex_trade(5 * 3600 + 30 * 60)
+        assert (
+            txn.events["CancelTrade"] and txn.events["CancelTrade"]["reason"] == "O30"
+        )
+
+        ########### MARKET IS CLOSED BETWEEN THE SESSIONS ###########
+        self.chain.sleep(4 * 3600 + 30 * 60)
+        txn = self.open_forex_trade(300)
+        assert (
+            txn.events["CancelTrade"] and txn.events["CancelTrade"]["reason"] == "O30"
+        )
+
+        ########### SECOND SESSION ###########
+        self.chain.sleep(3600)
+        txn = self.open_forex_trade(300)
+        assert txn.events["OpenTrade"], "Trade didn't open"
+        txn = self.open_forex_trade(1800)
+        assert (
+            txn.events["CancelTrade"] and txn.events["CancelTrade"]["reason"] == "O30"
+        )
+
+        ########### SESSIONS CAN WRAP AROUND THE END OF THE WEEK ###########
+        self.forex_option_config.setMarketSessions(
+            [(6, (22, 0, 2, 0))], {"from": self.owner}
+        )
+        # Weeks of the unix epoch start on Thursday
+        week_start = currentTime - (currentTime % (7 * 86400))
+        saturday = week_start + 2 * 86400
+        assert self.forex_option_config.isInMarketHours(
+            saturday + 22 * 3600, saturday + 25 * 3600 + 59 * 60
+        ), "Wrong overnight session"
+        assert not self.forex_option_config.isInMarketHours(
+            saturday + 22 * 3600, saturday + 26 * 3600
+        ), "Session should be closed"
+        assert not self.forex_option_config.isInMarketHours(
+            saturday + 21 * 3600 + 59 * 60, saturday + 23 * 3600
+        ), "Session shouldn't be open yet"
+        self.chain.revert()
+
     def verify_fake_referral_protection(self):
         self.chain.snapshot()
         self.tokenX.transfer(self.user_5, self.total_fee * 3, {"from": self.owner})
@@ -624,7 +764,7 @@ class BinaryOptionTesting(object):
         )
         queued_trade = self.router.queuedTrades(queue_id)
         open_params_1 = [
-            queued_trade[10],
+            queued_trade[8],
             396e8,
         ]
 
@@ -684,6 +824,18 @@ class BinaryOptionTesting(object):
                 self.referral_code,
                 {"from": self.user_2},
             )
+        assert self.referral_contract.resolve(web3.keccak(text=self.referral_code)) == (
+            self.referrer,
+            0,
+            4,
+            25e3,
+        ), "Wrong resolution"
+        assert self.referral_contract.resolve(web3.keccak(text="unknown")) == (
+            ADDRESS_0,
+            0,
+            0,
+            0,
+        )
 
         txn = self.router.initiateTrade(
             *params,
@@ -695,14 +847,12 @@ class BinaryOptionTesting(object):
 
         initial_referrer_tokenX_balance = self.tokenX.balanceOf(self.referrer)
         initial_user_tokenX_balance = self.tokenX.balanceOf(self.user_5)
-        initial_sfd_tokenX_balance = self.tokenX.balanceOf(
-            self.settlement_fee_disbursal
-        )
+        initial_accrued_fees = self.tokenX_options.accruedSettlementFees()
         initial_pool_tokenX_balance = self.tokenX.balanceOf(self.generic_pool.address)
 
         queued_trade = self.router.queuedTrades(queue_id)
         open_params_1 = [
-            queued_trade[10],
+            queued_trade[8],
             396e8,
         ]
 
@@ -722,7 +872,7 @@ class BinaryOptionTesting(object):
 
         final_referrer_tokenX_balance = self.tokenX.balanceOf(self.referrer)
         final_user_tokenX_balance = self.tokenX.balanceOf(self.user_5)
-        final_sfd_tokenX_balance = self.tokenX.balanceOf(self.settlement_fee_disbursal)
+        final_accrued_fees = self.tokenX_options.accruedSettlementFees()
         final_pool_tokenX_balance = self.tokenX.balanceOf(self.generic_pool.address)
 
         option_id = txn.events["Create"]["id"]
@@ -745,7 +895,7 @@ class BinaryOptionTesting(object):
             self.total_fee,
             137500,  # 14% - 2500
             final_pool_tokenX_balance - initial_pool_tokenX_balance,
-            final_sfd_tokenX_balance - initial_sfd_tokenX_balance,
+            final_accrued_fees - initial_accrued_fees,
             txn,
         )
         self.chain.revert()
@@ -776,12 +926,10 @@ class BinaryOptionTesting(object):
         initial_user_tokenX_balance = self.tokenX.balanceOf(self.user_1)
         initial_pool_tokenX_balance = self.tokenX.balanceOf(self.generic_pool.address)
         initial_locked_amount = self.tokenX_options.totalLockedAmount()
-        initial_sfd_tokenX_balance = self.tokenX.balanceOf(
-            self.settlement_fee_disbursal
-        )
+        initial_accrued_fees = self.tokenX_options.accruedSettlementFees()
         queued_trade = self.router.queuedTrades(0)
         open_params_1 = [
-            queued_trade[10],
+            queued_trade[8],
             396e8,
         ]
         txn = self.router.resolveQueuedTrades(
@@ -799,7 +947,7 @@ class BinaryOptionTesting(object):
         )
         final_user_tokenX_balance = self.tokenX.balanceOf(self.user_1)
         final_pool_tokenX_balance = self.tokenX.balanceOf(self.generic_pool.address)
-        final_sfd_tokenX_balance = self.tokenX.balanceOf(self.settlement_fee_disbursal)
+        final_accrued_fees = self.tokenX_options.accruedSettlementFees()
         final_locked_amount = self.tokenX_options.totalLockedAmount()
         assert txn.events["OpenTrade"], "Trade not opened"
         assert (
@@ -816,7 +964,7 @@ class BinaryOptionTesting(object):
             self.total_fee,
             150000,
             final_pool_tokenX_balance - initial_pool_tokenX_balance,
-            final_sfd_tokenX_balance - initial_sfd_tokenX_balance,
+            final_accrued_fees - initial_accrued_fees,
             txn,
         )
 
@@ -842,12 +990,10 @@ class BinaryOptionTesting(object):
         )
         initial_user_tokenX_balance = self.tokenX.balanceOf(self.user_1)
         initial_pool_tokenX_balance = self.tokenX.balanceOf(self.generic_pool.address)
-        initial_sfd_tokenX_balance = self.tokenX.balanceOf(
-            self.settlement_fee_disbursal
-        )
+        initial_accrued_fees = self.tokenX_options.accruedSettlementFees()
         queued_trade = self.router.queuedTrades(1)
         open_params_1 = [
-            queued_trade[10],
+            queued_trade[8],
             396e8,
         ]
         txn = self.router.resolveQueuedTrades(
@@ -865,7 +1011,7 @@ class BinaryOptionTesting(object):
         )
         final_user_tokenX_balance = self.tokenX.balanceOf(self.user_1)
         final_pool_tokenX_balance = self.tokenX.balanceOf(self.generic_pool.address)
-        final_sfd_tokenX_balance = self.tokenX.balanceOf(self.settlement_fee_disbursal)
+        final_accrued_fees = self.tokenX_options.accruedSettlementFees()
         assert txn.events["OpenTrade"], "Trade not opened"
         assert (
             final_user_tokenX_balance - initial_user_tokenX_balance == 0
@@ -880,7 +1026,7 @@ class BinaryOptionTesting(object):
             self.total_fee,
             150000,
             final_pool_tokenX_balance - initial_pool_tokenX_balance,
-            final_sfd_tokenX_balance - initial_sfd_tokenX_balance,
+            final_accrued_fees - initial_accrued_fees,
             txn,
         )
         self.router.initiateTrade(
@@ -889,7 +1035,7 @@ class BinaryOptionTesting(object):
         )
         queued_trade = self.router.queuedTrades(2)
         open_params_1 = [
-            queued_trade[10],
+            queued_trade[8],
             396e8,
         ]
         txn = self.router.resolveQueuedTrades(
@@ -943,12 +1089,10 @@ class BinaryOptionTesting(object):
         initial_user_tokenX_balance = self.tokenX.balanceOf(self.user_1)
         initial_pool_tokenX_balance = self.tokenX.balanceOf(self.generic_pool.address)
         initial_locked_amount = self.tokenX_options.totalLockedAmount()
-        initial_sfd_tokenX_balance = self.tokenX.balanceOf(
-            self.settlement_fee_disbursal
-        )
+        initial_accrued_fees = self.tokenX_options.accruedSettlementFees()
         queued_trade = self.router.queuedTrades(3)
         open_params_1 = [
-            queued_trade[10],
+            queued_trade[8],
             396e8,
         ]
         txn = self.router.resolveQueuedTrades(
@@ -967,7 +1111,7 @@ class BinaryOptionTesting(object):
         final_user_tokenX_balance = self.tokenX.balanceOf(self.user_1)
         final_pool_tokenX_balance = self.tokenX.balanceOf(self.generic_pool.address)
         final_locked_amount = self.tokenX_options.totalLockedAmount()
-        final_sfd_tokenX_balance = self.tokenX.balanceOf(self.settlement_fee_disbursal)
+        final_accrued_fees = self.tokenX_options.accruedSettlementFees()
         assert txn.events["OpenTrade"], "Trade not opened"
         assert (
             final_user_tokenX_balance - initial_user_tokenX_balance == 0
@@ -983,7 +1127,7 @@ class BinaryOptionTesting(object):
             self.total_fee,
             125000.0,
             final_pool_tokenX_balance - initial_pool_tokenX_balance,
-            final_sfd_tokenX_balance - initial_sfd_tokenX_balance,
+            final_accrued_fees - initial_accrued_fees,
             txn,
         )
 
@@ -1038,12 +1182,10 @@ class BinaryOptionTesting(object):
         initial_pool_tokenX_balance = self.tokenX.balanceOf(self.generic_pool.address)
         initial_locked_amount = self.tokenX_options.totalLockedAmount()
         initial_referrer_tokenX_balance = self.tokenX.balanceOf(self.referrer)
-        initial_sfd_tokenX_balance = self.tokenX.balanceOf(
-            self.settlement_fee_disbursal
-        )
+        initial_accrued_fees = self.tokenX_options.accruedSettlementFees()
         queued_trade = self.router.queuedTrades(0)
         open_params_1 = [
-            queued_trade[10],
+            queued_trade[8],
             396e8,
         ]
         txn = self.router.resolveQueuedTrades(
@@ -1063,7 +1205,7 @@ class BinaryOptionTesting(object):
         final_user_tokenX_balance = self.tokenX.balanceOf(self.user_1)
         final_pool_tokenX_balance = self.tokenX.balanceOf(self.generic_pool.address)
         final_locked_amount = self.tokenX_options.totalLockedAmount()
-        final_sfd_tokenX_balance = self.tokenX.balanceOf(self.settlement_fee_disbursal)
+        final_accrued_fees = self.tokenX_options.accruedSettlementFees()
 
         assert (
             final_referrer_tokenX_balance - initial_referrer_tokenX_balance == 5000
@@ -1083,7 +1225,7 @@ class BinaryOptionTesting(object):
             self.total_fee,
             120000.0,  # 5%
             final_pool_tokenX_balance - initial_pool_tokenX_balance,
-            final_sfd_tokenX_balance - initial_sfd_tokenX_balance,
+            final_accrued_fees - initial_accrued_fees,
             txn,
         )
 
@@ -1139,12 +1281,10 @@ class BinaryOptionTesting(object):
         initial_pool_tokenX_balance = self.tokenX.balanceOf(self.generic_pool.address)
         initial_locked_amount = self.tokenX_options.totalLockedAmount()
         initial_referrer_tokenX_balance = self.tokenX.balanceOf(self.referrer)
-        initial_sfd_tokenX_balance = self.tokenX.balanceOf(
-            self.settlement_fee_disbursal
-        )
+        initial_accrued_fees = self.tokenX_options.accruedSettlementFees()
         queued_trade = self.router.queuedTrades(0)
         open_params_1 = [
-            queued_trade[10],
+            queued_trade[8],
             396e8,
         ]
         txn = self.router.resolveQueuedTrades(
@@ -1164,7 +1304,7 @@ class BinaryOptionTesting(object):
         final_user_tokenX_balance = self.tokenX.balanceOf(self.user_1)
         final_pool_tokenX_balance = self.tokenX.balanceOf(self.generic_pool.address)
         final_locked_amount = self.tokenX_options.totalLockedAmount()
-        final_sfd_tokenX_balance = self.tokenX.balanceOf(self.settlement_fee_disbursal)
+        final_accrued_fees = self.tokenX_options.accruedSettlementFees()
 
         assert (
             final_referrer_tokenX_balance - initial_referrer_tokenX_balance == 2500
@@ -1184,7 +1324,7 @@ class BinaryOptionTesting(object):
             self.total_fee,
             107499.0,
             final_pool_tokenX_balance - initial_pool_tokenX_balance,
-            final_sfd_tokenX_balance - initial_sfd_tokenX_balance,
+            final_accrued_fees - initial_accrued_fees,
             txn,
         )
         self.chain.revert()
@@ -1224,12 +1364,10 @@ class BinaryOptionTesting(object):
         )
         initial_user_tokenX_balance = self.tokenX.balanceOf(self.user_1)
         initial_pool_tokenX_balance = self.tokenX.balanceOf(self.generic_pool.address)
-        initial_sfd_tokenX_balance = self.tokenX.balanceOf(
-            self.settlement_fee_disbursal
-        )
+        initial_accrued_fees = self.tokenX_options.accruedSettlementFees()
         queued_trade = self.router.queuedTrades(next_id)
         open_params_1 = [
-            queued_trade[10],
+            queued_trade[8],
             396e8,
         ]
         txn = self.router.resolveQueuedTrades(
@@ -1247,7 +1385,7 @@ class BinaryOptionTesting(object):
         )
         final_user_tokenX_balance = self.tokenX.balanceOf(self.user_1)
         final_pool_tokenX_balance = self.tokenX.balanceOf(self.generic_pool.address)
-        final_sfd_tokenX_balance = self.tokenX.balanceOf(self.settlement_fee_disbursal)
+        final_accrued_fees = self.tokenX_options.accruedSettlementFees()
         assert txn.events["OpenTrade"], "Wrong action"
         assert (
             final_user_tokenX_balance - initial_user_tokenX_balance == 882353.0
@@ -1263,7 +1401,7 @@ class BinaryOptionTesting(object):
             1117647.0,
             167647.0,
             final_pool_tokenX_balance - initial_pool_tokenX_balance,
-            final_sfd_tokenX_balance - initial_sfd_tokenX_balance,
+            final_accrued_fees - initial_accrued_fees,
             txn,
         )
 
@@ -1300,12 +1438,10 @@ class BinaryOptionTesting(object):
         )
         initial_user_tokenX_balance = self.tokenX.balanceOf(self.user_1)
         initial_pool_tokenX_balance = self.tokenX.balanceOf(self.generic_pool.address)
-        initial_sfd_tokenX_balance = self.tokenX.balanceOf(
-            self.settlement_fee_disbursal
-        )
+        initial_accrued_fees = self.tokenX_options.accruedSettlementFees()
         queued_trade = self.router.queuedTrades(4)
         open_params_1 = [
-            queued_trade[10],
+            queued_trade[8],
             400e8,
         ]
         txn = self.router.resolveQueuedTrades(
@@ -1323,7 +1459,7 @@ class BinaryOptionTesting(object):
         )
         final_user_tokenX_balance = self.tokenX.balanceOf(self.user_1)
         final_pool_tokenX_balance = self.tokenX.balanceOf(self.generic_pool.address)
-        final_sfd_tokenX_balance = self.tokenX.balanceOf(self.settlement_fee_disbursal)
+        final_accrued_fees = self.tokenX_options.accruedSettlementFees()
         assert txn.events["OpenTrade"], "Wrong action"
         assert (
             final_user_tokenX_balance - initial_user_tokenX_balance == 411765.0
@@ -1338,7 +1474,7 @@ class BinaryOptionTesting(object):
             588235.0,
             88235.0,
             final_pool_tokenX_balance - initial_pool_tokenX_balance,
-            final_sfd_tokenX_balance - initial_sfd_tokenX_balance,
+            final_accrued_fees - initial_accrued_fees,
             txn,
         )
 
@@ -1377,12 +1513,10 @@ class BinaryOptionTesting(object):
         )
         initial_user_tokenX_balance = self.tokenX.balanceOf(self.user_1)
         initial_pool_tokenX_balance = self.tokenX.balanceOf(self.generic_pool.address)
-        initial_sfd_tokenX_balance = self.tokenX.balanceOf(
-            self.settlement_fee_disbursal
-        )
+        initial_accrued_fees = self.tokenX_options.accruedSettlementFees()
         queued_trade = self.router.queuedTrades(6)
         open_params_1 = [
-            queued_trade[10],
+            queued_trade[8],
             400e8,
         ]
         txn = self.router.resolveQueuedTrades(
@@ -1400,7 +1534,7 @@ class BinaryOptionTesting(object):
         )
         final_user_tokenX_balance = self.tokenX.balanceOf(self.user_1)
         final_pool_tokenX_balance = self.tokenX.balanceOf(self.generic_pool.address)
-        final_sfd_tokenX_balance = self.tokenX.balanceOf(self.settlement_fee_disbursal)
+        final_accrued_fees = self.tokenX_options.accruedSettlementFees()
         assert txn.events["OpenTrade"], "Wrong action"
         assert (
             final_user_tokenX_balance - initial_user_tokenX_balance == 1819998
@@ -1415,7 +1549,7 @@ class BinaryOptionTesting(object):
             5180002,
             777000.0,
             final_pool_tokenX_balance - initial_pool_tokenX_balance,
-            final_sfd_tokenX_balance - initial_sfd_tokenX_balance,
+            final_accrued_fees - initial_accrued_fees,
             txn,
         )
         self.chain.revert()
@@ -1441,7 +1575,7 @@ class BinaryOptionTesting(object):
         )
         queued_trade = self.router.queuedTrades(5)
         open_params_1 = [
-            queued_trade[10],
+            queued_trade[8],
             400e8,
         ]
         txn = self.router.resolveQueuedTrades(
@@ -1486,7 +1620,7 @@ class BinaryOptionTesting(object):
         )
         queued_trade = self.router.queuedTrades(5)
         open_params_1 = [
-            queued_trade[10],
+            queued_trade[8],
             400e8,
         ]
         self.tokenX_options.toggleCreation()
@@ -1515,7 +1649,7 @@ class BinaryOptionTesting(object):
         params = []
         for option in options:
             option_data = self.tokenX_options.options(option[0])
-            close_params = (self.tokenX_options.address, option_data[5], option[1])
+            close_params = (self.tokenX_options.address, option_data[4], option[1])
             params.append(
                 (
                     option[0],
@@ -1659,6 +1793,240 @@ class BinaryOptionTesting(object):
             and exercise_events[2]["id"] == 4
         )
 
+        # All the payouts to the same user should be merged into a single transfer
+        payouts = [
+            event
+            for event in txn.events["Transfer"]
+            if event.address == self.tokenX.address
+        ]
+        users = {event["account"] for event in exercise_events}
+        assert sorted(payout["to"] for payout in payouts) == sorted(
+            users
+        ), "Payouts weren't merged"
+        assert sum(payout["value"] for payout in payouts) == sum(
+            event["profit"] for event in exercise_events
+        ), "Wrong payout"
+
+    def verify_expiry_index(self):
+        total = self.tokenX_options.nextTokenId()
+        all_options = [self.tokenX_options.options(i) for i in range(total)]
+        active = [i for i in range(total) if all_options[i][0] == 1]
+        expirations = [option[4] for option in all_options]
+        start, end = min(expirations), max(expirations)
+
+        ids, strikes, expiries, cursor = self.tokenX_options.getOptionsExpiringBetween(
+            start, end, 0, total
+        )
+        assert sorted(ids) == active, "Wrong active options"
+        assert cursor == 0, "Range not fully scanned"
+        for option_id, strike, expiry in zip(ids, strikes, expiries):
+            assert strike == all_options[option_id][1], "Wrong strike"
+            assert expiry == all_options[option_id][4], "Wrong expiration"
+
+        # Pages should add up to the full list
+        pages = []
+        cursor = 0
+        while True:
+            page, _, _, cursor = self.tokenX_options.getOptionsExpiringBetween(
+                start, end, cursor, 2
+            )
+            assert len(page) <= 2, "Wrong page size"
+            pages += list(page)
+            if cursor == 0:
+                break
+        assert pages == list(ids), "Wrong pages"
+
+        # Settling the options of a page shouldn't move the ones not returned yet
+        if len(ids) > 2:
+            self.chain.snapshot()
+            pages = []
+            cursor = 0
+            while True:
+                page, strikes, expiries, cursor = (
+                    self.tokenX_options.getOptionsExpiringBetween(start, end, cursor, 2)
+                )
+                pages += list(page)
+                expired = [
+                    (option_id, strike)
+                    for option_id, strike, expiry in zip(page, strikes, expiries)
+                    if expiry <= self.chain.time()
+                ]
+                if expired:
+                    self.unlock_options(expired)
+                if cursor == 0:
+                    break
+            assert pages == list(ids), "Options skipped after settling a page"
+            assert list(
+                self.tokenX_options.getOptionsExpiringBetween(start, end, 0, total)[0]
+            ) == [
+                option_id
+                for option_id in ids
+                if expirations[option_id] > self.chain.time()
+            ], "Settled options returned"
+            self.chain.revert()
+
+        # A call reads a bounded number of buckets, empty ones included
+        bucket_size = self.tokenX_options.EXPIRY_BUCKET_SIZE()
+        max_scan = self.tokenX_options.MAX_EXPIRY_QUERY_SCAN()
+        early_start = start - max_scan * bucket_size
+        page, _, _, cursor = self.tokenX_options.getOptionsExpiringBetween(
+            early_start, end, 0, total
+        )
+        assert not page, "Too many buckets scanned"
+        assert cursor == (early_start // bucket_size + max_scan) << 128
+        pages = []
+        while cursor != 0:
+            page, _, _, cursor = self.tokenX_options.getOptionsExpiringBetween(
+                early_start, end, cursor, total
+            )
+            pages += list(page)
+        assert pages == list(ids), "Wrong pages after the empty buckets"
+
+        # Options outside the range should be filtered out
+        ids = self.tokenX_options.getOptionsExpiringBetween(end, end, 0, total)[0]
+        assert sorted(ids) == [i for i in active if expirations[i] == end]
+        assert not self.tokenX_options.getOptionsExpiringBetween(
+            end + 1, end + 10 * 60, 0, total
+        )[0], "Wrong range"
+
+        with brownie.reverts("O37"):
+            self.tokenX_options.getOptionsExpiringBetween(
+                start, end, 0, self.tokenX_options.MAX_EXPIRY_QUERY_LIMIT() + 1
+            )
+        with brownie.reverts("O38"):
+            self.tokenX_options.getOptionsExpiringBetween(
+                start,
+                start + self.tokenX_options.MAX_EXPIRY_QUERY_RANGE() + 1,
+                0,
+                total,
+            )
+
+    def get_active_option_ids(self, user):
+        return [
+            self.tokenX_options.userActiveOptionIds(user, i)
+            for i in range(self.tokenX_options.userActiveOptionCount(user))
+        ]
+
+    def verify_user_options(self):
+        reader = OptionReader.deploy(self.generic_pool.address, {"from": self.owner})
+        total = self.tokenX_options.nextTokenId()
+        states = [self.tokenX_options.options(i)[0] for i in range(total)]
+        active = [i for i in range(total) if states[i] == 1]
+
+        for user in self.accounts[:8]:
+            count = self.tokenX_options.userOptionCount(user)
+            history = [
+                self.tokenX_options.userOptionIds(user, i) for i in range(count)
+            ][::-1]
+            option_ids, options = reader.getUserOptions(
+                self.tokenX_options.address, user, 0, count + 1, False
+            )
+            assert list(option_ids) == history, "Wrong history"
+            for option_id, option in zip(option_ids, options):
+                assert option == self.tokenX_options.options(option_id)
+
+            # Pages should add up to the full list
+            first_page = reader.getUserOptions(
+                self.tokenX_options.address, user, 0, 2, False
+            )[0]
+            second_page = reader.getUserOptions(
+                self.tokenX_options.address, user, 2, count, False
+            )[0]
+            assert list(first_page) + list(second_page) == history, "Wrong pages"
+
+            held = [i for i in active if self.tokenX_options.ownerOf(i) == user]
+            active_ids = self.get_active_option_ids(user)
+            assert sorted(active_ids) == held, "Wrong active index"
+
+            # The active options are paged from the end of the unsorted index
+            active_count = len(active_ids)
+            assert (
+                list(
+                    reader.getUserOptions(
+                        self.tokenX_options.address, user, 0, total, True
+                    )[0]
+                )
+                == active_ids[::-1]
+            ), "Wrong active options"
+            pages = [
+                reader.getUserOptions(
+                    self.tokenX_options.address, user, offset, 2, True
+                )[0]
+                for offset in range(0, active_count + 1, 2)
+            ]
+            assert [option_id for page in pages for option_id in page] == active_ids[
+                ::-1
+            ], "Wrong active pages"
+
+        # The active index follows the holder of the option
+        if active:
+            self.chain.snapshot()
+            option_id = active[0]
+            holder = self.tokenX_options.ownerOf(option_id)
+            self.tokenX_options.transferFrom(
+                holder, self.user_7, option_id, {"from": holder}
+            )
+            assert option_id not in self.get_active_option_ids(holder)
+            assert option_id in self.get_active_option_ids(self.user_7)
+            self.chain.revert()
+
+    def verify_settlement_fee_sweep(self):
+        self.chain.snapshot()
+        accrued_fees = self.tokenX_options.accruedSettlementFees()
+        assert accrued_fees > 0, "Settlement fees weren't accrued"
+        assert (
+            self.tokenX.balanceOf(self.tokenX_options.address) >= accrued_fees
+        ), "Wrong option balance"
+
+        # Anyone can sweep and the fees go to the configured contract only
+        initial_sfd_balance = self.tokenX.balanceOf(self.settlement_fee_disbursal)
+        txn = self.tokenX_options.sweepSettlementFees(False, {"from": self.user_1})
+        assert (
+            self.tokenX.balanceOf(self.settlement_fee_disbursal) - initial_sfd_balance
+            == accrued_fees
+        ), "Wrong settlement fee transferred"
+        assert txn.events["SweepSettlementFees"]["amount"] == accrued_fees
+        assert self.tokenX_options.accruedSettlementFees() == 0, "Fees not cleared"
+
+        # Sweeping again shouldn't move anything
+        txn = self.tokenX_options.sweepSettlementFees(False, {"from": self.user_1})
+        assert txn.events["SweepSettlementFees"]["amount"] == 0
+        assert (
+            self.tokenX.balanceOf(self.settlement_fee_disbursal) - initial_sfd_balance
+            == accrued_fees
+        ), "Fees swept twice"
+        self.chain.revert()
+
+        # The distribution can be triggered in the same transaction
+        self.chain.snapshot()
+        distributor = SettlementFeeDistributor.deploy(
+            self.tokenX.address,
+            self.user_6,
+            self.user_7,
+            {"from": self.owner},
+        )
+        self.options_config.setSettlementFeeDisbursalContract(
+            distributor.address, {"from": self.owner}
+        )
+        # Top up the distributor above its distribution threshold
+        initial_distributor_balance = int(10e6)
+        self.tokenX.transfer(
+            distributor.address, initial_distributor_balance, {"from": self.owner}
+        )
+        initial_balances = [
+            self.tokenX.balanceOf(account) for account in [self.user_6, self.user_7]
+        ]
+        self.tokenX_options.sweepSettlementFees(True, {"from": self.user_1})
+        bfr_amount, blp_amount = [
+            self.tokenX.balanceOf(account) - initial
+            for account, initial in zip([self.user_6, self.user_7], initial_balances)
+        ]
+        distributed = initial_distributor_balance + accrued_fees
+        assert bfr_amount + blp_amount == distributed, "Fees not distributed"
+        assert bfr_amount == distributed * 4000 // 10000, "Wrong split"
+        assert self.tokenX.balanceOf(distributor.address) == 0
+        self.chain.revert()
+
     def verify_asset_utilization_limit(self):
         self.chain.snapshot()
         self.tokenX.approve(self.generic_pool.address, 100e6, {"from": self.owner})
@@ -1712,22 +2080,22 @@ class BinaryOptionTesting(object):
         # Trade 1,2,3 use the max utilization(10%) of asset A so trade 4 should cancel
         queued_trade = self.router.queuedTrades(next_id)
         open_params_1 = [
-            queued_trade[10],
+            queued_trade[8],
             self.expected_strike,
         ]
         queued_trade = self.router.queuedTrades(next_id + 1)
         open_params_2 = [
-            queued_trade[10],
+            queued_trade[8],
             self.expected_strike,
         ]
         queued_trade = self.router.queuedTrades(next_id + 2)
         open_params_3 = [
-            queued_trade[10],
+            queued_trade[8],
             self.expected_strike,
         ]
         queued_trade = self.router.queuedTrades(next_id + 3)
         open_params_4 = [
-            queued_trade[10],
+            queued_trade[8],
             self.expected_strike,
         ]
         txn = self.router.resolveQueuedTrades(
@@ -1811,7 +2179,7 @@ class BinaryOptionTesting(object):
 
         queued_trade = self.router.queuedTrades(next_id)
         open_params_2 = [
-            queued_trade[10],
+            queued_trade[8],
             self.expected_strike,
         ]
         txn = self.router.resolveQueuedTrades(
@@ -1847,7 +2215,7 @@ class BinaryOptionTesting(object):
         )
         queued_trade = self.router.queuedTrades(next_id)
         open_params_2 = [
-            queued_trade[10],
+            queued_trade[8],
             self.expected_strike,
         ]
         txn = self.router.resolveQueuedTrades(
@@ -1924,7 +2292,7 @@ class BinaryOptionTesting(object):
 
         queued_trade = self.router.queuedTrades(next_id)
         open_params_2 = [
-            queued_trade[10],
+            queued_trade[8],
             self.expected_strike,
         ]
         txn = self.router.resolveQueuedTrades(
@@ -1967,15 +2335,16 @@ class BinaryOptionTesting(object):
                     True,
                     self.total_fee,
                     self.user_1,
-                    "1e6",
+                    "0x" + "00" * 32,
                     0,
                 ),
-                False,
+                (ADDRESS_0, False, 0, 0),
                 int(time.time()),
                 {"from": self.accounts[0]},
             )
 
         self.verify_forex_option_trading_window()
+        self.verify_forex_market_sessions()
         # self.verify_fake_referral_protection()
         self.verify_creation_with_referral_and_nft()
         self.verify_creation_with_referral_and_no_nft()
@@ -2008,9 +2377,14 @@ class BinaryOptionTesting(object):
         assert txn.events["FailUnlock"]["reason"] == "O4", "Wrong action"
 
         self.chain.sleep(self.period + 1)
+        self.verify_expiry_index()
+        self.verify_user_options()
         self.verify_unlocking_ITM()
         self.verify_unlocking_OTM_and_ATM()
         self.verify_unlocking_multiple_options_at_once()
+        self.verify_expiry_index()
+        self.verify_user_options()
+        self.verify_settlement_fee_sweep()
         self.verify_asset_utilization_limit()
         self.verify_overall_utilization_limit()
 
@@ -2063,3 +2437,89 @@ def test_BinaryOptions(contracts, accounts, chain):
         settlement_fee_disbursal,
     )
     option.complete_flow_test()
+
+
+def test_option_reader_markets(contracts, accounts, chain):
+    tokenX = contracts["tokenX"]
+    binary_pool_atm = contracts["binary_pool_atm"]
+    owner = accounts[0]
+    user = accounts[1]
+    markets = [
+        contracts["binary_european_options_atm"],
+        contracts["binary_european_options_atm_2"],
+        contracts["bfr_binary_european_options_atm"],
+    ]
+    reader = OptionReader.deploy(binary_pool_atm.address, {"from": owner})
+
+    tokenX.approve(binary_pool_atm.address, 100e6, {"from": owner})
+    binary_pool_atm.provide(100e6, 0, {"from": owner})
+    contracts["binary_options_config_atm_2"].setAssetUtilizationLimit(
+        5e2, {"from": owner}
+    )
+
+    # A single call should match the per market reads
+    data = reader.getMarketsData([market.address for market in markets], 0, "", user)
+    assert len(data) == len(markets)
+    for market, market_data in zip(markets, data):
+        if market.pool() == binary_pool_atm.address:
+            expected_max_fees = reader.calculateMaxAmount(market.address, 0, "", user)
+            assert market_data[4] == market.getMaxUtilization()
+        else:
+            # The BFR pool is empty
+            expected_max_fees = (0, 0)
+            assert market_data[4] == 0
+        assert market_data[:2] == expected_max_fees, "Wrong max fees"
+        assert market_data[2:4] == (
+            reader.getPayout(market.address, "", user, 0, True),
+            reader.getPayout(market.address, "", user, 0, False),
+        ), "Wrong payouts"
+    assert data[0][4] != data[1][4], "Markets should have their own limits"
+
+
+def test_trader_nft_tier_cache(contracts, accounts, chain):
+    tokenX = contracts["tokenX"]
+    binary_pool_atm = contracts["binary_pool_atm"]
+    options = contracts["binary_european_options_atm"]
+    options_config = contracts["binary_options_config_atm"]
+    fake_nft = contracts["trader_nft_contract"]
+    owner = accounts[0]
+    user = accounts[1]
+    base_fee_percentage = 15e2
+    step_size = options.stepSize()
+
+    chain.snapshot()
+    tokenX.approve(binary_pool_atm.address, 100e6, {"from": owner})
+    binary_pool_atm.provide(100e6, 0, {"from": owner})
+    fake_nft.claim({"from": user, "value": "2 ether"})
+    nft_id = fake_nft.safeMint(
+        user, "QmRu61jShPgiQp33UA5RNcULAvLU5JEPbnXGqEtBmVcdMg", 0, 0, {"from": owner}
+    ).return_value
+    trader_nft = TraderNFT.deploy(fake_nft.address, {"from": owner})
+    options_config.settraderNFTContract(trader_nft.address, {"from": owner})
+
+    def settlement_fee_percentage(account):
+        params = (0, 0, 300, True, True, 1e6, account, "0x" + "00" * 32, nft_id)
+        txn = options.checkParams(params, {"from": owner})
+        return txn.return_value[2][2]
+
+    # The tier is cached by the first trade and reused until the next update
+    trader_nft.updateTokenTier([nft_id], [2], [1], {"from": owner})
+    expected = base_fee_percentage - step_size * options.nftTierStep(2)
+    assert settlement_fee_percentage(user) == expected
+    assert settlement_fee_percentage(user) == expected
+
+    # Updating the tiers bumps the epoch which invalidates the cached tier
+    trader_nft.updateTokenTier([nft_id], [3], [2], {"from": owner})
+    assert trader_nft.tierEpoch() == 2
+    expected = base_fee_percentage - step_size * options.nftTierStep(3)
+    assert settlement_fee_percentage(user) == expected, "Stale tier"
+    assert options._getSettlementFeeDiscount(ADDRESS_0, user, nft_id) == (
+        False,
+        options.nftTierStep(3),
+    )
+
+    # The ownership is checked even when the tier is cached
+    fake_nft.transferFrom(user, accounts[2], nft_id, {"from": user})
+    assert settlement_fee_percentage(user) == base_fee_percentage
+    assert settlement_fee_percentage(accounts[2]) == expected
+    chain.revert()
@@ -0,0 +1,82 @@
+import re
+from pathlib import Path
+
+import numpy as np
+from brownie import OptionMath
+from scripts.option_pricing import (
+    black_scholes_price_binary,
+    black_scholes_price_binary_fast,
+    cdf_table,
+    exact_price_binary,
+    pack_table,
+)
+
+STRIKE = 2000e8
+IMPLIED_VOLS = [3e3, 1e4, 2e4]
+PERIODS = [60, 300, 3600, 4 * 3600, 86400]
+FAST_PRICE_ERROR = 1e-5  # Error of the interpolated CDF
+CURRENT_PRICE_ERROR = 2e-4  # Error of Choudhury's approximation
+# Deep ITM/OTM spots whose log moneyness is computed by the ABDK ln fallback
+# of OptionMath._ln, as |(spot - strike) / (spot + strike)| > 1/8
+DEEP_MONEYNESS = [-0.8, -0.5, 0.5, 0.8]
+
+
+def _grid(moneyness):
+    """
+    Returns the (implied_vol, strike, spot, period, is_above) grid as flat arrays
+    """
+    implied_vol, spot, period, is_above = np.meshgrid(
+        IMPLIED_VOLS, STRIKE * (1 + moneyness), PERIODS, [True, False]
+    )
+    return (
+        implied_vol.ravel(),
+        np.full(implied_vol.size, STRIKE),
+        np.round(spot.ravel()),
+        period.ravel(),
+        is_above.ravel(),
+    )
+
+
+def test_option_math_tables():
+    source = (
+        Path(__file__).parent.parent / "contracts" / "Libraries" / "OptionMath.sol"
+    ).read_text()
+    cdf, pdf = cdf_table()
+    for name, values in (("CDF", cdf), ("PDF", pdf)):
+        for index, word in enumerate(pack_table(values)):
+            constant = re.search(rf"{name}_TABLE_{index} =\s+(0x[0-9a-f]+);", source)
+            assert int(constant.group(1), 16) == word, f"Stale {name}_TABLE_{index}"
+
+
+def test_fast_pricing_error_bound():
+    grid = _grid(np.linspace(-0.25, 0.25, 2001))
+    exact = exact_price_binary(*grid)
+
+    fast_error = np.abs(black_scholes_price_binary_fast(*grid) - exact)
+    assert np.max(fast_error) < FAST_PRICE_ERROR
+    current_error = np.abs(black_scholes_price_binary(*grid) - exact)
+    assert np.max(current_error) < CURRENT_PRICE_ERROR
+
+
+def test_fast_pricing_on_chain(contracts):
+    option_math = OptionMath[-1]
+    grid = _grid(np.concatenate([np.linspace(-0.3, 0.3, 11), DEEP_MONEYNESS]))
+    exact = exact_price_binary(*grid) * 1e8
+    reference = black_scholes_price_binary_fast(*grid) * 1e8
+
+    volatility_terms = {
+        implied_vol: option_math.volatilityPerSqrtSecond(implied_vol)
+        for implied_vol in IMPLIED_VOLS
+    }
+    for index, (implied_vol, strike, spot, period, is_above) in enumerate(zip(*grid)):
+        params = (int(strike), int(spot), int(period))
+        fast = option_math.blackScholesPriceBinaryFast(
+            volatility_terms[implied_vol], *params, bool(is_above)
+        )
+        current = option_math.blackScholesPriceBinary(
+            int(implied_vol), *params, True, bool(is_above)
+        )
+
+        assert abs(fast - reference[index]) < 10, "Wrong fixed point math"
+        assert abs(fast - exact[index]) < FAST_PRICE_ERROR * 1e8
+        assert abs(fast - current) < (FAST_PRICE_ERROR + CURRENT_PRICE_ERROR) * 1e8
@@ -1,4 +1,5 @@
 import brownie
+import pytest
 
 
 def test_binary_pool(contracts, accounts, chain):
@@ -367,3 +368,201 @@ def test_binary_pool(contracts, accounts, chain):
     binary_pool_atm.setMaxLiquidity(
         binary_pool_atm.totalTokenXBalance() + 1e6, {"from": owner}
     )
+
+
+@pytest.mark.benchmark
+def test_binary_pool_lockup_gas(contracts, accounts, chain):
+    tokenX = contracts["tokenX"]
+    binary_pool_atm = contracts["binary_pool_atm"]
+    owner = accounts[0]
+    user_1 = accounts[1]
+    user_2 = accounts[2]
+    user_3 = accounts[3]
+    deposits = 1000
+    amount = 100
+    lockup_period = binary_pool_atm.lockupPeriod()
+
+    for user in [user_1, user_2]:
+        tokenX.transfer(user, amount * deposits, {"from": owner})
+        tokenX.approve(binary_pool_atm.address, amount * deposits, {"from": user})
+
+    # Half of the deposits of user_1 unlock while the other half stays locked
+    for _ in range(deposits // 2):
+        binary_pool_atm.provide(amount, 0, {"from": user_1})
+    binary_pool_atm.provide(amount, 0, {"from": user_2})
+    chain.sleep(lockup_period + 1)
+    for _ in range(deposits // 2):
+        binary_pool_atm.provide(amount, 0, {"from": user_1})
+    binary_pool_atm.provide(amount, 0, {"from": user_2})
+
+    assert binary_pool_atm.getUnlockedLiquidity(user_1) == amount * (
+        deposits // 2
+    ), "Wrong unlocked amount"
+    assert binary_pool_atm.getUnlockedLiquidity(user_2) == amount
+
+    # Transfers have to find the unlocked deposits of the sender
+    many_deposits = binary_pool_atm.transfer(user_3, amount, {"from": user_1})
+    few_deposits = binary_pool_atm.transfer(user_3, amount, {"from": user_2})
+    print(
+        f"Transfer gas with {deposits} deposits: {many_deposits.gas_used}",
+        f"with 2 deposits: {few_deposits.gas_used}",
+    )
+    assert (
+        many_deposits.gas_used - few_deposits.gas_used < 50000
+    ), "Lockup tracking shouldn't be linear in the number of deposits"
+    assert binary_pool_atm.liquidityPerUser(user_1) == (
+        amount * (deposits // 2 - 1),
+        deposits // 2,
+    ), "Wrong liquidity state"
+
+    # The locked deposits unlock all at once without walking them
+    chain.sleep(lockup_period + 1)
+    withdrawal = binary_pool_atm.withdraw(amount * (deposits - 1), {"from": user_1})
+    print(f"Withdrawal gas with {deposits} deposits: {withdrawal.gas_used}")
+    assert binary_pool_atm.balanceOf(user_1) == 0, "Wrong balance"
+    assert binary_pool_atm.liquidityPerUser(user_1) == (0, deposits)
+
+
+def test_binary_pool_deposit_coalescing(contracts, accounts, chain):
+    tokenX = contracts["tokenX"]
+    binary_pool_atm = contracts["binary_pool_atm"]
+    owner = accounts[0]
+    user_1 = accounts[1]
+    user_2 = accounts[2]
+    deposits = 10
+    amount = 100
+    lockup_period = binary_pool_atm.lockupPeriod()
+
+    with brownie.reverts():  # Wrong role
+        binary_pool_atm.setDepositBucketSize(lockup_period, {"from": user_1})
+    with brownie.reverts("Pool: Bucket size is greater than the lockup period"):
+        binary_pool_atm.setDepositBucketSize(lockup_period + 1, {"from": owner})
+    txn = binary_pool_atm.setDepositBucketSize(lockup_period, {"from": owner})
+    assert txn.events["UpdateDepositBucketSize"]["depositBucketSize"] == lockup_period
+    assert binary_pool_atm.depositBucketSize() == lockup_period
+
+    tokenX.transfer(user_1, amount * deposits * 2, {"from": owner})
+    tokenX.approve(binary_pool_atm.address, amount * deposits * 2, {"from": user_1})
+
+    # Deposits made within the same bucket are merged into a single lockup
+    chain.sleep(lockup_period - (chain.time() % lockup_period) + 1)
+    for _ in range(deposits):
+        binary_pool_atm.provide(amount, 0, {"from": user_1})
+    assert binary_pool_atm.getUnlockedLiquidity(user_1) == 0
+
+    chain.sleep(lockup_period + 1)
+    assert binary_pool_atm.getUnlockedLiquidity(user_1) == amount * deposits
+    binary_pool_atm.transfer(user_2, amount, {"from": user_1})
+    assert binary_pool_atm.liquidityPerUser(user_1) == (
+        amount * (deposits - 1),
+        1,
+    ), "Deposits weren't merged"
+
+    # Deposits of another bucket get a lockup of their own
+    for _ in range(deposits):
+        binary_pool_atm.provide(amount, 0, {"from": user_1})
+    assert binary_pool_atm.getUnlockedLiquidity(user_1) == amount * (deposits - 1)
+    chain.sleep(lockup_period + 1)
+    binary_pool_atm.transfer(user_2, amount, {"from": user_1})
+    assert binary_pool_atm.liquidityPerUser(user_1) == (
+        amount * (2 * deposits - 2),
+        2,
+    ), "Deposits weren't merged"
+
+
+def test_binary_pool_withdrawal_queue(contracts, accounts, chain):
+    tokenX = contracts["tokenX"]
+    binary_pool_atm = contracts["binary_pool_atm"]
+    owner = accounts[0]
+    user_1 = accounts[1]
+    user_2 = accounts[2]
+    user_3 = accounts[3]
+    amount = int(1000e6)
+    lockup_period = binary_pool_atm.lockupPeriod()
+
+    for user in [user_1, user_3]:
+        tokenX.transfer(user, amount, {"from": owner})
+        tokenX.approve(binary_pool_atm.address, amount, {"from": user})
+        binary_pool_atm.provide(amount, 0, {"from": user})
+
+    # Options lock most of the pool
+    binary_pool_atm.grantRole(
+        binary_pool_atm.OPTION_ISSUER_ROLE(), user_2, {"from": owner}
+    )
+    binary_pool_atm.lockDeferred(0, int(1900e6), 0, {"from": user_2})
+    assert binary_pool_atm.availableBalance() == int(100e6)
+
+    with brownie.reverts("Pool: Transfer of funds in lock in period is blocked"):
+        binary_pool_atm.requestWithdrawal(int(600e6), {"from": user_1})
+    chain.sleep(lockup_period + 1)
+    with brownie.reverts(
+        "Pool: Not enough funds on the pool contract. Please lower the amount."
+    ):
+        binary_pool_atm.withdraw(int(600e6), {"from": user_1})
+    with brownie.reverts("Pool: Amount is too small"):
+        binary_pool_atm.requestWithdrawal(0, {"from": user_1})
+    with brownie.reverts("Pool: Amount can be withdrawn directly"):
+        binary_pool_atm.requestWithdrawal(int(100e6), {"from": user_1})
+    with brownie.reverts("Pool: Use requestWithdrawal"):
+        binary_pool_atm.transfer(binary_pool_atm.address, 1, {"from": user_1})
+
+    # Requests hold the BLP until they are filled
+    txn = binary_pool_atm.requestWithdrawal(int(600e6), {"from": user_1})
+    assert txn.events["RequestWithdrawal"]["id"] == 0
+    binary_pool_atm.requestWithdrawal(int(300e6), {"from": user_3})
+    assert binary_pool_atm.balanceOf(user_1) == int(400e6), "BLP not held"
+    assert binary_pool_atm.balanceOf(binary_pool_atm.address) == int(900e6)
+    assert binary_pool_atm.totalPendingWithdrawal() == int(900e6)
+    assert binary_pool_atm.withdrawalQueuePosition(0) == 0
+    assert binary_pool_atm.withdrawalQueuePosition(1) == 1
+
+    # Cancelled requests don't count in the queue positions
+    chain.snapshot()
+    txn = binary_pool_atm.requestWithdrawal(int(100e6), {"from": user_3})
+    assert binary_pool_atm.withdrawalQueuePosition(txn.return_value) == 2
+    binary_pool_atm.cancelWithdrawalRequest(1, {"from": user_3})
+    assert binary_pool_atm.withdrawalQueuePosition(txn.return_value) == 1
+    chain.revert()
+
+    with brownie.reverts("Pool: forbidden"):
+        binary_pool_atm.cancelWithdrawalRequest(0, {"from": user_3})
+
+    # The first request is partially filled with the available balance
+    initial_balance = tokenX.balanceOf(user_1)
+    txn = binary_pool_atm.processWithdrawals(10, {"from": owner})
+    assert txn.return_value == 0, "Request shouldn't be complete"
+    assert tokenX.balanceOf(user_1) - initial_balance == int(100e6)
+    assert txn.events["Withdraw"]["writeAmount"] == int(100e6)
+    assert binary_pool_atm.withdrawalRequests(0) == (user_1, int(500e6))
+    assert binary_pool_atm.totalPendingWithdrawal() == int(800e6)
+
+    # Direct withdrawals can't jump the queue
+    with brownie.reverts(
+        "Pool: Not enough funds on the pool contract. Please lower the amount."
+    ):
+        binary_pool_atm.withdraw(1, {"from": user_1})
+
+    # Unlocked liquidity goes to the requests in order
+    binary_pool_atm.unlock(0, {"from": user_2})
+    txn = binary_pool_atm.processWithdrawals(1, {"from": owner})
+    assert txn.return_value == 1
+    assert tokenX.balanceOf(user_1) - initial_balance == int(600e6)
+    assert binary_pool_atm.firstPendingWithdrawalRequestId() == 1
+    assert binary_pool_atm.withdrawalQueuePosition(1) == 0
+    with brownie.reverts("Pool: Request isn't pending"):
+        binary_pool_atm.withdrawalQueuePosition(0)
+
+    # Cancelled requests return the BLP and are skipped
+    txn = binary_pool_atm.cancelWithdrawalRequest(1, {"from": user_3})
+    assert txn.events["CancelWithdrawal"]["amount"] == int(300e6)
+    assert binary_pool_atm.balanceOf(user_3) == amount
+    assert binary_pool_atm.getUnlockedLiquidity(user_3) == amount
+    assert binary_pool_atm.totalPendingWithdrawal() == 0
+    with brownie.reverts("Pool: Request isn't pending"):
+        binary_pool_atm.cancelWithdrawalRequest(1, {"from": user_3})
+
+    txn = binary_pool_atm.processWithdrawals(10, {"from": owner})
+    assert txn.return_value == 1
+    assert binary_pool_atm.firstPendingWithdrawalRequestId() == 2
+    assert binary_pool_atm.balanceOf(binary_pool_atm.address) == 0
+    binary_pool_atm.withdraw(int(400e6), {"from": user_1})
@@ -2,9 +2,18 @@ import time
 from enum import IntEnum
 
 import brownie
-from brownie import BufferBinaryOptions
+import pytest
+from brownie import (
+    BlacklistUSDC,
+    BufferBinaryOptions,
+    BufferBinaryPool,
+    FakeBinaryOptions,
+    OptionsConfig,
+    web3,
+)
 from eth_account import Account
 from eth_account.messages import encode_defunct
+from scripts.packed_calldata import encode_close_trades, encode_open_trades
 
 
 class OptionType(IntEnum):
@@ -66,7 +75,7 @@ class Router(object):
         self.expected_strike = int(400e8)
         self.slippage = 100
         self.allow_partial_fill = False
-        self.index = 11
+        self.index = 9
         # self.is_trader_nft = False
         self.referral_code = "code123"
         self.trader_id = 0
@@ -96,6 +105,40 @@ class Router(object):
             self.tokenX_options.DEFAULT_ADMIN_ROLE(), self.accounts[0]
         ), "The admin of the contract should be the account the contract was deployed by"
 
+    def get_queued_trade_data(self, trade):
+        # Reorders the packed QueuedTrade fields like the initiateTrade params
+        (
+            queue_id,
+            user_queue_index,
+            user,
+            is_above,
+            allow_partial_fill,
+            target_contract,
+            period,
+            slippage,
+            _,
+            _,
+            total_fee,
+            expected_strike,
+            trader_nft_id,
+            referral_code_hash,
+        ) = trade
+        assert referral_code_hash == web3.keccak(text=self.referral_code).hex()
+        return [
+            queue_id,
+            user_queue_index,
+            user,
+            total_fee,
+            period,
+            is_above,
+            target_contract,
+            expected_strike,
+            slippage,
+            allow_partial_fill,
+            self.referral_code,
+            trader_nft_id,
+        ]
+
     def verify_target_contract_registration(self):
         with brownie.reverts("Router: Unauthorized contract"):
             self.router.initiateTrade(
@@ -130,6 +173,87 @@ class Router(object):
 
         return to_32byte_hex(signed_message.signature)
 
+    def get_price_root(self, entries, publisher=None):
+        # Builds a merkle tree over the (token, timestamp, price) entries using
+        # sorted pair hashing and signs its root with the publisher key
+        web3 = brownie.network.web3
+        key = self.publisher.private_key if not publisher else publisher.private_key
+        leaves = [
+            bytes(
+                web3.solidityKeccak(
+                    ["string", "uint256", "uint256"],
+                    [BufferBinaryOptions.at(token).assetPair(), timestamp, int(price)],
+                )
+            )
+            for token, timestamp, price in entries
+        ]
+        layers = [leaves]
+        while len(layers[-1]) > 1:
+            layer = layers[-1]
+            next_layer = []
+            for i in range(0, len(layer), 2):
+                if i + 1 == len(layer):
+                    next_layer.append(layer[i])
+                else:
+                    left, right = sorted(layer[i : i + 2])
+                    next_layer.append(bytes(web3.keccak(left + right)))
+            layers.append(next_layer)
+        root = layers[-1][0]
+
+        proofs = []
+        for index in range(len(leaves)):
+            proof = []
+            for layer in layers[:-1]:
+                if index ^ 1 < len(layer):
+                    proof.append(web3.toHex(layer[index ^ 1]))
+                index //= 2
+            proofs.append(proof)
+
+        signed_message = Account.sign_message(encode_defunct(root), key)
+        return web3.toHex(root), web3.toHex(signed_message.signature), proofs
+
+    def _queue_trades(
+        self,
+        count,
+        options=None,
+        total_fee=None,
+        prices=None,
+        referral_code=None,
+        user=None,
+        token=None,
+    ):
+        # Queues count trades and returns the params to open them at the prices,
+        # the expected strike by default
+        options = options or self.tokenX_options
+        total_fee = total_fee or self.total_fee
+        prices = prices or [self.expected_strike] * count
+        if referral_code is None:
+            referral_code = self.referral_code
+        user = user or self.owner
+        token = token or self.tokenX
+
+        token.approve(self.router.address, total_fee * count, {"from": user})
+        open_params = []
+        for price in prices:
+            txn = self.router.initiateTrade(
+                total_fee,
+                self.period,
+                self.is_above,
+                options.address,
+                self.expected_strike,
+                self.slippage,
+                self.allow_partial_fill,
+                referral_code,
+                0,
+                {"from": user},
+            )
+            queue_id = txn.events["InitiateTrade"]["queueId"]
+            _params = [self.router.queuedTrades(queue_id)[8], price]
+            open_params.append(
+                (queue_id, *_params, self.get_signature(options.address, *_params))
+            )
+        return open_params
+
     def verify_multitoken_router(self):
         self.chain.snapshot()
         self.tokenX.approve(self.router.address, self.total_fee, {"from": self.owner})
@@ -196,12 +320,12 @@ class Router(object):
         )
         queued_trade = self.router.queuedTrades(8)
         open_params_1 = [
-            queued_trade[10],
+            queued_trade[8],
             self.expected_strike,
         ]
         queued_trade = self.router.queuedTrades(9)
         open_params_2 = [
-            queued_trade[10],
+            queued_trade[8],
             self.expected_strike,
         ]
 
@@ -320,11 +444,14 @@ class Router(object):
         final_user_tokenX_balance = self.tokenX.balanceOf(self.user_1)
         final_router_tokenX_balance = self.tokenX.balanceOf(self.router.address)
 
-        trade = list(self.router.queuedTrades(0))
-
-        trade.pop(10)
-        trade.pop(10)
-        assert trade == [0, 0, self.user_1, *params], "Wrong data"
+        trade = self.router.queuedTrades(0)
+        assert trade[8] == txn.timestamp and trade[9], "Wrong state"
+        assert self.get_queued_trade_data(trade) == [
+            0,
+            0,
+            self.user_1,
+            *params,
+        ], "Wrong data"
         assert (
             initial_user_tokenX_balance - final_user_tokenX_balance == self.total_fee
         ) and (
@@ -340,10 +467,13 @@ class Router(object):
             *params,
             {"from": self.owner},
         )
-        trade = list(self.router.queuedTrades(1))
-        trade.pop(10)
-        trade.pop(10)
-        assert trade == [1, 0, self.owner, *params], "Wrong data"
+        trade = self.router.queuedTrades(1)
+        assert self.get_queued_trade_data(trade) == [
+            1,
+            0,
+            self.owner,
+            *params,
+        ], "Wrong data"
         assert self.router.nextQueueId() == 2, "Wrong QueueId"
         assert self.router.userQueueCount(self.owner) == 1, "Wrong data"
         assert self.router.userQueueCount(self.user_1) == 1, "Wrong data"
@@ -418,7 +548,7 @@ class Router(object):
         assert self.router.queuedTrades(1)[self.index], "Wrong value"
         queued_trade = self.router.queuedTrades(1)
         open_params = [
-            queued_trade[10],
+            queued_trade[8],
             404e8 + 1,
         ]
         txn = self.router.resolveQueuedTrades(
@@ -447,7 +577,7 @@ class Router(object):
         assert self.router.queuedTrades(1)[self.index], "Wrong value"
         queued_trade = self.router.queuedTrades(1)
         open_params = [
-            queued_trade[10],
+            queued_trade[8],
             396e8 - 1,
         ]
         txn = self.router.resolveQueuedTrades(
@@ -476,7 +606,7 @@ class Router(object):
         self.chain.snapshot()
         queued_trade = self.router.queuedTrades(1)
         open_params = [
-            queued_trade[10],
+            queued_trade[8],
             396e8,
         ]
         txn = self.router.resolveQueuedTrades(
@@ -500,7 +630,7 @@ class Router(object):
         initial_user_tokenX_balance = self.tokenX.balanceOf(self.user_1)
         queued_trade = self.router.queuedTrades(1)
         open_params = [
-            queued_trade[10],
+            queued_trade[8],
             404e8,
         ]
         txn = self.router.resolveQueuedTrades(
@@ -550,7 +680,7 @@ class Router(object):
         self.chain.snapshot()
         queued_trade = self.router.queuedTrades(2)
         open_params = [
-            queued_trade[10],
+            queued_trade[8],
             404e8,
         ]
         initial_user_tokenX_balance = self.tokenX.balanceOf(self.user_2)
@@ -574,7 +704,7 @@ class Router(object):
         assert final_router_tokenX_balance == 0, "Wrong router balance"
         assert (
             final_user_tokenX_balance - initial_user_tokenX_balance
-        ) == self.total_fee - self.tokenX_options.options(1)[7], "Wrong user balance"
+        ) == self.total_fee - self.tokenX_options.options(1)[6], "Wrong user balance"
         assert txn.events["OpenTrade"], "Trade should have been cancelled"
 
         self.chain.revert()
@@ -615,11 +745,11 @@ class Router(object):
             {"from": self.user_1},
         )
         open_params = [
-            self.router.queuedTrades(3)[10],
+            self.router.queuedTrades(3)[8],
             404e8,
         ]
         open_params_1 = [
-            self.router.queuedTrades(4)[10],
+            self.router.queuedTrades(4)[8],
             404e8 + 1,
         ]
         txn = self.router.resolveQueuedTrades(
@@ -671,7 +801,7 @@ class Router(object):
             {"from": self.owner},
         )
         queued_trade = self.router.queuedTrades(5)
-        open_params_1 = [queued_trade[10], 404e8]
+        open_params_1 = [queued_trade[8], 404e8]
         txn = self.router.resolveQueuedTrades(
             [
                 (
@@ -707,7 +837,7 @@ class Router(object):
             {"from": self.owner},
         )
         queued_trade = self.router.queuedTrades(6)
-        open_params_2 = [queued_trade[10], 404e8]
+        open_params_2 = [queued_trade[8], 404e8]
         txn = self.router.resolveQueuedTrades(
             [
                 (
@@ -770,11 +900,11 @@ class Router(object):
 
         self.chain.snapshot()
         queued_trade = self.router.queuedTrades(5)
-        open_params_1 = [queued_trade[10], 404e8]
+        open_params_1 = [queued_trade[8], 404e8]
         queued_trade = self.router.queuedTrades(6)
-        open_params_2 = [queued_trade[10], 404e8]
+        open_params_2 = [queued_trade[8], 404e8]
         queued_trade = self.router.queuedTrades(7)
-        open_params_3 = [queued_trade[10], 404e8]
+        open_params_3 = [queued_trade[8], 404e8]
         txn = self.router.resolveQueuedTrades(
             [
                 (
@@ -825,17 +955,17 @@ class Router(object):
         queued_trade = self.router.queuedTrades(1)
         open_params = [
             self.tokenX_options.address,
-            queued_trade[10],
+            queued_trade[8],
             self.expected_strike,
         ]
         open_params_1 = [
             self.tokenX_options.address,
-            queued_trade[10] + 1,
+            queued_trade[8] + 1,
             self.expected_strike,
         ]
         open_params_2 = [
             self.bfr_options,
-            queued_trade[10] + 1,
+            queued_trade[8] + 1,
             self.expected_strike,
         ]
 
@@ -886,7 +1016,7 @@ class Router(object):
             [
                 (
                     1,
-                    queued_trade[10],
+                    queued_trade[8],
                     self.expected_strike,
                     self.get_signature(
                         *open_params_2,
@@ -903,7 +1033,7 @@ class Router(object):
             [
                 (
                     1,
-                    queued_trade[10],
+                    queued_trade[8],
                     self.expected_strike + 1,
                     self.get_signature(
                         *open_params,
@@ -961,15 +1091,15 @@ class Router(object):
             {"from": self.bot},
         )
         assert not txn.events, "SHouldn't change anything"
-        assert self.router.queuedTrades(1)[12], "SHouldn't change anything"
+        assert self.router.queuedTrades(1)[13], "SHouldn't change anything"
         self.chain.revert()
 
     def verify_option_unlocking(self):
         option_1 = self.tokenX_options.options(0)
         option_2 = self.tokenX_options.options(1)
 
-        close_params_1 = (self.tokenX_options.address, option_1[5], option_1[1] * 2)
-        close_params_2 = (self.tokenX_options.address, option_2[5], option_2[1] // 2)
+        close_params_1 = (self.tokenX_options.address, option_1[4], option_1[1] * 2)
+        close_params_2 = (self.tokenX_options.address, option_2[4], option_2[1] // 2)
         with brownie.reverts():  # Keeper not verified
             self.router.unlockOptions(
                 [
@@ -1015,38 +1145,659 @@ class Router(object):
             txn.events["FailUnlock"]["reason"] == "Router: Signature didn't match"
         ), "Wrong event"
 
-        # Should unlock with the right params
+        # Should unlock with the right params and skip the failing option
         self.chain.snapshot()
         user = self.tokenX_options.ownerOf(0)
         initial_user_balance = self.tokenX.balanceOf(user)
-        txn = self.router.unlockOptions(
-            [
-                (
-                    0,
+        close_params_3 = (self.tokenX_options.address, 0, option_1[1])
+        unlock_params = [
+            (
+                0,
+                *close_params_1,
+                self.get_signature(
                     *close_params_1,
-                    self.get_signature(
-                        *close_params_1,
-                    ),
                 ),
-                (
-                    1,
+            ),
+            (
+                99,
+                *close_params_3,
+                self.get_signature(
+                    *close_params_3,
+                ),
+            ),
+            (
+                1,
+                *close_params_2,
+                self.get_signature(
                     *close_params_2,
-                    self.get_signature(
-                        *close_params_2,
-                    ),
                 ),
-            ],
-            {"from": self.bot},
-        )
+            ),
+        ]
+        assert self.router.unlockOptions.call(unlock_params, {"from": self.bot}) == [
+            0b101
+        ], "Wrong status bitmap"
+        txn = self.router.unlockOptions(unlock_params, {"from": self.bot})
         final_user_balance = self.tokenX.balanceOf(user)
 
         assert txn.events["Expire"]["id"] == 1 and txn.events["Exercise"]["id"] == 0
+        assert txn.events["FailUnlock"]["optionId"] == 99
+        assert txn.events["FailUnlock"]["reason"] == "O10", "Wrong reason"
         assert (
             final_user_balance - initial_user_balance
             == txn.events["Exercise"]["profit"]
         ), "Wrong incentive"
         self.chain.revert()
 
+        # A reverting batch falls back to unlocking the options one by one
+        self.chain.snapshot()
+        self.generic_pool.revokeRole(
+            self.generic_pool.OPTION_ISSUER_ROLE(),
+            self.tokenX_options.address,
+            {"from": self.owner},
+        )
+        assert self.router.unlockOptions.call(unlock_params, {"from": self.bot}) == [
+            0
+        ], "Wrong status bitmap"
+        txn = self.router.unlockOptions(unlock_params, {"from": self.bot})
+        assert [event["optionId"] for event in txn.events["FailUnlock"]] == [99, 0, 1]
+        assert all(
+            event["reason"].startswith("AccessControl")
+            for event in list(txn.events["FailUnlock"])[1:]
+        ), "Wrong reason"
+        self.chain.revert()
+
+        # Options failing with a panic or without revert data are skipped too
+        self.chain.snapshot()
+        fake_options = FakeBinaryOptions.deploy(
+            self.tokenX_options.assetPair(), {"from": self.owner}
+        )
+        for option_id, failure_mode in ((5, 1), (6, 2), (7, 0)):
+            fake_options.createOption(option_id, option_1[4], failure_mode)
+        fake_close_params = (fake_options.address, option_1[4], option_1[1])
+        fake_unlock_params = [
+            (option_id, *fake_close_params, self.get_signature(*fake_close_params))
+            for option_id in (5, 6, 7)
+        ]
+        unlock_params = [unlock_params[0], *fake_unlock_params, unlock_params[2]]
+        assert self.router.unlockOptions.call(unlock_params, {"from": self.bot}) == [
+            0b11001
+        ], "Wrong status bitmap"
+        txn = self.router.unlockOptions(unlock_params, {"from": self.bot})
+        assert [
+            (event["optionId"], event["reason"]) for event in txn.events["FailUnlock"]
+        ] == [(5, "R1"), (6, "R2")], "Wrong reason"
+        assert txn.events["Exercise"]["id"] == 0 and txn.events["Expire"]["id"] == 1
+        assert fake_options.states(7) == 3, "Option not unlocked"
+        assert fake_options.states(5) == fake_options.states(6) == 1
+        self.chain.revert()
+
+    def verify_price_root_resolution(self):
+        self.chain.snapshot()
+        open_params = self._queue_trades(3)
+        queue_ids = [params[0] for params in open_params]
+        entries = [
+            (self.tokenX_options.address, *params[1:3]) for params in open_params
+        ]
+        root, signature, proofs = self.get_price_root(entries)
+
+        # Root signed by someone other than the publisher
+        spam_publisher = self.accounts.add()
+        _, spam_signature, _ = self.get_price_root(entries, spam_publisher)
+        with brownie.reverts("Router: Signature didn't match"):
+            self.router.resolveQueuedTradesWithProof(
+                root,
+                spam_signature,
+                [(queue_ids[0], *entries[0][1:], proofs[0])],
+                {"from": self.bot},
+            )
+
+        # Proof of a different leaf shouldn't verify
+        txn = self.router.resolveQueuedTradesWithProof(
+            root,
+            signature,
+            [(queue_ids[0], *entries[0][1:], proofs[1])],
+            {"from": self.bot},
+        )
+        assert (
+            txn.events["FailResolve"]["reason"] == "Router: Signature didn't match"
+        ), "Wrong event"
+        assert self.router.queuedTrades(queue_ids[0])[self.index], "Wrong state"
+
+        txn = self.router.resolveQueuedTradesWithProof(
+            root,
+            signature,
+            [
+                (queue_id, *entry[1:], proof)
+                for queue_id, entry, proof in zip(queue_ids, entries, proofs)
+            ],
+            {"from": self.bot},
+        )
+        assert [event["queueId"] for event in txn.events["OpenTrade"]] == queue_ids
+        option_ids = [event["id"] for event in txn.events["Create"]]
+
+        # Settle all the options with a single root signature
+        self.chain.sleep(self.period + 1)
+        close_entries = []
+        for index, option_id in enumerate(option_ids):
+            option = self.tokenX_options.options(option_id)
+            price = option[1] * 2 if index % 2 == 0 else option[1] // 2
+            close_entries.append((self.tokenX_options.address, option[4], price))
+        root, signature, proofs = self.get_price_root(close_entries)
+        txn = self.router.unlockOptionsWithProof(
+            root,
+            signature,
+            [
+                (option_id, *entry, proof)
+                for option_id, entry, proof in zip(option_ids, close_entries, proofs)
+            ],
+            {"from": self.bot},
+        )
+        assert [event["id"] for event in txn.events["Exercise"]] == option_ids[::2]
+        assert [event["id"] for event in txn.events["Expire"]] == option_ids[1::2]
+        self.chain.revert()
+
+    def verify_packed_resolution(self):
+        self.chain.snapshot()
+        open_params = self._queue_trades(2)
+
+        data = encode_open_trades(open_params)
+        assert len(data) == 2 + 2 * 2 * self.router.OPEN_TRADE_PACKED_SIZE()
+        with brownie.reverts("Router: Wrong data length"):
+            self.router.resolveQueuedTradesPacked(data[:-2], {"from": self.bot})
+
+        # Signature of a different price shouldn't verify
+        txn = self.router.resolveQueuedTradesPacked(
+            encode_open_trades(
+                [(*open_params[0][:2], self.expected_strike + 1, open_params[0][3])]
+            ),
+            {"from": self.bot},
+        )
+        assert (
+            txn.events["FailResolve"]["reason"] == "Router: Signature didn't match"
+        ), "Wrong event"
+
+        txn = self.router.resolveQueuedTradesPacked(data, {"from": self.bot})
+        assert [event["queueId"] for event in txn.events["OpenTrade"]] == [
+            params[0] for params in open_params
+        ]
+        option_ids = [event["id"] for event in txn.events["Create"]]
+
+        self.chain.sleep(self.period + 1)
+        close_params = []
+        for index, option_id in enumerate(option_ids):
+            option = self.tokenX_options.options(option_id)
+            _params = (
+                self.tokenX_options.address,
+                option[4],
+                option[1] * 2 if index == 0 else option[1] // 2,
+            )
+            close_params.append((option_id, *_params, self.get_signature(*_params)))
+        txn = self.router.unlockOptionsPacked(
+            encode_close_trades(close_params), {"from": self.bot}
+        )
+        assert txn.events["Exercise"]["id"] == option_ids[0]
+        assert txn.events["Expire"]["id"] == option_ids[1]
+        self.chain.revert()
+
+    def verify_close_anytime_with_proof(self):
+        self.chain.snapshot()
+        txn = self.router.resolveQueuedTrades(self._queue_trades(2), {"from": self.bot})
+        option_ids = [event["optionId"] for event in txn.events["OpenTrade"]]
+
+        with brownie.reverts("Only owner can close"):
+            self.router.initiateClose(
+                option_ids[0], self.tokenX_options.address, {"from": self.user_2}
+            )
+        close_ids = []
+        for option_id in option_ids:
+            close_ids.append(self.router.nextCloseId())
+            self.router.initiateClose(
+                option_id, self.tokenX_options.address, {"from": self.owner}
+            )
+
+        # The options are closed at the prices of the times the closes were initiated
+        self.chain.sleep(self.period + 1)
+        entries = [
+            (
+                self.tokenX_options.address,
+                self.router.tradesToClose(close_id)[3],
+                self.expected_strike * (2 + index),
+            )
+            for index, close_id in enumerate(close_ids)
+        ]
+        root, signature, proofs = self.get_price_root(entries)
+
+        # Root signed by someone other than the publisher
+        spam_publisher = self.accounts.add()
+        _, spam_signature, _ = self.get_price_root(entries, spam_publisher)
+        with brownie.reverts("Router: Signature didn't match"):
+            self.router.closeAnytimeWithProof(
+                root,
+                spam_signature,
+                [(close_ids[0], entries[0][2], proofs[0])],
+                {"from": self.bot},
+            )
+
+        # Proof of a different leaf shouldn't verify
+        txn = self.router.closeAnytimeWithProof(
+            root,
+            signature,
+            [(close_ids[0], entries[0][2], proofs[1])],
+            {"from": self.bot},
+        )
+        assert (
+            txn.events["FailUnlock"]["reason"] == "Router: Signature didn't match"
+        ), "Wrong event"
+        assert not self.router.tradesToClose(close_ids[0])[4], "Wrong state"
+
+        close_params = [
+            (close_id, entry[2], proof)
+            for close_id, entry, proof in zip(close_ids, entries, proofs)
+        ]
+        assert self.router.closeAnytimeWithProof.call(
+            root, signature, close_params, {"from": self.bot}
+        ) == [0b11], "Wrong status bitmap"
+        txn = self.router.closeAnytimeWithProof(
+            root, signature, close_params, {"from": self.bot}
+        )
+        assert [event["id"] for event in txn.events["Exercise"]] == option_ids
+        for close_id in close_ids:
+            assert self.router.tradesToClose(close_id)[4], "Trade not closed"
+
+        # Closed options can't be closed again
+        txn = self.router.closeAnytimeWithProof(
+            root, signature, close_params[:1], {"from": self.bot}
+        )
+        assert txn.events["FailUnlock"]["reason"] == "O10", "Wrong reason"
+        self.chain.revert()
+
+    def verify_failure_isolation(self):
+        self.chain.snapshot()
+        bfr_fee = int(1e18)
+        initial_bfr_balance = self.bfr.balanceOf(self.owner)
+        open_params = [
+            *self._queue_trades(1),
+            *self._queue_trades(1, self.bfr_options, bfr_fee, token=self.bfr),
+            *self._queue_trades(1),
+        ]
+
+        # Make pool.lock revert for the trade in the middle of the batch
+        self.bfr_pool.revokeRole(
+            self.bfr_pool.OPTION_ISSUER_ROLE(),
+            self.bfr_options.address,
+            {"from": self.owner},
+        )
+        with brownie.reverts("Router: Forbidden"):
+            self.router.openQueuedTrade(
+                open_params[1][0], self.expected_strike, {"from": self.bot}
+            )
+
+        # Not enough gas to open a trade shouldn't cancel it
+        with brownie.reverts("Router: Not enough gas"):
+            self.router.resolveQueuedTrades(
+                open_params,
+                {"from": self.bot, "gas_limit": self.router.MIN_OPEN_TRADE_GAS()},
+            )
+        assert self.router.queuedTrades(open_params[0][0])[self.index]
+
+        txn = self.router.resolveQueuedTrades(open_params, {"from": self.bot})
+        assert [event["queueId"] for event in txn.events["OpenTrade"]] == [
+            open_params[0][0],
+            open_params[2][0],
+        ], "Trades around the failing one should open"
+        assert txn.events["CancelTrade"]["queueId"] == open_params[1][0]
+        assert txn.events["CancelTrade"]["reason"].startswith("AccessControl")
+        assert not self.router.queuedTrades(open_params[1][0])[self.index]
+        assert self.bfr.balanceOf(self.owner) == initial_bfr_balance, "Not refunded"
+        assert self.bfr.balanceOf(self.router.address) == 0, "Wrong router balance"
+        assert self.tokenX.balanceOf(self.router.address) == 0, "Wrong router balance"
+        self.chain.revert()
+
+    def verify_pending_trades(self):
+        self.chain.snapshot()
+        start_id = self.router.nextQueueId()
+        queue_ids = [params[0] for params in self._queue_trades(3)]
+        self.router.cancelQueuedTrade(queue_ids[1], {"from": self.owner})
+
+        trades, lowest_pending_id = self.router.getPendingTrades(start_id, 2**64)
+        assert [trade[0] for trade in trades] == [queue_ids[0], queue_ids[2]]
+        assert lowest_pending_id == queue_ids[0], "Wrong watermark"
+        for trade in trades:
+            queued_trade = self.router.queuedTrades(trade[0])
+            assert trade[1] == self.tokenX_options.address, "Wrong target"
+            assert trade[2] == queued_trade[8], "Wrong queued time"
+
+        # The watermark moves to the end of the range when nothing is pending
+        self.router.cancelQueuedTrade(queue_ids[0], {"from": self.owner})
+        trades, lowest_pending_id = self.router.getPendingTrades(start_id, queue_ids[2])
+        assert not trades and lowest_pending_id == queue_ids[2]
+        trades, lowest_pending_id = self.router.getPendingTrades(
+            queue_ids[2], queue_ids[2]
+        )
+        assert not trades and lowest_pending_id == queue_ids[2]
+        self.chain.revert()
+
+    def verify_user_queued_trades(self):
+        self.chain.snapshot()
+        initial_count = self.router.userQueueCount(self.owner)
+        queue_ids = [params[0] for params in self._queue_trades(3)]
+        self.router.cancelQueuedTrade(queue_ids[1], {"from": self.owner})
+
+        # The whole history newest first
+        count = self.router.userQueueCount(self.owner)
+        assert count == initial_count + 3
+        history = [self.router.userQueuedIds(self.owner, i) for i in range(count)]
+        ids, trades = self.router.getUserQueuedTrades(self.owner, 0, count, False)
+        assert list(ids) == history[::-1], "Wrong history"
+        for queue_id, trade in zip(ids, trades):
+            assert trade == self.router.queuedTrades(queue_id), "Wrong trade"
+        ids = self.router.getUserQueuedTrades(self.owner, 1, 1, False)[0]
+        assert list(ids) == [queue_ids[1]], "Wrong page"
+        assert not self.router.getUserQueuedTrades(self.owner, count, 10, False)[0]
+
+        # Only the trades waiting to be opened
+        pending = [
+            queue_id for queue_id in history if self.router.queuedTrades(queue_id)[9]
+        ]
+        pending_count = self.router.userPendingQueueCount(self.owner)
+        assert pending_count == len(pending)
+        ids = self.router.getUserQueuedTrades(self.owner, 0, count, True)[0]
+        assert sorted(ids) == sorted(pending), "Wrong pending trades"
+        assert queue_ids[2] in ids and queue_ids[1] not in ids
+
+        # The cancelled trade was replaced by the last pending one in the index
+        assert list(ids[:2]) == [queue_ids[2], queue_ids[0]], "Wrong index order"
+        pages = [
+            self.router.getUserQueuedTrades(self.owner, offset, 1, True)[0]
+            for offset in range(pending_count + 1)
+        ]
+        assert [queue_id for page in pages for queue_id in page] == list(ids)
+
+        self.router.cancelQueuedTrade(queue_ids[2], {"from": self.owner})
+        ids = self.router.getUserQueuedTrades(self.owner, 0, count, True)[0]
+        assert queue_ids[2] not in ids and queue_ids[0] in ids
+        assert self.router.userPendingQueueCount(self.owner) == pending_count - 1
+        self.chain.revert()
+
+    def verify_batched_lock(self):
+        self.chain.snapshot()
+        open_params = self._queue_trades(3, referral_code="")
+
+        sfd = self.options_config.settlementFeeDisbursalContract()
+        initial_accrued_fees = self.tokenX_options.accruedSettlementFees()
+        initial_locked_premium = self.generic_pool.lockedPremium()
+        initial_pool_balance = self.tokenX.balanceOf(self.generic_pool.address)
+        initial_sfd_balance = self.tokenX.balanceOf(sfd)
+        txn = self.router.resolveQueuedTrades(open_params, {"from": self.bot})
+        assert len(txn.events["OpenTrade"]) == 3, "Trades not opened"
+
+        # Premiums are moved once for the whole batch and settlement fees stay
+        # in the options contract until they are swept
+        transfers = [
+            event
+            for event in txn.events["Transfer"]
+            if event.address == self.tokenX.address
+        ]
+        assert [event["to"] for event in transfers].count(
+            self.generic_pool.address
+        ) == 1, "Premiums weren't aggregated"
+        assert sfd not in [
+            event["to"] for event in transfers
+        ], "Settlement fees weren't accrued"
+
+        premiums = sum(
+            self.tokenX_options.options(event["optionId"])[2] // 2
+            for event in txn.events["OpenTrade"]
+        )
+        settlement_fees = sum(event["settlementFee"] for event in txn.events["Create"])
+        assert self.generic_pool.lockedPremium() - initial_locked_premium == premiums
+        assert (
+            self.tokenX.balanceOf(self.generic_pool.address) - initial_pool_balance
+            == premiums
+        ), "Wrong premium transferred"
+        assert (
+            self.tokenX_options.accruedSettlementFees() - initial_accrued_fees
+            == settlement_fees
+        ), "Wrong settlement fee accrued"
+        assert self.tokenX_options.pendingPremium() == 0, "Pending premium not cleared"
+
+        self.tokenX_options.sweepSettlementFees(False, {"from": self.user_2})
+        assert (
+            self.tokenX.balanceOf(sfd) - initial_sfd_balance
+            == initial_accrued_fees + settlement_fees
+        ), "Wrong settlement fee transferred"
+        assert self.tokenX.balanceOf(self.tokenX_options.address) == 0
+        for event in txn.events["OpenTrade"]:
+            assert (
+                self.generic_pool.lockedLiquidity(
+                    self.tokenX_options.address, event["optionId"]
+                )[1]
+                == self.tokenX_options.options(event["optionId"])[2] // 2
+            )
+        self.chain.revert()
+
+    def deploy_market(self, token):
+        # Deploys and registers a pool and an options contract on the token
+        pool = BufferBinaryPool.deploy(token.address, 600, {"from": self.owner})
+        options_config = OptionsConfig.deploy(pool.address, {"from": self.owner})
+        options = BufferBinaryOptions.deploy(
+            token.address,
+            pool.address,
+            options_config.address,
+            self.tokenX_options.referral(),
+            1,
+            "ETH_BTC",
+            {"from": self.owner},
+        )
+        options_config.setSettlementFeeDisbursalContract(
+            self.accounts.add(), {"from": self.owner}
+        )
+        options.approvePoolToTransferTokenX({"from": self.owner})
+        pool.grantRole(pool.OPTION_ISSUER_ROLE(), options.address, {"from": self.owner})
+        options.grantRole(
+            options.ROUTER_ROLE(), self.router.address, {"from": self.owner}
+        )
+        options.configure(15e2, 15e2, [5, 10, 16, 24], {"from": self.owner})
+        self.router.setContractRegistry(options.address, True, {"from": self.owner})
+
+        token.approve(pool.address, self.liquidity, {"from": self.owner})
+        pool.provide(self.liquidity, 0, {"from": self.owner})
+        return options
+
+    def verify_failed_transfer(self):
+        self.chain.snapshot()
+        token = BlacklistUSDC.deploy({"from": self.owner})
+        options = self.deploy_market(token)
+        token.transfer(self.user_1, self.total_fee, {"from": self.owner})
+
+        open_params = [
+            *self._queue_trades(1, options, referral_code="", token=token),
+            *self._queue_trades(
+                1,
+                options,
+                prices=[self.expected_strike * 2],
+                referral_code="",
+                user=self.user_1,
+                token=token,
+            ),
+        ]
+
+        # The refund of the cancelled trade can't be sent to the blacklisted user
+        token.setBlacklisted(self.user_1, True, {"from": self.owner})
+        txn = self.router.resolveQueuedTrades(open_params, {"from": self.bot})
+        assert txn.events["OpenTrade"]["queueId"] == open_params[0][0]
+        assert txn.events["CancelTrade"]["queueId"] == open_params[1][0]
+        assert txn.events["FailTransfer"]["account"] == self.user_1
+        assert txn.events["FailTransfer"]["amount"] == self.total_fee
+        assert not options.pendingPremium(), "Premium not settled"
+        assert (
+            self.router.claimableBalance(token.address, self.user_1) == self.total_fee
+        ), "Refund not claimable"
+        assert token.balanceOf(self.router.address) == self.total_fee
+
+        # The user can claim the refund to another address
+        with brownie.reverts("Router: Nothing to claim"):
+            self.router.claim(token.address, self.user_2, {"from": self.user_2})
+        txn = self.router.claim(token.address, self.user_2, {"from": self.user_1})
+        assert txn.events["Claim"]["amount"] == self.total_fee
+        assert token.balanceOf(self.user_2) == self.total_fee, "Wrong claim"
+        assert self.router.claimableBalance(token.address, self.user_1) == 0
+        assert token.balanceOf(self.router.address) == 0
+
+        # The premiums of the opened trades can't be kept claimable, so the
+        # batch reverts if the options contract or its pool can't receive them
+        open_params = self._queue_trades(2, options, referral_code="", token=token)
+        pool = BufferBinaryPool.at(options.pool())
+        for blacklisted in (options, pool):
+            token.setBlacklisted(blacklisted, True, {"from": self.owner})
+            with brownie.reverts("Blacklistable: account is blacklisted"):
+                self.router.resolveQueuedTrades(open_params, {"from": self.bot})
+            token.setBlacklisted(blacklisted, False, {"from": self.owner})
+            for params in open_params:
+                assert self.router.queuedTrades(params[0])[self.index], "Not queued"
+            assert not options.pendingPremium(), "Premium left pending"
+
+        txn = self.router.resolveQueuedTrades(open_params, {"from": self.bot})
+        assert len(txn.events["OpenTrade"]) == 2, "Trades not opened"
+        assert "FailTransfer" not in txn.events
+        self.chain.revert()
+
+    def clear_market_cache(self, options):
+        # Empties the cached metadata of a market that stays registered. The
+        # marketInfo entry is found as the one whose second slot holds tokenX
+        key = int(options.address, 16)
+        for slot in range(32):
+            entry = int(
+                web3.solidityKeccak(["uint256", "uint256"], [key, slot]).hex(), 16
+            )
+            cached_token = web3.eth.get_storage_at(self.router.address, entry + 1)
+            if int(cached_token.hex(), 16) == int(self.tokenX.address, 16):
+                break
+        else:
+            raise AssertionError("marketInfo entry not found")
+        for location in (entry, entry + 1):
+            web3.provider.make_request(
+                "evm_setAccountStorageAt",
+                [self.router.address, f"0x{location:064x}", "0x" + "00" * 32],
+            )
+        assert self.router.marketInfo(options.address)[1] == ADDRESS_0
+        assert self.router.contractRegistry(options.address), "Market deregistered"
+
+    def benchmark_batch_resolution(self, batch_sizes):
+        # Compares the gas used by batches resolved with the cached market metadata
+        # against the same batches resolved through the uncached fallback, both on
+        # the same registered market
+        for batch_size in batch_sizes:
+            open_params = self._queue_trades(batch_size)
+
+            self.chain.snapshot()
+            txn = self.router.resolveQueuedTrades(open_params, {"from": self.bot})
+            assert len(txn.events["OpenTrade"]) == batch_size, "Trades not opened"
+            cached_gas = txn.gas_used
+            self.chain.revert()
+
+            self.clear_market_cache(self.tokenX_options)
+            txn = self.router.resolveQueuedTrades(open_params, {"from": self.bot})
+            assert len(txn.events["OpenTrade"]) == batch_size, "Trades not opened"
+            uncached_gas = txn.gas_used
+            self.router.setContractRegistry(self.tokenX_options.address, True)
+
+            print(
+                f"batch of {batch_size}: cached {cached_gas // batch_size}/trade,"
+                f" uncached {uncached_gas // batch_size}/trade"
+            )
+            assert cached_gas < uncached_gas, "Cache should reduce the gas used"
+
+    def queued_trade_slots(self, queue_id):
+        # Counts the storage slots written for the queued trade. The queuedTrades
+        # entry is found as the one whose second slot holds the target contract
+        trade = self.router.queuedTrades(queue_id)
+        for slot in range(32):
+            entry = int(
+                web3.solidityKeccak(["uint256", "uint256"], [queue_id, slot]).hex(), 16
+            )
+            word = web3.eth.get_storage_at(self.router.address, entry + 1)
+            if int(word.hex(), 16) & (2**160 - 1) == int(trade[5], 16):
+                break
+        else:
+            raise AssertionError("queuedTrades entry not found")
+        # The unpacked layout used 13 slots
+        return sum(
+            int(web3.eth.get_storage_at(self.router.address, entry + i).hex(), 16) != 0
+            for i in range(13)
+        )
+
+    def benchmark_trade_initiation(self, trade_count):
+        # Measures initiateTrade and the slots its queued trade occupies. The
+        # referral code hash is the only optional slot
+        self.tokenX.approve(
+            self.router.address,
+            self.total_fee * trade_count * 2,
+            {"from": self.owner},
+        )
+        for referral_code in (self.referral_code, ""):
+            params = (
+                self.total_fee,
+                self.period,
+                self.is_above,
+                self.tokenX_options.address,
+                self.expected_strike,
+                self.slippage,
+                self.allow_partial_fill,
+                referral_code,
+                0,
+            )
+            txns = [
+                self.router.initiateTrade(*params, {"from": self.owner})
+                for _ in range(trade_count)
+            ]
+            gas_used = [txn.gas_used for txn in txns]
+            print(
+                f"initiateTrade with referral code {referral_code!r}:"
+                f" first {gas_used[0]}, average {sum(gas_used) // trade_count}"
+            )
+            for txn in txns:
+                assert self.queued_trade_slots(
+                    txn.events["InitiateTrade"]["queueId"]
+                ) == (4 if referral_code else 3), "Layout isn't packed"
+
+    def benchmark_user_netting(self, trade_count):
+        # Half of the trades get cancelled for slippage so that the user is refunded
+        # several times in the batch. All the refunds and all the fees sent to the
+        # options contract should be settled with a single transfer each
+        initial_balance = self.tokenX.balanceOf(self.owner)
+        open_params = self._queue_trades(
+            trade_count,
+            prices=[
+                self.expected_strike * (2 if index % 2 else 1)
+                for index in range(trade_count)
+            ],
+            referral_code="",
+        )
+
+        txn = self.router.resolveQueuedTrades(open_params, {"from": self.bot})
+        opened = len(txn.events["OpenTrade"])
+        cancelled = len(txn.events["CancelTrade"])
+        assert opened == cancelled == trade_count // 2, "Wrong trades opened"
+
+        transfers = [
+            event
+            for event in txn.events["Transfer"]
+            if event.address == self.tokenX.address
+            and event["from"] == self.router.address
+        ]
+        assert sorted(event["to"] for event in transfers) == sorted(
+            [self.owner.address, self.tokenX_options.address]
+        ), "Transfers weren't netted"
+        assert self.tokenX.balanceOf(self.router.address) == 0
+        assert initial_balance - self.tokenX.balanceOf(self.owner) == sum(
+            event["totalFee"] for event in txn.events["Create"]
+        ), "Wrong refund"
+        print(
+            f"{trade_count} trades of a single user:"
+            f" {txn.gas_used // trade_count}/trade"
+        )
+
     def complete_flow_test(self):
         self.init()
         self.verify_owner()
@@ -1057,45 +1808,62 @@ class Router(object):
         self.verify_trade_execution()
         self.verify_trade_execution_with_cancellable_trades()
         self.verify_multitoken_router()
+        self.verify_price_root_resolution()
+        self.verify_packed_resolution()
+        self.verify_close_anytime_with_proof()
+        self.verify_failure_isolation()
+        self.verify_pending_trades()
+        self.verify_user_queued_trades()
+        self.verify_batched_lock()
+        self.verify_failed_transfer()
         self.verify_option_unlocking()
 
 
-def test_router(contracts, accounts, chain):
-
-    tokenX = contracts["tokenX"]
-    binary_pool_atm = contracts["binary_pool_atm"]
-    binary_options_config_atm = contracts["binary_options_config_atm"]
-    router = contracts["router"]
-    binary_european_options_atm = contracts["binary_european_options_atm"]
-
-    ibfr_contract = contracts["ibfr_contract"]
-    bfr_pool_atm = contracts["bfr_pool_atm"]
-    bfr_binary_options_config_atm = contracts["bfr_binary_options_config_atm"]
-    bfr_binary_european_options_atm = contracts["bfr_binary_european_options_atm"]
-    publisher = contracts["publisher"]
-
-    total_fee = int(1e6)
-    liquidity = int(1500e6)
-    period = 600
-    isYes = True
-    isAbove = True
-    option = Router(
+@pytest.fixture
+def router_flow(contracts, accounts, chain):
+    return Router(
         accounts,
-        binary_european_options_atm,
-        binary_pool_atm,
-        total_fee,
+        contracts["binary_european_options_atm"],
+        contracts["binary_pool_atm"],
+        int(1e6),
         chain,
-        tokenX,
-        liquidity,
-        binary_options_config_atm,
-        period,
-        isYes,
-        isAbove,
-        router,
-        ibfr_contract,
-        bfr_pool_atm,
-        bfr_binary_options_config_atm,
-        bfr_binary_european_options_atm,
-        publisher,
+        contracts["tokenX"],
+        int(1500e6),
+        contracts["binary_options_config_atm"],
+        600,
+        True,
+        True,
+        contracts["router"],
+        contracts["ibfr_contract"],
+        contracts["bfr_pool_atm"],
+        contracts["bfr_binary_options_config_atm"],
+        contracts["bfr_binary_european_options_atm"],
+        contracts["publisher"],
     )
-    option.complete_flow_test()
+
+
+def test_router(router_flow):
+    router_flow.complete_flow_test()
+
+
+@pytest.mark.benchmark
+def test_router_batch_gas(router_flow):
+    router_flow.liquidity = int(6500e6)
+    router_flow.init()
+    router_flow.router.setContractRegistry(router_flow.tokenX_options.address, True)
+    router_flow.router.setKeeper(router_flow.bot, True)
+    router_flow.benchmark_batch_resolution([1, 10, 100])
+
+
+@pytest.mark.benchmark
+def test_router_initiate_trade_gas(router_flow):
+    router_flow.router.setContractRegistry(router_flow.tokenX_options.address, True)
+    router_flow.benchmark_trade_initiation(10)
+
+
+@pytest.mark.benchmark
+def test_router_netting_gas(router_flow):
+    router_flow.init()
+    router_flow.router.setContractRegistry(router_flow.tokenX_options.address, True)
+    router_flow.router.setKeeper(router_flow.bot, True)
+    router_flow.benchmark_user_netting(20)